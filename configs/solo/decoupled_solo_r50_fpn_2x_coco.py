@@ -0,0 +1,14 @@
+_base_ = './solo_r50_fpn_2x_coco.py'
+
+custom_imports = dict(
+    imports=['models.dense_heads.solo_head',
+             'models.dense_heads.decoupled_solo_head',
+             'models.detectors.solo'],
+    allow_failed_imports=False)
+
+# model settings
+model = dict(
+    bbox_head=dict(
+        type='DecoupledSOLOHead',
+        # one target per instance instead of S^2 planes on every level
+        sparse_ins_label=True))
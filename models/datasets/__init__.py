@@ -0,0 +1,11 @@
+from .coco import (FastCocoDataset, FastCOCOeval, StreamingCocoEval,
+                   fast_coco_eval)
+from .feature_store import FeatureStoreDataset, FeatureStoreWriter
+from .results_file import (ResultsFile, ResultsWriter, dump_results,
+                           load_results)
+
+__all__ = [
+    'FastCocoDataset', 'FastCOCOeval', 'fast_coco_eval', 'StreamingCocoEval',
+    'FeatureStoreDataset', 'FeatureStoreWriter', 'ResultsFile',
+    'ResultsWriter', 'dump_results', 'load_results'
+]
@@ -0,0 +1,547 @@
+import contextlib
+import copy
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import os.path as osp
+import tempfile
+import time
+from collections import OrderedDict
+from functools import partial
+
+import mmdet.datasets.coco as mmdet_coco
+import numpy as np
+from mmcv.utils import print_log
+from pycocotools import mask as mask_util
+from pycocotools.cocoeval import COCOeval
+from terminaltables import AsciiTable
+
+from mmdet.datasets import CocoDataset
+from mmdet.datasets.builder import DATASETS
+
+from .results_file import ResultsFile
+
+# (image, category) pairs matched at once, sorted by their number of
+# detections
+PAIRS_PER_BLOCK = 512
+
+# indices of the metrics in COCOeval.stats
+COCO_METRIC_NAMES = {
+    'mAP': 0,
+    'mAP_50': 1,
+    'mAP_75': 2,
+    'mAP_s': 3,
+    'mAP_m': 4,
+    'mAP_l': 5,
+    'AR@100': 6,
+    'AR@300': 7,
+    'AR@1000': 8,
+    'AR_s@1000': 9,
+    'AR_m@1000': 10,
+    'AR_l@1000': 11
+}
+
+
+def _pair_inputs(gts, dts, iou_type, max_det):
+    """Detections of an (image, category) pair sorted and cut like
+    COCOeval.computeIoU, and their IoU with the GTs."""
+    inds = np.argsort([-dt['score'] for dt in dts], kind='mergesort')
+    dts = [dts[i] for i in inds[:max_det]]
+    key = 'segmentation' if iou_type == 'segm' else 'bbox'
+    iscrowd = [int(gt['iscrowd']) for gt in gts]
+    if len(gts) == 0 or len(dts) == 0:
+        ious = np.zeros((len(dts), len(gts)))
+    else:
+        ious = np.asarray(mask_util.iou([dt[key] for dt in dts],
+                                        [gt[key] for gt in gts], iscrowd))
+    return dict(
+        gt_ids=[gt['id'] for gt in gts],
+        gt_ignore=np.array([gt['ignore'] for gt in gts], dtype=bool),
+        gt_area=np.array([gt['area'] for gt in gts], dtype=np.float64),
+        iscrowd=np.array(iscrowd, dtype=bool),
+        dt_ids=[dt['id'] for dt in dts],
+        dt_scores=[dt['score'] for dt in dts],
+        dt_area=np.array([dt['area'] for dt in dts], dtype=np.float64),
+        ious=ious)
+
+
+def _match_block(pairs, iou_thrs, area_rngs):
+    """COCOeval.evaluateImg for a block of pairs and all area ranges.
+    The greedy matching of pycocotools goes through the detections in
+    order. Here the i-th detections of all pairs, area ranges and IoU
+    thresholds are matched in one step, which gives the same matches.
+    Returns:
+        list[list[dict]]: the evalImgs entries of every pair, one per area
+            range
+    """
+    num_pairs, num_thrs = len(pairs), len(iou_thrs)
+    num_gts = np.array([len(pair['gt_ids']) for pair in pairs])
+    num_dts = np.array([len(pair['dt_ids']) for pair in pairs])
+    max_gts, max_dts = max(num_gts.max(), 1), max(num_dts.max(), 1)
+    lo, hi = np.asarray(area_rngs, dtype=np.float64).T[:, None, :, None]
+    thrs = np.minimum(np.asarray(iou_thrs), 1 - 1e-10)[None, None, :, None]
+
+    # pairs padded to the largest one, padding GTs ignored and after all
+    # others
+    gt_valid = np.arange(max_gts) < num_gts[:, None]
+    gt_ignore = np.ones((num_pairs, max_gts), dtype=bool)
+    gt_area = np.zeros((num_pairs, max_gts))
+    crowd = np.zeros((num_pairs, max_gts), dtype=bool)
+    gt_ids = np.zeros((num_pairs, max_gts), dtype=np.int64)
+    dt_ids = np.zeros((num_pairs, max_dts))
+    dt_area = np.zeros((num_pairs, max_dts))
+    ious = np.full((num_pairs, max_dts, max_gts), -1.)
+    for p, pair in enumerate(pairs):
+        num_gt, num_dt = num_gts[p], num_dts[p]
+        gt_ignore[p, :num_gt] = pair['gt_ignore']
+        gt_area[p, :num_gt] = pair['gt_area']
+        crowd[p, :num_gt] = pair['iscrowd']
+        gt_ids[p, :num_gt] = pair['gt_ids']
+        dt_ids[p, :num_dt] = pair['dt_ids']
+        dt_area[p, :num_dt] = pair['dt_area']
+        ious[p, :num_dt, :num_gt] = pair['ious']
+
+    # GTs of every area range, not ignored first as in evaluateImg
+    gt_ig = gt_ignore[:, None] | (gt_area[:, None] < lo) | \
+        (gt_area[:, None] > hi)
+    order = np.argsort(
+        gt_ig.astype(np.int8) + ~gt_valid[:, None], axis=-1, kind='mergesort')
+    gt_ig = np.take_along_axis(gt_ig, order, axis=-1)
+    gt_valid = np.take_along_axis(
+        np.broadcast_to(gt_valid[:, None], order.shape), order, axis=-1)
+    crowd = np.take_along_axis(crowd[:, None], order, axis=-1)
+    gt_ids = np.take_along_axis(gt_ids[:, None], order, axis=-1)
+    ious = np.take_along_axis(ious[:, None], order[:, :, None], axis=-1)
+
+    gt_m = np.zeros((num_pairs, len(area_rngs), num_thrs, max_gts))
+    dt_m = np.zeros((num_pairs, len(area_rngs), num_thrs, max_dts))
+    dt_ig = np.zeros(dt_m.shape, dtype=bool)
+    for d in range(num_dts.max() if num_gts.max() > 0 else 0):
+        # the pairs with a d-th detection, a prefix since they are sorted
+        n = int((num_dts > d).sum())
+        iou = ious[:n, :, d, None, :]
+        candidate = gt_valid[:n, :, None] & (iou >= thrs) & \
+            ~((gt_m[:n] > 0) & ~crowd[:n, :, None])
+        # the best GT not ignored, else the best ignored one, the last of
+        # equal IoUs wins
+        not_ig = candidate & ~gt_ig[:n, :, None]
+        candidate = np.where(
+            not_ig.any(axis=-1, keepdims=True), not_ig, candidate)
+        score = np.where(candidate, iou, -np.inf)
+        best = candidate & (score == score.max(axis=-1, keepdims=True))
+        m = max_gts - 1 - best[..., ::-1].argmax(axis=-1)
+        pi, ai, ti = np.nonzero(candidate.any(axis=-1))
+        mi = m[pi, ai, ti]
+        dt_ig[pi, ai, ti, d] = gt_ig[pi, ai, mi]
+        dt_m[pi, ai, ti, d] = gt_ids[pi, ai, mi]
+        gt_m[pi, ai, ti, mi] = dt_ids[pi, d]
+    # unmatched detections out of the area range are ignored
+    dt_ig |= (dt_m == 0) & ((dt_area[:, None] < lo) |
+                            (dt_area[:, None] > hi))[:, :, None]
+    gt_ig = gt_ig.astype(np.int64)
+
+    results = []
+    for p, pair in enumerate(pairs):
+        num_gt, num_dt = num_gts[p], num_dts[p]
+        results.append([
+            dict(
+                dtIds=pair['dt_ids'],
+                gtIds=gt_ids[p, a, :num_gt].tolist(),
+                dtMatches=dt_m[p, a, :, :num_dt],
+                gtMatches=gt_m[p, a, :, :num_gt],
+                dtScores=pair['dt_scores'],
+                gtIgnore=gt_ig[p, a, :num_gt],
+                dtIgnore=dt_ig[p, a, :, :num_dt])
+            for a in range(len(area_rngs))
+        ])
+    return results
+
+
+def evaluate_pairs(pairs, iou_type, iou_thrs, area_rngs, max_det):
+    """evalImgs entries of (image, category) pairs.
+    Args:
+        pairs (list[tuple]): gts and dts of every pair, as prepared by
+            COCOeval._prepare
+        iou_type (str): 'segm' or 'bbox'
+        iou_thrs (ndarray): IoU thresholds
+        area_rngs (list): area ranges
+        max_det (int): largest maxDets
+    Returns:
+        list[list[dict]]: for every pair, its entries for every area range,
+            without image_id, category_id, aRng and maxDet
+    """
+    inputs = [
+        _pair_inputs(gts, dts, iou_type, max_det) for gts, dts in pairs
+    ]
+    order = sorted(
+        range(len(inputs)), key=lambda i: -len(inputs[i]['dt_ids']))
+    results = [None] * len(inputs)
+    for start in range(0, len(order), PAIRS_PER_BLOCK):
+        block = order[start:start + PAIRS_PER_BLOCK]
+        for i, entries in zip(block,
+                              _match_block([inputs[i] for i in block],
+                                           iou_thrs, area_rngs)):
+            results[i] = entries
+    return results
+
+
+# pairs inherited by forked workers
+_shared = {}
+
+
+def _evaluate_shared(chunk, evaluate):
+    return evaluate(_shared['pairs'][chunk])
+
+
+class FastCOCOeval(COCOeval):
+    """COCOeval whose per image evaluation is vectorized and runs in a
+    process pool. It fills evalImgs with the same entries as COCOeval, so
+    accumulate and summarize are unchanged and give identical metrics.
+    Args:
+        nproc (int): worker processes, at most one per cpu and per block of
+            pairs, 0 or 1 to evaluate in this process
+    """
+
+    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm', nproc=4):
+        super(FastCOCOeval, self).__init__(cocoGt, cocoDt, iouType)
+        self.nproc = nproc
+
+    def evaluate(self):
+        if self.params.iouType not in ('segm', 'bbox') or \
+                self.params.useSegm is not None:
+            return super(FastCOCOeval, self).evaluate()
+        tic = time.time()
+        print('Running per image evaluation...')
+        p = self.params
+        print('Evaluate annotation type *{}*'.format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self._prepare()
+        cat_ids = p.catIds if p.useCats else [-1]
+
+        keys, pairs = [], []
+        for cat_id in cat_ids:
+            for img_id in p.imgIds:
+                if p.useCats:
+                    gts = self._gts[img_id, cat_id]
+                    dts = self._dts[img_id, cat_id]
+                else:
+                    gts = [g for c in p.catIds for g in self._gts[img_id, c]]
+                    dts = [d for c in p.catIds for d in self._dts[img_id, c]]
+                if len(gts) > 0 or len(dts) > 0:
+                    keys.append((cat_id, img_id))
+                    pairs.append((gts, dts))
+
+        evaluate = partial(
+            evaluate_pairs,
+            iou_type=p.iouType,
+            iou_thrs=p.iouThrs,
+            area_rngs=p.areaRng,
+            max_det=p.maxDets[-1])
+        # at least a block of pairs per worker, and no more workers than
+        # cpus
+        nproc = min(self.nproc, os.cpu_count(),
+                    len(pairs) // PAIRS_PER_BLOCK)
+        if nproc > 1:
+            # the workers are forked and inherit the pairs, they only run
+            # numpy and pycocotools so the OpenMP pool of torch is not an
+            # issue
+            _shared['pairs'] = pairs
+            try:
+                with multiprocessing.get_context('fork').Pool(nproc) as pool:
+                    chunk_results = pool.map(
+                        partial(_evaluate_shared, evaluate=evaluate),
+                        [slice(i, None, nproc) for i in range(nproc)])
+            finally:
+                _shared.clear()
+            results = [None] * len(pairs)
+            for i, chunk_result in enumerate(chunk_results):
+                results[i::nproc] = chunk_result
+        else:
+            results = evaluate(pairs)
+
+        evaluated = dict(zip(keys, results))
+        self.ious = {}
+        self.evalImgs = []
+        for cat_id in cat_ids:
+            for a, area_rng in enumerate(p.areaRng):
+                for img_id in p.imgIds:
+                    entries = evaluated.get((cat_id, img_id))
+                    if entries is None:
+                        self.evalImgs.append(None)
+                        continue
+                    entry = dict(
+                        image_id=img_id,
+                        category_id=cat_id,
+                        aRng=area_rng,
+                        maxDet=p.maxDets[-1])
+                    entry.update(entries[a])
+                    self.evalImgs.append(entry)
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc - tic))
+
+
+@contextlib.contextmanager
+def fast_coco_eval(nproc=4):
+    """Evaluate mmdet COCO datasets with `FastCOCOeval` in the context."""
+    coco_eval = mmdet_coco.COCOeval
+    mmdet_coco.COCOeval = partial(FastCOCOeval, nproc=nproc)
+    try:
+        yield
+    finally:
+        mmdet_coco.COCOeval = coco_eval
+
+
+@DATASETS.register_module()
+class FastCocoDataset(CocoDataset):
+    """CocoDataset evaluated with `FastCOCOeval`.
+    The results can also be a `ResultsFile` or the path of one.
+    Args:
+        eval_nproc (int): worker processes of the evaluation
+    """
+
+    def __init__(self, *args, eval_nproc=4, **kwargs):
+        super(FastCocoDataset, self).__init__(*args, **kwargs)
+        self.eval_nproc = eval_nproc
+
+    def format_results(self, results, jsonfile_prefix=None, **kwargs):
+        if isinstance(results, str):
+            results = ResultsFile(results)
+        if not isinstance(results, ResultsFile):
+            return super(FastCocoDataset, self).format_results(
+                results, jsonfile_prefix, **kwargs)
+        assert len(results) == len(self), (
+            'The length of results is not equal to the dataset len: {} != {}'.
+            format(len(results), len(self)))
+        if jsonfile_prefix is None:
+            tmp_dir = tempfile.TemporaryDirectory()
+            jsonfile_prefix = osp.join(tmp_dir.name, 'results')
+        else:
+            tmp_dir = None
+        result_files = self.results2json(results, jsonfile_prefix)
+        return result_files, tmp_dir
+
+    def evaluate(self, results, *args, **kwargs):
+        if isinstance(results, str):
+            results = ResultsFile(results)
+        with fast_coco_eval(self.eval_nproc):
+            return super(FastCocoDataset, self).evaluate(
+                results, *args, **kwargs)
+
+
+class StreamingCocoEval:
+    """Incremental COCO bbox / segm evaluation of a CocoDataset.
+    Every image is matched against its GTs as soon as its result is given
+    to `process`, and only the scores and matches of its detections are
+    kept, so the results need not be stored. `evaluate` then gives the
+    metrics of CocoDataset.evaluate.
+    Args:
+        dataset (CocoDataset): the test dataset
+        metric (str | list[str]): 'bbox' and / or 'segm'
+        classwise (bool): log the AP of every class
+        proposal_nums (Sequence[int]): maxDets of the evaluation
+        iou_thrs (Sequence[float]): IoU thresholds, 0.5:0.95 if not given
+        metric_items (list[str] | str): metrics returned, the AP of all, small,
+            medium and large objects if not given
+    """
+
+    def __init__(self,
+                 dataset,
+                 metric='bbox',
+                 classwise=False,
+                 proposal_nums=(100, 300, 1000),
+                 iou_thrs=None,
+                 metric_items=None):
+        self.metrics = metric if isinstance(metric, list) else [metric]
+        for metric in self.metrics:
+            if metric not in ['bbox', 'segm']:
+                raise KeyError(f'metric {metric} is not supported')
+        if iou_thrs is None:
+            iou_thrs = np.linspace(
+                .5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        if metric_items is None:
+            metric_items = [
+                'mAP', 'mAP_50', 'mAP_75', 'mAP_s', 'mAP_m', 'mAP_l'
+            ]
+        elif not isinstance(metric_items, list):
+            metric_items = [metric_items]
+        for metric_item in metric_items:
+            if metric_item not in COCO_METRIC_NAMES:
+                raise KeyError(f'metric item {metric_item} is not supported')
+        self.dataset = dataset
+        self.classwise = classwise
+        self.metric_items = metric_items
+        self.cat_ids = dataset.coco.get_cat_ids(cat_names=dataset.CLASSES)
+        self.coco_evals = {}
+        for metric in self.metrics:
+            coco_eval = COCOeval(dataset.coco, iouType=metric)
+            p = coco_eval.params
+            p.imgIds = list(np.unique(dataset.img_ids))
+            p.catIds = list(np.unique(self.cat_ids))
+            p.maxDets = sorted(proposal_nums)
+            p.iouThrs = iou_thrs
+            self.coco_evals[metric] = coco_eval
+        # compact evalImgs entries, by metric and (category, image)
+        self.entries = {metric: {} for metric in self.metrics}
+        self.num_dets = dict.fromkeys(self.metrics, 0)
+        self.done = set()
+
+    def _gts(self, img_id, iou_type):
+        """GTs of an image as prepared by COCOeval._prepare."""
+        coco = self.dataset.coco
+        gts = []
+        for ann in coco.loadAnns(
+                coco.getAnnIds(imgIds=[img_id], catIds=self.cat_ids)):
+            gt = dict(ann)
+            if iou_type == 'segm':
+                gt['segmentation'] = coco.annToRLE(ann)
+            gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
+            gts.append(gt)
+        return gts
+
+    def _dts(self, result, iou_type):
+        """Detections of an image as converted by CocoDataset.results2json
+        and loaded by COCO.loadRes."""
+        det, seg = result if isinstance(result, tuple) else (result, None)
+        if iou_type == 'segm' and seg is None:
+            raise KeyError('segm is not in results')
+        dts = []
+        for label, bboxes in enumerate(det):
+            if iou_type == 'segm':
+                if isinstance(seg, tuple):
+                    segms, scores = seg[0][label], seg[1][label]
+                else:
+                    segms, scores = seg[label], bboxes[:, 4]
+            for i, bbox in enumerate(bboxes):
+                if iou_type == 'bbox':
+                    xywh = self.dataset.xyxy2xywh(bbox)
+                    dt = dict(
+                        bbox=xywh, score=float(bbox[4]),
+                        area=xywh[2] * xywh[3])
+                else:
+                    # the bbox is dropped by mmdet, so the area is the one
+                    # of the mask
+                    dt = dict(
+                        segmentation=segms[i],
+                        score=float(scores[i]),
+                        area=mask_util.area(segms[i]))
+                dt.update(
+                    category_id=self.cat_ids[label],
+                    iscrowd=0,
+                    id=self.num_dets[iou_type] + len(dts) + 1)
+                dts.append(dt)
+        return dts
+
+    def _match(self, iou_type, img_id, dts):
+        p = self.coco_evals[iou_type].params
+        gts = self._gts(img_id, iou_type)
+        keys, pairs = [], []
+        for cat_id in p.catIds:
+            cat_gts = [gt for gt in gts if gt['category_id'] == cat_id]
+            cat_dts = [dt for dt in dts if dt['category_id'] == cat_id]
+            if len(cat_gts) > 0 or len(cat_dts) > 0:
+                keys.append((cat_id, img_id))
+                pairs.append((cat_gts, cat_dts))
+        results = evaluate_pairs(pairs, iou_type, p.iouThrs, p.areaRng,
+                                 p.maxDets[-1])
+        entries = self.entries[iou_type]
+        for key, pair_entries in zip(keys, results):
+            # all accumulate reads, stacked over the area ranges
+            entries[key] = dict(
+                dtScores=np.asarray(pair_entries[0]['dtScores']),
+                dtMatches=np.stack(
+                    [entry['dtMatches'] != 0 for entry in pair_entries]),
+                dtIgnore=np.stack(
+                    [entry['dtIgnore'] for entry in pair_entries]),
+                gtIgnore=np.stack([
+                    entry['gtIgnore'] for entry in pair_entries
+                ]).astype(np.int8))
+        self.num_dets[iou_type] += len(dts)
+
+    @staticmethod
+    def _entry(entry, area_idx):
+        """evalImgs entry of an area range."""
+        if entry is None:
+            return None
+        return dict(
+            dtScores=entry['dtScores'],
+            dtMatches=entry['dtMatches'][area_idx],
+            dtIgnore=entry['dtIgnore'][area_idx],
+            gtIgnore=entry['gtIgnore'][area_idx])
+
+    def process(self, idx, result):
+        """Match the result of the idx-th image of the dataset."""
+        img_id = self.dataset.img_ids[idx]
+        for metric in self.metrics:
+            self._match(metric, img_id, self._dts(result, metric))
+        self.done.add(img_id)
+
+    def evaluate(self, logger=None):
+        """Metrics of the processed results, as CocoDataset.evaluate.
+        Images without a result count as images without detections.
+        """
+        eval_results = OrderedDict()
+        for metric in self.metrics:
+            msg = f'Evaluating {metric}...'
+            if logger is None:
+                msg = '\n' + msg
+            print_log(msg, logger=logger)
+            if self.num_dets[metric] == 0:
+                print_log(
+                    'The testing results of the whole dataset is empty.',
+                    logger=logger,
+                    level=logging.ERROR)
+                break
+
+            coco_eval = self.coco_evals[metric]
+            p = coco_eval.params
+            for img_id in p.imgIds:
+                if img_id not in self.done:
+                    self._match(metric, img_id, [])
+            entries = self.entries[metric]
+            coco_eval.evalImgs = [
+                self._entry(entries.get((cat_id, img_id)), a)
+                for cat_id in p.catIds for a in range(len(p.areaRng))
+                for img_id in p.imgIds
+            ]
+            coco_eval._paramsEval = copy.deepcopy(p)
+            coco_eval.accumulate()
+            redirect_string = io.StringIO()
+            with contextlib.redirect_stdout(redirect_string):
+                coco_eval.summarize()
+            print_log('\n' + redirect_string.getvalue(), logger=logger)
+
+            if self.classwise:
+                precisions = coco_eval.eval['precision']
+                results_per_category = []
+                for idx, cat_id in enumerate(self.cat_ids):
+                    # area range index 0: all area ranges
+                    # max dets index -1: typically 100 per image
+                    name = self.dataset.coco.loadCats(cat_id)[0]['name']
+                    precision = precisions[:, :, idx, 0, -1]
+                    precision = precision[precision > -1]
+                    ap = np.mean(precision) if precision.size else float('nan')
+                    results_per_category.append((name, f'{float(ap):0.3f}'))
+                num_columns = min(6, len(results_per_category) * 2)
+                results_flatten = list(itertools.chain(*results_per_category))
+                table_data = [['category', 'AP'] * (num_columns // 2)]
+                table_data += list(
+                    itertools.zip_longest(*[
+                        results_flatten[i::num_columns]
+                        for i in range(num_columns)
+                    ]))
+                print_log('\n' + AsciiTable(table_data).table, logger=logger)
+
+            for metric_item in self.metric_items:
+                eval_results[f'{metric}_{metric_item}'] = float(
+                    f'{coco_eval.stats[COCO_METRIC_NAMES[metric_item]]:.4f}')
+            ap = coco_eval.stats[:6]
+            eval_results[f'{metric}_mAP_copypaste'] = (
+                f'{ap[0]:.4f} {ap[1]:.4f} {ap[2]:.4f} {ap[3]:.4f} '
+                f'{ap[4]:.4f} {ap[5]:.4f}')
+        return eval_results
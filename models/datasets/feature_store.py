@@ -0,0 +1,156 @@
+import os.path as osp
+
+import mmcv
+import numpy as np
+import torch
+from mmcv.parallel import DataContainer as DC
+from pycocotools import mask as mask_util
+from torch.utils.data import Dataset
+
+from mmdet.core import BitmapMasks
+from mmdet.datasets.builder import DATASETS
+
+FEATURES_FILE = 'features.bin'
+INDEX_FILE = 'index.pkl'
+
+
+class FeatureStoreWriter:
+    """Writes the neck outputs of training samples to a feature store.
+    The store is a directory with one flat fp16 file holding the features
+    of all samples back to back, which the dataset memory-maps, and an
+    index with their offsets, shapes, meta and annotations.
+    Args:
+        store (str): directory of the store
+        classes (tuple[str]): class names of the dataset
+        num_variants (int): augmentation variants of every image
+        checkpoint (str): weights the features were computed with
+        pad_size (tuple[int]): (h, w) every image was padded to, if any
+    """
+
+    def __init__(self,
+                 store,
+                 classes,
+                 num_variants,
+                 checkpoint=None,
+                 pad_size=None):
+        mmcv.mkdir_or_exist(store)
+        self.store = store
+        self.index = dict(
+            classes=tuple(classes),
+            num_variants=num_variants,
+            checkpoint=checkpoint,
+            pad_size=pad_size,
+            samples=[])
+        self.file = open(osp.join(store, FEATURES_FILE), 'wb')
+        self.offset = 0
+
+    def add(self, img_idx, feats, img_meta, gt_bboxes, gt_labels, gt_masks):
+        """Append a sample.
+        Args:
+            img_idx (int): index of the image in the source dataset
+            feats (list[Tensor]): neck outputs of shape (c, h, w)
+            img_meta (dict): meta of the sample
+            gt_bboxes (ndarray): shape (n, 4)
+            gt_labels (ndarray): shape (n)
+            gt_masks (BitmapMasks): the n GT masks
+        """
+        levels = []
+        for feat in feats:
+            feat = feat.detach().half().cpu().numpy()
+            self.file.write(feat.tobytes())
+            levels.append((self.offset, feat.shape))
+            self.offset += feat.size
+        self.index['samples'].append(
+            dict(
+                img_idx=img_idx,
+                levels=levels,
+                img_meta=img_meta,
+                gt_bboxes=gt_bboxes.astype(np.float32),
+                gt_labels=gt_labels.astype(np.int64),
+                gt_masks=mask_util.encode(
+                    np.asfortranarray(
+                        gt_masks.masks.transpose(1, 2, 0).astype(np.uint8))),
+                mask_size=(gt_masks.height, gt_masks.width)))
+
+    def close(self):
+        self.file.close()
+        mmcv.dump(self.index, osp.join(self.store, INDEX_FILE))
+        return self.offset * 2
+
+
+@DATASETS.register_module()
+class FeatureStoreDataset(Dataset):
+    """Training samples read from a feature store instead of images, to train
+    the heads of a single-stage segmenter with frozen backbone and neck.
+    Every image has num_variants augmented samples in the store, and one of
+    them is drawn each time the image is read.
+    Features of different shapes are zero-padded when batched, which is not
+    what the backbone gives for a batch of images padded to the same size:
+    the padded border has responses, and the coordinates of the heads span
+    the padded extent. Such stores are only exact with samples_per_gpu=1,
+    see `fixed_shape`.
+    Args:
+        store (str): directory written by `FeatureStoreWriter`, see
+            tools/cache_features.py
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.index = mmcv.load(osp.join(store, INDEX_FILE))
+        self.CLASSES = self.index['classes']
+        # samples of every image
+        self.img_samples = {}
+        for i, sample in enumerate(self.index['samples']):
+            self.img_samples.setdefault(sample['img_idx'], []).append(i)
+        self.img_samples = list(self.img_samples.values())
+        self._features = None
+        self._set_group_flag()
+
+    def __len__(self):
+        return len(self.img_samples)
+
+    def _set_group_flag(self):
+        """Aspect ratio groups, as in CustomDataset."""
+        self.flag = np.zeros(len(self), dtype=np.uint8)
+        for i, samples in enumerate(self.img_samples):
+            img_meta = self.index['samples'][samples[0]]['img_meta']
+            h, w = img_meta['img_shape'][:2]
+            if w / h > 1:
+                self.flag[i] = 1
+
+    @property
+    def fixed_shape(self):
+        """Whether all samples were padded to the same size when cached,
+        so that batches of them match batches of the images."""
+        return self.index.get('pad_size') is not None
+
+    @property
+    def features(self):
+        # opened lazily, in every dataloader worker
+        if self._features is None:
+            self._features = np.memmap(
+                osp.join(self.store, FEATURES_FILE), dtype=np.float16,
+                mode='r')
+        return self._features
+
+    def __getitem__(self, idx):
+        samples = self.img_samples[idx]
+        sample = self.index['samples'][samples[np.random.randint(
+            len(samples))]]
+        feats = []
+        for offset, shape in sample['levels']:
+            feat = self.features[offset:offset + int(np.prod(shape))]
+            feats.append(DC(
+                torch.from_numpy(feat.reshape(shape).astype(np.float32)),
+                stack=True))
+        if len(sample['gt_masks']) > 0:
+            gt_masks = mask_util.decode(sample['gt_masks']).transpose(2, 0, 1)
+        else:
+            gt_masks = np.zeros((0, ) + sample['mask_size'], dtype=np.uint8)
+        return dict(
+            img=feats,
+            img_metas=DC(sample['img_meta'], cpu_only=True),
+            gt_bboxes=DC(torch.from_numpy(sample['gt_bboxes'])),
+            gt_labels=DC(torch.from_numpy(sample['gt_labels'])),
+            gt_masks=DC(
+                BitmapMasks(gt_masks, *sample['mask_size']), cpu_only=True))
@@ -0,0 +1,239 @@
+import json
+from collections.abc import Sequence
+
+import mmcv
+import numpy as np
+from pycocotools import mask as mask_util
+
+from ..utils import crop2rle
+
+MAGIC = b'DETRES01'
+# columns start at multiples of this
+ALIGN = 64
+
+
+def _align(size):
+    return -(-size // ALIGN) * ALIGN
+
+
+def _encode_mask(segm):
+    """Compressed RLE counts and size of a mask result."""
+    if isinstance(segm, dict) and 'counts' in segm:
+        rle = segm
+    elif isinstance(segm, dict):
+        # a crop emitted with test_cfg.mask_format='crop'
+        rle = crop2rle(segm['mask'], segm['offset'], segm['size'])
+    else:
+        rle = mask_util.encode(
+            np.array(segm[:, :, np.newaxis], order='F', dtype='uint8'))[0]
+    counts = rle['counts']
+    if isinstance(counts, str):
+        counts = counts.encode()
+    return counts, rle['size']
+
+
+class ResultsWriter:
+    """Collects detection results image by image and writes them as a
+    results file.
+    The file holds the results of all images in columns: the labels, boxes
+    and scores of all detections back to back, their masks as compressed
+    RLE, and offsets of the detections of every image. See `ResultsFile`.
+    Args:
+        num_classes (int): classes of the results
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.with_masks = None
+        self.with_mask_scores = None
+        self.img_offsets = [0]
+        self.labels, self.bboxes, self.mask_scores = [], [], []
+        self.mask_sizes, self.rles = [], []
+
+    def add(self, result):
+        """Append the result of the next image.
+        Args:
+            result (list | tuple): bbox_results, a list of (n, 5) arrays per
+                class, or (bbox_results, segm_results), where segm_results
+                are lists of masks per class, or a (masks, mask scores)
+                tuple of them
+        """
+        if isinstance(result, tuple):
+            bbox_results, segm_results = result
+        elif isinstance(result, list):
+            bbox_results, segm_results = result, None
+        else:
+            raise TypeError('invalid type of results')
+        with_mask_scores = isinstance(segm_results, tuple)
+        if self.with_masks is None:
+            self.with_masks = segm_results is not None
+            self.with_mask_scores = with_mask_scores
+        assert self.with_masks == (segm_results is not None) and \
+            self.with_mask_scores == with_mask_scores, \
+            'all images must have the same type of results'
+        assert len(bbox_results) == self.num_classes
+        if with_mask_scores:
+            segm_results, mask_scores = segm_results
+
+        num_dets = 0
+        for label, bboxes in enumerate(bbox_results):
+            bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+            self.labels.append(np.full(len(bboxes), label, dtype=np.int32))
+            self.bboxes.append(bboxes)
+            num_dets += len(bboxes)
+            if not self.with_masks:
+                continue
+            assert len(segm_results[label]) == len(bboxes)
+            for segm in segm_results[label]:
+                counts, size = _encode_mask(segm)
+                self.rles.append(counts)
+                self.mask_sizes.append(size)
+            if with_mask_scores:
+                self.mask_scores.append(
+                    np.asarray(mask_scores[label], dtype=np.float32))
+        self.img_offsets.append(self.img_offsets[-1] + num_dets)
+
+    def columns(self):
+        """Arrays of the file, by column name."""
+        columns = dict(
+            img_offsets=np.array(self.img_offsets, dtype=np.int64),
+            labels=np.concatenate(self.labels + [np.zeros(0, np.int32)]),
+            bboxes=np.concatenate(self.bboxes +
+                                  [np.zeros((0, 5), np.float32)]))
+        if self.with_masks:
+            lengths = np.array([len(rle) for rle in self.rles], np.int64)
+            columns.update(
+                mask_offsets=np.concatenate([[0], np.cumsum(lengths)]),
+                mask_sizes=np.array(self.mask_sizes,
+                                    dtype=np.int32).reshape(-1, 2),
+                rles=np.frombuffer(b''.join(self.rles), dtype=np.uint8))
+        if self.with_mask_scores:
+            columns['mask_scores'] = np.concatenate(
+                self.mask_scores + [np.zeros(0, np.float32)])
+        return columns
+
+    def write(self, file):
+        """Write the results file, and return its size in bytes."""
+        columns = self.columns()
+        header = dict(
+            num_imgs=len(self.img_offsets) - 1,
+            num_classes=self.num_classes,
+            with_masks=bool(self.with_masks),
+            with_mask_scores=bool(self.with_mask_scores),
+            columns={})
+        # offsets from the end of the header, rounded up to ALIGN
+        offset = 0
+        for name, column in columns.items():
+            header['columns'][name] = dict(
+                dtype=column.dtype.str, shape=list(column.shape),
+                offset=offset)
+            offset += _align(column.nbytes)
+        header = json.dumps(header).encode()
+        start = _align(len(MAGIC) + 8 + len(header))
+        with open(file, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for column in columns.values():
+                f.write(b'\0' * (start - f.tell()))
+                f.write(column.tobytes())
+                start += _align(column.nbytes)
+            return f.tell()
+
+
+def dump_results(results, file):
+    """Write the results of a dataset as a results file.
+    Args:
+        results (list): results of every image, as returned by test.py
+        file (str): path of the file
+    Returns:
+        int: size of the file in bytes
+    """
+    assert len(results) > 0, 'no results to write'
+    first = results[0][0] if isinstance(results[0], tuple) else results[0]
+    writer = ResultsWriter(len(first))
+    for result in results:
+        writer.add(result)
+    return writer.write(file)
+
+
+def load_results(file):
+    """Results of a dataset written by test.py --out.
+    Args:
+        file (str): path of a results file, which ends with .res, or of a
+            pickle
+    Returns:
+        ResultsFile | list: the memory-mapped results of a results file, or
+            the list of the pickle
+    """
+    if file.endswith('.res'):
+        return ResultsFile(file)
+    return mmcv.load(file)
+
+
+class ResultsFile(Sequence):
+    """Detection results read from a results file, a sequence of the results
+    of every image like the list test.py returns.
+    The file is memory-mapped, so opening it is instant and the results of
+    an image are only read when indexed.
+    Args:
+        file (str): path of a file written by `dump_results`
+    """
+
+    def __init__(self, file):
+        self.file = file
+        data = np.memmap(file, dtype=np.uint8, mode='r')
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{file} is not a results file')
+        header_len = int(data[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+        header = json.loads(
+            bytes(data[len(MAGIC) + 8:len(MAGIC) + 8 + header_len]))
+        start = _align(len(MAGIC) + 8 + header_len)
+        self.num_classes = header['num_classes']
+        self.with_masks = header['with_masks']
+        self.with_mask_scores = header['with_mask_scores']
+        self.num_imgs = header['num_imgs']
+        self.columns = {}
+        for name, entry in header['columns'].items():
+            dtype = np.dtype(entry['dtype'])
+            offset = start + entry['offset']
+            count = int(np.prod(entry['shape']))
+            self.columns[name] = data[offset:offset + count *
+                                      dtype.itemsize].view(dtype).reshape(
+                                          entry['shape'])
+
+    def __len__(self):
+        return self.num_imgs
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        idx = range(len(self))[idx]
+        start, end = self.columns['img_offsets'][idx:idx + 2]
+        labels = self.columns['labels'][start:end]
+        # the detections of an image are sorted by class
+        bounds = start + np.searchsorted(labels, np.arange(
+            self.num_classes + 1))
+        bboxes = self.columns['bboxes']
+        bbox_results = [
+            np.array(bboxes[bounds[i]:bounds[i + 1]])
+            for i in range(self.num_classes)
+        ]
+        if not self.with_masks:
+            return bbox_results
+        mask_offsets = self.columns['mask_offsets']
+        mask_sizes = self.columns['mask_sizes']
+        rles = self.columns['rles']
+        segm_results = [[
+            dict(
+                size=mask_sizes[j].tolist(),
+                counts=bytes(rles[mask_offsets[j]:mask_offsets[j + 1]]))
+            for j in range(bounds[i], bounds[i + 1])
+        ] for i in range(self.num_classes)]
+        if self.with_mask_scores:
+            mask_scores = self.columns['mask_scores']
+            segm_results = (segm_results, [
+                np.array(mask_scores[bounds[i]:bounds[i + 1]])
+                for i in range(self.num_classes)
+            ])
+        return bbox_results, segm_results
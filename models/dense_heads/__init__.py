@@ -1,4 +1,5 @@
+from .decoupled_solo_head import DecoupledSOLOHead
 from .solo_head import SOLOHead
 
 
-__all__ = ['SOLOHead']
+__all__ = ['SOLOHead', 'DecoupledSOLOHead']
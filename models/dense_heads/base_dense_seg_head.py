@@ -1,6 +1,37 @@
 from abc import ABCMeta, abstractmethod
 
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from ..utils import crop_upsample_masks, dense_matrix_nms, matrix_nms
+
+
+def sort_per_img(scores, img_inds, max_num=None):
+    """Indices that sort candidates by image, then by descending score.
+    Args:
+        scores (Tensor): shape (n), scores in [0, 1]
+        img_inds (Tensor): shape (n), image of every candidate
+        max_num (int, optional): keep at most max_num candidates per image
+    Returns:
+        Tensor: the sorting indices
+    """
+    # scores are in [0, 1], so a step of 2 keeps the images apart
+    sort_inds = torch.argsort(img_inds.double() * 2 - scores.double())
+    if max_num is not None:
+        img_inds = img_inds[sort_inds]
+        ranks = img_rank(img_inds)
+        sort_inds = sort_inds[ranks < max_num]
+    return sort_inds
+
+
+def img_rank(img_inds):
+    """Position of every candidate among the candidates of its image.
+    The candidates of an image must be contiguous.
+    """
+    num_per_img = img_inds.bincount()
+    return torch.arange(len(img_inds), device=img_inds.device) - \
+        (num_per_img.cumsum(0) - num_per_img)[img_inds]
 
 
 class BaseDenseSegHead(nn.Module, metaclass=ABCMeta):
@@ -54,3 +85,237 @@ class BaseDenseSegHead(nn.Module, metaclass=ABCMeta):
             loss_inputs = outs + (gt_bboxes, gt_labels, gt_masks, img_metas)
         losses = self.loss(*loss_inputs, gt_bboxes_ignore=gt_bboxes_ignore)
         return losses
+
+    def select_candidates(self, cate_preds, cfg):
+        """Grid cells and categories whose score passes score_thr.
+        With cfg.max_candidates only the top max_candidates scores of every
+        image are thresholded, which bounds the mask work that follows
+        however low score_thr is.
+        Args:
+            cate_preds (Tensor): shape (n_imgs, sum(S^2), num_classes),
+                category scores of all levels
+            cfg (mmcv.Config): Test / postprocessing configuration
+        Returns:
+            tuple[Tensor]: img_inds, cell_inds, cate_labels, cate_scores
+                and strides of the candidates, image by image
+        """
+        max_candidates = cfg.get('max_candidates')
+        if max_candidates is None:
+            # process.
+            inds = (cate_preds > cfg.score_thr).nonzero(as_tuple=False)
+            img_inds, cell_inds, cate_labels = \
+                inds[:, 0], inds[:, 1], inds[:, 2]
+            # category scores.
+            cate_scores = cate_preds[img_inds, cell_inds, cate_labels]
+        else:
+            num_imgs, _, num_classes = cate_preds.shape
+            flatten_preds = cate_preds.reshape(num_imgs, -1)
+            cate_scores, inds = flatten_preds.topk(
+                min(max_candidates, flatten_preds.size(1)), dim=1)
+            img_inds = torch.arange(
+                num_imgs, device=inds.device)[:, None].expand_as(inds)
+            keep = cate_scores > cfg.score_thr
+            cate_scores, inds, img_inds = \
+                cate_scores[keep], inds[keep], img_inds[keep]
+            cell_inds = inds // num_classes
+            cate_labels = inds % num_classes
+
+        # strides.
+        strides = cate_preds.new_tensor(self.strides[:len(
+            self.seg_num_grids)]).repeat_interleave(cell_inds.new_tensor(
+                [num_grid**2 for num_grid in self.seg_num_grids]))
+        strides = strides[cell_inds]
+        return img_inds, cell_inds, cate_labels, cate_scores, strides
+
+    def seg_postprocess(self, seg_preds, cate_labels, cate_scores, strides,
+                        img_inds, featmap_size, img_metas, cfg):
+        """Filter, rescore and suppress the candidate masks of a batch.
+        Args:
+            seg_preds (Tensor): shape (n, h, w), soft masks of the
+                candidates at feature resolution
+            cate_labels (Tensor): shape (n), candidate labels
+            cate_scores (Tensor): shape (n), candidate category scores
+            strides (Tensor): shape (n), stride of the candidate levels
+            img_inds (Tensor): shape (n), image of every candidate, the
+                candidates of an image are contiguous
+            featmap_size (tuple): (h, w) of the mask features
+            img_metas (list[dict]): Meta information of each image
+            cfg (mmcv.Config): Test / postprocessing configuration
+        Returns:
+            list[tuple | None]: seg_masks, cate_labels and cate_scores of
+                every image, None if nothing is detected. With
+                cfg.mask_format 'crop' or 'rle' seg_masks are the masks
+                cropped to their boxes, and the boxes are appended.
+        """
+        mask_format = cfg.get('mask_format', 'full')
+        assert mask_format in ('full', 'crop', 'rle')
+        upsampled_size_out = (featmap_size[0] * 4, featmap_size[1] * 4)
+
+        # mask.
+        seg_masks = seg_preds > cfg.mask_thr
+        sum_masks = seg_masks.sum((1, 2)).float()
+
+        # filter.
+        keep = sum_masks > strides
+        seg_masks = seg_masks[keep, ...]
+        seg_preds = seg_preds[keep, ...]
+        sum_masks = sum_masks[keep]
+        cate_scores = cate_scores[keep]
+        cate_labels = cate_labels[keep]
+        img_inds = img_inds[keep]
+
+        # maskness.
+        seg_scores = (seg_preds * seg_masks.float()).sum((1, 2)) / sum_masks
+        cate_scores *= seg_scores
+
+        # sort and keep top nms_pre of every image
+        sort_inds = sort_per_img(cate_scores, img_inds, cfg.nms_pre)
+        seg_masks = seg_masks[sort_inds, :, :]
+        seg_preds = seg_preds[sort_inds, :, :]
+        sum_masks = sum_masks[sort_inds]
+        cate_scores = cate_scores[sort_inds]
+        cate_labels = cate_labels[sort_inds]
+        img_inds = img_inds[sort_inds]
+
+        # Matrix NMS
+        if len(cate_labels) > 0:
+            cate_scores = matrix_nms(seg_masks, cate_labels, cate_scores,
+                                     kernel=cfg.kernel, sigma=cfg.sigma,
+                                     sum_masks=sum_masks, img_inds=img_inds,
+                                     chunk_size=cfg.get('nms_chunk_size'),
+                                     half=cfg.get('nms_half', False),
+                                     box_prefilter=cfg.get(
+                                         'nms_box_prefilter', False))
+
+        # filter.
+        keep = cate_scores >= cfg.update_thr
+        seg_preds = seg_preds[keep, :, :]
+        cate_scores = cate_scores[keep]
+        cate_labels = cate_labels[keep]
+        img_inds = img_inds[keep]
+
+        # sort and keep top_k of every image
+        sort_inds = sort_per_img(cate_scores, img_inds, cfg.max_per_img)
+        seg_preds = seg_preds[sort_inds, :, :]
+        cate_scores = cate_scores[sort_inds]
+        cate_labels = cate_labels[sort_inds]
+        img_inds = img_inds[sort_inds]
+
+        if mask_format != 'full':
+            return self.crop_postprocess(seg_preds, cate_labels, cate_scores,
+                                         img_inds, img_metas, cfg)
+        if len(seg_preds) > 0:
+            seg_preds = F.interpolate(seg_preds.unsqueeze(0),
+                                      size=upsampled_size_out,
+                                      mode='bilinear').squeeze(0)
+        results = []
+        for img_id, img_meta in enumerate(img_metas):
+            keep = img_inds == img_id
+            if keep.sum() == 0:
+                results.append(None)
+                continue
+            h, w, _ = img_meta['img_shape']
+            ori_shape = img_meta['ori_shape']
+            seg_masks = F.interpolate(seg_preds[keep, :h, :w].unsqueeze(0),
+                                      size=ori_shape[:2],
+                                      mode='bilinear').squeeze(0)
+            seg_masks = seg_masks > cfg.mask_thr
+            results.append((seg_masks, cate_labels[keep], cate_scores[keep]))
+        return results
+
+    def crop_postprocess(self, seg_preds, cate_labels, cate_scores, img_inds,
+                         img_metas, cfg):
+        """Upsample the kept masks only inside their boxes.
+        Returns:
+            list[tuple | None]: crops, cate_labels, cate_scores and crop
+                boxes of every image, None if nothing is detected
+        """
+        results = []
+        for img_id, img_meta in enumerate(img_metas):
+            keep = img_inds == img_id
+            if keep.sum() == 0:
+                results.append(None)
+                continue
+            crops, boxes = crop_upsample_masks(
+                seg_preds[keep], img_meta['img_shape'],
+                img_meta['ori_shape'], cfg.mask_thr)
+            results.append(
+                (crops, cate_labels[keep], cate_scores[keep], boxes))
+        return results
+
+    def onnx_select_candidates(self, cate_preds, cfg):
+        """select_candidates of a single image with a fixed number of
+        candidates, for export. The top cfg.max_candidates (cfg.nms_pre if
+        unset) category scores are taken and those under score_thr are
+        zeroed instead of dropped.
+        Args:
+            cate_preds (Tensor): shape (sum(S^2), num_classes)
+            cfg (mmcv.Config): Test / postprocessing configuration
+        Returns:
+            tuple[Tensor]: cell_inds, cate_labels, cate_scores and strides
+        """
+        num_classes = cate_preds.size(1)
+        num_candidates = min(cfg.get('max_candidates') or cfg.nms_pre,
+                             cate_preds.numel())
+        cate_scores, inds = cate_preds.flatten().topk(num_candidates)
+        cate_scores = cate_scores * (cate_scores > cfg.score_thr).float()
+        cell_inds = inds // num_classes
+        cate_labels = inds % num_classes
+        strides = cate_preds.new_tensor([
+            stride for stride, num_grid in zip(self.strides,
+                                               self.seg_num_grids)
+            for _ in range(num_grid**2)
+        ])[cell_inds]
+        return cell_inds, cate_labels, cate_scores, strides
+
+    def onnx_postprocess(self, seg_preds, cate_labels, cate_scores, strides,
+                         cfg):
+        """seg_postprocess of a single image with fixed shapes, for export.
+        Filtered candidates get a zero score instead of being dropped, and
+        the masks are left at feature resolution.
+        Args:
+            seg_preds (Tensor): shape (n, h, w), soft masks of the
+                candidates at feature resolution
+            cate_labels (Tensor): shape (n), candidate labels
+            cate_scores (Tensor): shape (n), candidate category scores
+            strides (Tensor): shape (n), stride of the candidate levels
+            cfg (mmcv.Config): Test / postprocessing configuration
+        Returns:
+            tuple[Tensor]: cate_scores, cate_labels and soft seg_preds of
+                the top cfg.max_per_img masks, in descending score order,
+                kept masks have a score of at least cfg.update_thr and the
+                others a score of 0
+        """
+        # mask.
+        seg_masks = seg_preds > cfg.mask_thr
+        sum_masks = seg_masks.sum((1, 2)).float()
+
+        # filter.
+        cate_scores = cate_scores * (sum_masks > strides).float()
+
+        # maskness.
+        seg_scores = (seg_preds * seg_masks.float()).sum((1, 2)) / \
+            sum_masks.clamp(min=1)
+        cate_scores = cate_scores * seg_scores
+
+        # sort and keep top nms_pre
+        cate_scores, sort_inds = cate_scores.topk(
+            min(cfg.nms_pre, len(cate_scores)))
+        seg_masks = seg_masks[sort_inds, :, :]
+        seg_preds = seg_preds[sort_inds, :, :]
+        sum_masks = sum_masks[sort_inds]
+        cate_labels = cate_labels[sort_inds]
+
+        # Matrix NMS, the zeroed candidates come last and leave the
+        # others unchanged.
+        cate_scores = dense_matrix_nms(seg_masks, cate_labels, cate_scores,
+                                       kernel=cfg.kernel, sigma=cfg.sigma,
+                                       sum_masks=sum_masks)
+
+        # filter.
+        cate_scores = cate_scores * (cate_scores >= cfg.update_thr).float()
+
+        # sort and keep top_k
+        cate_scores, sort_inds = cate_scores.topk(
+            min(cfg.max_per_img, len(cate_scores)))
+        return cate_scores, cate_labels[sort_inds], seg_preds[sort_inds]
@@ -0,0 +1,297 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from mmcv.cnn import ConvModule, bias_init_with_prob, normal_init
+from mmdet.core import multi_apply
+from mmdet.models.builder import HEADS
+
+from .solo_head import SOLOHead, dice_loss, points_nms
+from ..utils import coord_conv, coord_grid, segm2result
+
+
+@HEADS.register_module()
+class DecoupledSOLOHead(SOLOHead):
+    """Decoupled SOLO, with S + S mask channels per level instead of S^2.
+    The mask of grid cell (i, j) is the product of the j-th mask of the X
+    branch and the i-th mask of the Y branch.
+    https://arxiv.org/abs/1912.04488
+    """
+
+    def _init_layers(self):
+        self.ins_convs_x = nn.ModuleList()
+        self.ins_convs_y = nn.ModuleList()
+        self.cate_convs = nn.ModuleList()
+        for i in range(self.stacked_convs):
+            chn = self.in_channels + 1 if i == 0 else self.seg_feat_channels
+            self.ins_convs_x.append(
+                ConvModule(
+                    chn,
+                    self.seg_feat_channels,
+                    3,
+                    stride=1,
+                    padding=1,
+                    norm_cfg=self.norm_cfg,
+                    bias=self.norm_cfg is None))
+            self.ins_convs_y.append(
+                ConvModule(
+                    chn,
+                    self.seg_feat_channels,
+                    3,
+                    stride=1,
+                    padding=1,
+                    norm_cfg=self.norm_cfg,
+                    bias=self.norm_cfg is None))
+
+            chn = self.in_channels if i == 0 else self.seg_feat_channels
+            self.cate_convs.append(
+                ConvModule(
+                    chn,
+                    self.seg_feat_channels,
+                    3,
+                    stride=1,
+                    padding=1,
+                    norm_cfg=self.norm_cfg,
+                    bias=self.norm_cfg is None))
+
+        self.dsolo_ins_list_x = nn.ModuleList()
+        self.dsolo_ins_list_y = nn.ModuleList()
+        for seg_num_grid in self.seg_num_grids:
+            self.dsolo_ins_list_x.append(
+                nn.Conv2d(
+                    self.seg_feat_channels, seg_num_grid, 3, padding=1))
+            self.dsolo_ins_list_y.append(
+                nn.Conv2d(
+                    self.seg_feat_channels, seg_num_grid, 3, padding=1))
+
+        self.solo_cate = nn.Conv2d(
+            self.seg_feat_channels, self.cate_out_channels, 3, padding=1)
+
+    def init_weights(self):
+        for m in self.ins_convs_x:
+            normal_init(m.conv, std=0.01)
+        for m in self.ins_convs_y:
+            normal_init(m.conv, std=0.01)
+        for m in self.cate_convs:
+            normal_init(m.conv, std=0.01)
+        bias_ins = bias_init_with_prob(0.01)
+        for m in self.dsolo_ins_list_x:
+            normal_init(m, std=0.01, bias=bias_ins)
+        for m in self.dsolo_ins_list_y:
+            normal_init(m, std=0.01, bias=bias_ins)
+        bias_cate = bias_init_with_prob(0.01)
+        normal_init(self.solo_cate, std=0.01, bias=bias_cate)
+
+    def forward(self, feats, eval=False):
+        new_feats = self.split_feats(feats)
+        featmap_sizes = [featmap.size()[-2:] for featmap in new_feats]
+        upsampled_size = (featmap_sizes[0][0] * 2, featmap_sizes[0][1] * 2)
+        ins_pred_x, ins_pred_y, cate_pred = multi_apply(
+            self.forward_single,
+            new_feats,
+            list(range(len(self.seg_num_grids))),
+            eval=eval,
+            upsampled_size=upsampled_size)
+        return ins_pred_x, ins_pred_y, cate_pred
+
+    def forward_single(self, x, idx, eval=False, upsampled_size=None):
+        ins_feat = x
+        cate_feat = x
+        # ins branch
+        ins_convs_x, ins_convs_y = self.ins_convs_x, self.ins_convs_y
+        if self.cached_coord and not self.training:
+            h, w = ins_feat.shape[-2:]
+            device = ins_feat.device
+            ins_feat_x = coord_conv(ins_convs_x[0], ins_feat,
+                                    lambda: coord_grid(h, w, device)[:, :1],
+                                    self._coord_cache, ('x', h, w))
+            ins_feat_y = coord_conv(ins_convs_y[0], ins_feat,
+                                    lambda: coord_grid(h, w, device)[:, 1:],
+                                    self._coord_cache, ('y', h, w))
+            ins_convs_x, ins_convs_y = ins_convs_x[1:], ins_convs_y[1:]
+        else:
+            # concat coord
+            x_range = torch.linspace(-1, 1, ins_feat.shape[-1],
+                                     device=ins_feat.device)
+            y_range = torch.linspace(-1, 1, ins_feat.shape[-2],
+                                     device=ins_feat.device)
+            y, x = torch.meshgrid(y_range, x_range)
+            y = y.expand([ins_feat.shape[0], 1, -1, -1])
+            x = x.expand([ins_feat.shape[0], 1, -1, -1])
+            ins_feat_x = torch.cat([ins_feat, x], 1)
+            ins_feat_y = torch.cat([ins_feat, y], 1)
+
+        for ins_layer_x, ins_layer_y in zip(ins_convs_x, ins_convs_y):
+            ins_feat_x = ins_layer_x(ins_feat_x)
+            ins_feat_y = ins_layer_y(ins_feat_y)
+
+        ins_feat_x = F.interpolate(
+            ins_feat_x, scale_factor=2, mode='bilinear',
+            recompute_scale_factor=True)
+        ins_feat_y = F.interpolate(
+            ins_feat_y, scale_factor=2, mode='bilinear',
+            recompute_scale_factor=True)
+        ins_pred_x = self.dsolo_ins_list_x[idx](ins_feat_x)
+        ins_pred_y = self.dsolo_ins_list_y[idx](ins_feat_y)
+
+        # cate branch
+        for i, cate_layer in enumerate(self.cate_convs):
+            if i == self.cate_down_pos:
+                seg_num_grid = self.seg_num_grids[idx]
+                cate_feat = F.interpolate(cate_feat, size=seg_num_grid,
+                                          mode='bilinear')
+            cate_feat = cate_layer(cate_feat)
+
+        cate_pred = self.solo_cate(cate_feat)
+        if eval:
+            ins_pred_x = F.interpolate(ins_pred_x.float().sigmoid(),
+                                       size=upsampled_size, mode='bilinear')
+            ins_pred_y = F.interpolate(ins_pred_y.float().sigmoid(),
+                                       size=upsampled_size, mode='bilinear')
+            cate_pred = points_nms(cate_pred.float().sigmoid(),
+                                   kernel=2).permute(0, 2, 3, 1)
+        return ins_pred_x, ins_pred_y, cate_pred
+
+    def loss(self,
+             ins_preds_x,
+             ins_preds_y,
+             cate_preds,
+             gt_bbox_list,
+             gt_label_list,
+             gt_mask_list,
+             img_metas,
+             gt_bboxes_ignore=None):
+        featmap_sizes = [featmap.size()[-2:] for featmap in
+                         ins_preds_x]
+        ins_label_list, cate_label_list, ins_ind_label_list, ins_index_list = \
+            multi_apply(
+                self.solo_target_single,
+                gt_bbox_list,
+                gt_label_list,
+                gt_mask_list,
+                featmap_sizes=featmap_sizes)
+
+        # ins
+        ins_labels = [torch.cat([ins_labels_level_img[index_level_img, ...]
+                                 for ins_labels_level_img, index_level_img in
+                                 zip(ins_labels_level, ins_index_level)], 0)
+                      for ins_labels_level, ins_index_level in
+                      zip(zip(*ins_label_list), zip(*ins_index_list))]
+
+        # the X branch predicts the column of a cell and the Y branch its row
+        ins_preds = []
+        for ins_preds_level_x, ins_preds_level_y, ins_ind_labels_level, \
+                num_grid in zip(ins_preds_x, ins_preds_y,
+                                zip(*ins_ind_label_list), self.seg_num_grids):
+            preds = []
+            for ins_pred_x, ins_pred_y, ind_img in zip(
+                    ins_preds_level_x, ins_preds_level_y,
+                    ins_ind_labels_level):
+                cells = ind_img.nonzero(as_tuple=False).flatten()
+                preds.append(
+                    torch.sigmoid(ins_pred_x[cells % num_grid]) *
+                    torch.sigmoid(ins_pred_y[cells // num_grid]))
+            ins_preds.append(torch.cat(preds, 0))
+
+        ins_ind_labels = [
+            torch.cat([ins_ind_labels_level_img.flatten()
+                       for ins_ind_labels_level_img in ins_ind_labels_level])
+            for ins_ind_labels_level in zip(*ins_ind_label_list)
+        ]
+        flatten_ins_ind_labels = torch.cat(ins_ind_labels)
+
+        num_ins = flatten_ins_ind_labels.sum()
+
+        # cate
+        cate_labels = [
+            torch.cat([cate_labels_level_img.flatten()
+                       for cate_labels_level_img in cate_labels_level])
+            for cate_labels_level in zip(*cate_label_list)
+        ]
+        flatten_cate_labels = torch.cat(cate_labels)
+        cate_preds = [
+            cate_pred.permute(0, 2, 3, 1).reshape(-1, self.cate_out_channels)
+            for cate_pred in cate_preds
+        ]
+        flatten_cate_preds = torch.cat(cate_preds)
+        loss_cls = self.loss_cls(flatten_cate_preds, flatten_cate_labels,
+                                 avg_factor=num_ins + 1)
+
+        # dice loss
+        loss_mask = []
+        for input, target in zip(ins_preds, ins_labels):
+            if input.size()[0] == 0:
+                continue
+            loss_mask.append(dice_loss(input, target))
+        loss_mask = torch.cat(loss_mask).mean()
+        loss_mask = loss_mask * self.ins_loss_weight
+        return dict(
+            loss_mask=loss_mask,
+            loss_cls=loss_cls)
+
+    def get_seg(self, seg_preds_x, seg_preds_y, cate_preds, img_metas, cfg,
+                rescale=None):
+        assert len(seg_preds_x) == len(cate_preds)
+        cfg = self.test_cfg if cfg is None else cfg
+        featmap_size = seg_preds_x[0].size()[-2:]
+        num_imgs = len(img_metas)
+
+        cate_preds = torch.cat([
+            cate_pred.reshape(num_imgs, -1, self.cate_out_channels).detach()
+            for cate_pred in cate_preds
+        ], dim=1)
+        img_inds, cell_inds, cate_labels, cate_scores, strides = \
+            self.select_candidates(cate_preds, cfg)
+
+        # masks, the product of the X and Y masks, level by level.
+        cand_seg_preds = seg_preds_x[0].new_empty(
+            (len(cell_inds), ) + tuple(featmap_size))
+        level_start = 0
+        for seg_pred_x, seg_pred_y, num_grid in zip(
+                seg_preds_x, seg_preds_y, self.seg_num_grids):
+            level_end = level_start + num_grid**2
+            level_inds = (cell_inds >= level_start) & (cell_inds < level_end)
+            cells = cell_inds[level_inds] - level_start
+            level_img_inds = img_inds[level_inds]
+            cand_seg_preds[level_inds] = \
+                seg_pred_x[level_img_inds, cells % num_grid].detach() * \
+                seg_pred_y[level_img_inds, cells // num_grid].detach()
+            level_start = level_end
+
+        results = self.seg_postprocess(cand_seg_preds, cate_labels,
+                                       cate_scores, strides, img_inds,
+                                       featmap_size, img_metas, cfg)
+        bbox_result_list = []
+        segm_result_list = []
+        mask_format = cfg.get('mask_format', 'full')
+        for result, img_meta in zip(results, img_metas):
+            bbox_result, segm_result = segm2result(
+                result, self.num_classes, mask_format, img_meta['ori_shape'])
+            bbox_result_list.append(bbox_result)
+            segm_result_list.append(segm_result)
+        return bbox_result_list, segm_result_list
+
+    def onnx_export(self, seg_preds_x, seg_preds_y, cate_preds, cfg):
+        """get_seg of a single image with fixed output shapes, see
+        `onnx_postprocess`.
+        """
+        cate_preds = torch.cat([
+            cate_pred.reshape(-1, self.cate_out_channels)
+            for cate_pred in cate_preds
+        ])
+        cell_inds, cate_labels, cate_scores, strides = \
+            self.onnx_select_candidates(cate_preds, cfg)
+
+        # the X and Y masks of every cell, over the concatenated levels
+        x_inds, y_inds = [], []
+        level_start = 0
+        for num_grid in self.seg_num_grids:
+            for i in range(num_grid):
+                x_inds += range(level_start, level_start + num_grid)
+                y_inds += [level_start + i] * num_grid
+            level_start += num_grid
+        x_inds = cell_inds.new_tensor(x_inds)[cell_inds]
+        y_inds = cell_inds.new_tensor(y_inds)[cell_inds]
+        seg_preds = torch.cat(seg_preds_x, 1)[0, x_inds] * \
+            torch.cat(seg_preds_y, 1)[0, y_inds]
+        return self.onnx_postprocess(seg_preds, cate_labels, cate_scores,
+                                     strides, cfg)
@@ -1,14 +1,14 @@
-from scipy import ndimage
-import mmcv
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from mmcv.cnn import ConvModule, bias_init_with_prob, normal_init
 from mmdet.core import multi_apply
+from mmdet.core.utils import mask2ndarray
 from mmdet.models.builder import HEADS, build_loss
 from .base_dense_seg_head import BaseDenseSegHead
 
-from ..utils import matrix_nms, segm2result
+from ..utils import (center_of_mass, center_region, center_region_owner,
+                     coord_conv, coord_grid, imrescale_masks, segm2result)
 
 INF = 1e8
 
@@ -50,6 +50,8 @@ class SOLOHead(BaseDenseSegHead):
                  sigma=0.2,
                  num_grids=None,
                  cate_down_pos=0,
+                 sparse_ins_label=False,
+                 cached_coord=False,
                  background_label=None,
                  loss_mask=None,
                  loss_cls=None,
@@ -67,6 +69,12 @@ class SOLOHead(BaseDenseSegHead):
         self.strides = strides
         self.sigma = sigma
         self.cate_down_pos = cate_down_pos
+        # keep one target mask per GT instead of one per grid cell
+        self.sparse_ins_label = sparse_ins_label
+        # at test time, add the cached conv of the coordinate channels
+        # instead of concatenating them
+        self.cached_coord = cached_coord
+        self._coord_cache = {}
         self.base_edge_list = base_edge_list
         self.scale_ranges = scale_ranges
         self.background_label = (
@@ -145,43 +153,59 @@ class SOLOHead(BaseDenseSegHead):
                 feats[2],
                 feats[3],
                 F.interpolate(feats[4], size=feats[3].shape[-2:],
-                              mode='bilinear', recompute_scale_factor=True))
+                              mode='bilinear'))
 
     def forward_single(self, x, idx, eval=False, upsampled_size=None):
         ins_feat = x
         cate_feat = x
         # ins branch
-        # concat coord
-        x_range = torch.linspace(-1, 1, ins_feat.shape[-1],
-                                 device=ins_feat.device)
-        y_range = torch.linspace(-1, 1, ins_feat.shape[-2],
-                                 device=ins_feat.device)
-        y, x = torch.meshgrid(y_range, x_range)
-        y = y.expand([ins_feat.shape[0], 1, -1, -1])
-        x = x.expand([ins_feat.shape[0], 1, -1, -1])
-        coord_feat = torch.cat([x, y], 1)
-        ins_feat = torch.cat([ins_feat, coord_feat], 1)
-
-        for i, ins_layer in enumerate(self.ins_convs):
+        ins_convs = self.ins_convs
+        if self.cached_coord and not self.training:
+            h, w = ins_feat.shape[-2:]
+            device = ins_feat.device
+            ins_feat = coord_conv(ins_convs[0], ins_feat,
+                                  lambda: coord_grid(h, w, device),
+                                  self._coord_cache, (h, w))
+            ins_convs = ins_convs[1:]
+        else:
+            # concat coord
+            x_range = torch.linspace(-1, 1, ins_feat.shape[-1],
+                                     device=ins_feat.device)
+            y_range = torch.linspace(-1, 1, ins_feat.shape[-2],
+                                     device=ins_feat.device)
+            y, x = torch.meshgrid(y_range, x_range)
+            y = y.expand([ins_feat.shape[0], 1, -1, -1])
+            x = x.expand([ins_feat.shape[0], 1, -1, -1])
+            coord_feat = torch.cat([x, y], 1)
+            ins_feat = torch.cat([ins_feat, coord_feat], 1)
+
+        for i, ins_layer in enumerate(ins_convs):
             ins_feat = ins_layer(ins_feat)
 
         ins_feat = F.interpolate(
             ins_feat, scale_factor=2, mode='bilinear', recompute_scale_factor=True)
-        ins_pred = self.solo_ins_list[idx](ins_feat)
+        # the masks of the selected cells are computed in get_seg
+        lazy_masks = eval and self.lazy_masks
+        if not lazy_masks:
+            ins_pred = self.solo_ins_list[idx](ins_feat)
 
         # cate branch
         for i, cate_layer in enumerate(self.cate_convs):
             if i == self.cate_down_pos:
                 seg_num_grid = self.seg_num_grids[idx]
                 cate_feat = F.interpolate(cate_feat, size=seg_num_grid,
-                                          mode='bilinear', recompute_scale_factor=True)
+                                          mode='bilinear')
             cate_feat = cate_layer(cate_feat)
 
         cate_pred = self.solo_cate(cate_feat)
+        if lazy_masks:
+            ins_pred = ins_feat
+        elif eval:
+            ins_pred = F.interpolate(ins_pred.float().sigmoid(),
+                                     size=upsampled_size,
+                                     mode='bilinear')
         if eval:
-            ins_pred = F.interpolate(ins_pred.sigmoid(), size=upsampled_size,
-                                     mode='bilinear', recompute_scale_factor=True)
-            cate_pred = points_nms(cate_pred.sigmoid(),
+            cate_pred = points_nms(cate_pred.float().sigmoid(),
                                    kernel=2).permute(0, 2, 3, 1)
         return ins_pred, cate_pred
 
@@ -195,19 +219,20 @@ class SOLOHead(BaseDenseSegHead):
              gt_bboxes_ignore=None):
         featmap_sizes = [featmap.size()[-2:] for featmap in
                          ins_preds]
-        ins_label_list, cate_label_list, ins_ind_label_list = multi_apply(
-            self.solo_target_single,
-            gt_bbox_list,
-            gt_label_list,
-            gt_mask_list,
-            featmap_sizes=featmap_sizes)
+        ins_label_list, cate_label_list, ins_ind_label_list, ins_index_list = \
+            multi_apply(
+                self.solo_target_single,
+                gt_bbox_list,
+                gt_label_list,
+                gt_mask_list,
+                featmap_sizes=featmap_sizes)
 
         # ins
-        ins_labels = [torch.cat([ins_labels_level_img[ind_level_img, ...]
-                                 for ins_labels_level_img, ind_level_img in
-                                 zip(ins_labels_level, ins_ind_labels_level)], 0)
-                      for ins_labels_level, ins_ind_labels_level in
-                      zip(zip(*ins_label_list), zip(*ins_ind_label_list))]
+        ins_labels = [torch.cat([ins_labels_level_img[index_level_img, ...]
+                                 for ins_labels_level_img, index_level_img in
+                                 zip(ins_labels_level, ins_index_level)], 0)
+                      for ins_labels_level, ins_index_level in
+                      zip(zip(*ins_label_list), zip(*ins_index_list))]
 
         ins_preds = [torch.cat([ins_preds_level_img[ind_level_img, ...]
                                 for ins_preds_level_img, ind_level_img in
@@ -258,20 +283,31 @@ class SOLOHead(BaseDenseSegHead):
                            gt_masks_raw,
                            featmap_sizes=None):
 
-        device = gt_labels_raw[0].device
+        device = gt_labels_raw.device
 
         # ins
         gt_areas = torch.sqrt((gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0]) *
                               (gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1]))
+        gt_masks_raw = torch.from_numpy(
+            mask2ndarray(gt_masks_raw)).to(device=device)
+        upsampled_size = (featmap_sizes[0][0] * 4, featmap_sizes[0][1] * 4)
+        # rescaled once per stride and shared by the levels, the output
+        # stride of a level is half its stride
+        seg_masks_raw = {
+            stride: imrescale_masks(gt_masks_raw, 1. / (stride / 2))
+            for stride in set(self.strides[:len(self.seg_num_grids)])}
 
         ins_label_list = []
         cate_label_list = []
         ins_ind_label_list = []
+        ins_index_list = []
         for (lower_bound, upper_bound), stride, featmap_size, num_grid \
             in zip(self.scale_ranges, self.strides,
                    featmap_sizes, self.seg_num_grids):
 
-            ins_label = torch.zeros([num_grid ** 2,
+            # dense: one plane per grid cell, sparse: one plane per GT
+            num_planes = 0 if self.sparse_ins_label else num_grid ** 2
+            ins_label = torch.zeros([num_planes,
                                      featmap_size[0], featmap_size[1]],
                                     dtype=torch.uint8, device=device)
             # FG cat_id: [0, num_classes -1], BG cat_id: num_classes
@@ -280,102 +316,158 @@ class SOLOHead(BaseDenseSegHead):
                                      device=device) + self.num_classes
             ins_ind_label = torch.zeros([num_grid ** 2],
                                         dtype=torch.bool, device=device)
+            # index into ins_label of every positive cell, in cell order
+            ins_index = torch.zeros([0], dtype=torch.int64, device=device)
 
             hit_indices = ((gt_areas >= lower_bound) &
                            (gt_areas <= upper_bound)).nonzero(as_tuple=False).flatten()
+            gt_masks = gt_masks_raw[hit_indices]
+            hit_indices = hit_indices[gt_masks.sum((1, 2)) >= 10]
             if len(hit_indices) == 0:
                 ins_label_list.append(ins_label)
                 cate_label_list.append(cate_label)
                 ins_ind_label_list.append(ins_ind_label)
+                ins_index_list.append(ins_index)
                 continue
             gt_bboxes = gt_bboxes_raw[hit_indices]
             gt_labels = gt_labels_raw[hit_indices]
-            gt_masks = gt_masks_raw[hit_indices.cpu().numpy(), ...]
+            gt_masks = gt_masks_raw[hit_indices]
+            seg_masks = seg_masks_raw[stride][hit_indices]
 
             half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * self.sigma
             half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * self.sigma
 
-            output_stride = stride / 2
-
-            for seg_mask, gt_label, half_h, half_w in \
-                    zip(gt_masks, gt_labels, half_hs, half_ws):
-                if seg_mask.sum() < 10:
-                    continue
-                # mass center
-                upsampled_size = (featmap_sizes[0][0] * 4,
-                                  featmap_sizes[0][1] * 4)
-                center_h, center_w = ndimage.measurements.center_of_mass(
-                    seg_mask)
-                coord_w = int((center_w / upsampled_size[1]
-                               ) // (1. / num_grid))
-                coord_h = int((center_h / upsampled_size[0]
-                               ) // (1. / num_grid))
-
-                # left, top, right, down
-                top_box = max(0,
-                              int(((center_h - half_h) /
-                                   upsampled_size[0]) // (1. / num_grid)))
-                down_box = min(num_grid - 1,
-                               int(((center_h + half_h) /
-                                    upsampled_size[0]) // (1. / num_grid)))
-                left_box = max(0,
-                               int(((center_w - half_w) /
-                                    upsampled_size[1]) // (1. / num_grid)))
-                right_box = min(num_grid - 1,
-                                int(((center_w + half_w) /
-                                     upsampled_size[1]) // (1. / num_grid)))
-
-                top = max(top_box, coord_h-1)
-                down = min(down_box, coord_h+1)
-                left = max(coord_w-1, left_box)
-                right = min(right_box, coord_w+1)
-
-                cate_label[top:(down+1), left:(right+1)] = gt_label
-                # ins
-                seg_mask = mmcv.imrescale(seg_mask, scale=1. / output_stride)
-                seg_mask = torch.Tensor(seg_mask)
-                for i in range(top, down+1):
-                    for j in range(left, right+1):
-                        label = int(i * num_grid + j)
-                        ins_label[label, :seg_mask.shape[0],
-                                  :seg_mask.shape[1]] = seg_mask
-                        ins_ind_label[label] = True
+            # mass center
+            center_hs, center_ws = center_of_mass(gt_masks)
+            top, down, left, right = center_region(
+                center_hs, center_ws, half_hs, half_ws,
+                upsampled_size, num_grid)
+            owner = center_region_owner(top, down, left, right, num_grid)
+
+            pos = owner >= 0
+            cate_label[pos] = gt_labels[owner[pos]]
+            # ins
+            pos = pos.flatten()
+            owner = owner.flatten()[pos]
+            if self.sparse_ins_label:
+                ins_label = ins_label.new_zeros(
+                    [len(seg_masks), featmap_size[0], featmap_size[1]])
+                ins_label[:, :seg_masks.shape[1],
+                          :seg_masks.shape[2]] = seg_masks
+                ins_index = owner
+            else:
+                ins_label[pos, :seg_masks.shape[1],
+                          :seg_masks.shape[2]] = seg_masks[owner]
+                ins_index = pos.nonzero(as_tuple=False).flatten()
+            ins_ind_label[pos] = True
             ins_label_list.append(ins_label)
             cate_label_list.append(cate_label)
             ins_ind_label_list.append(ins_ind_label)
-        return ins_label_list, cate_label_list, ins_ind_label_list
+            ins_index_list.append(ins_index)
+        return (ins_label_list, cate_label_list, ins_ind_label_list,
+                ins_index_list)
+
+    @property
+    def lazy_masks(self):
+        """Whether forward leaves the masks of the selected cells to
+        get_seg, set by test_cfg.lazy_masks of the head."""
+        return self.test_cfg is not None and \
+            self.test_cfg.get('lazy_masks', False)
 
     def get_seg(self, seg_preds, cate_preds, img_metas, cfg, rescale=None):
         assert len(seg_preds) == len(cate_preds)
-        num_levels = len(cate_preds)
+        cfg = self.test_cfg if cfg is None else cfg
         featmap_size = seg_preds[0].size()[-2:]
+        num_imgs = len(img_metas)
 
+        cate_preds = torch.cat([
+            cate_pred.reshape(num_imgs, -1, self.cate_out_channels).detach()
+            for cate_pred in cate_preds
+        ], dim=1)
+        img_inds, cell_inds, cate_labels, cate_scores, strides = \
+            self.select_candidates(cate_preds, cfg)
+
+        # masks, gathered level by level. forward decided from
+        # self.test_cfg whether seg_preds are masks or mask features
+        if self.lazy_masks:
+            cand_seg_preds = self.selected_masks(seg_preds, img_inds,
+                                                 cell_inds, featmap_size)
+        else:
+            cand_seg_preds = seg_preds[0].new_empty(
+                (len(cell_inds), ) + tuple(featmap_size))
+            level_start = 0
+            for seg_pred in seg_preds:
+                level_end = level_start + seg_pred.size(1)
+                level_inds = (cell_inds >= level_start) & \
+                    (cell_inds < level_end)
+                cand_seg_preds[level_inds] = seg_pred[
+                    img_inds[level_inds],
+                    cell_inds[level_inds] - level_start].detach()
+                level_start = level_end
+
+        results = self.seg_postprocess(cand_seg_preds, cate_labels,
+                                       cate_scores, strides, img_inds,
+                                       featmap_size, img_metas, cfg)
         bbox_result_list = []
         segm_result_list = []
-        for img_id in range(len(img_metas)):
-            cate_pred_list = [
-                cate_preds[i][img_id].view(
-                    -1, self.cate_out_channels).detach() for i in
-                range(num_levels)
-            ]
-            seg_pred_list = [
-                seg_preds[i][img_id].detach() for i in range(num_levels)
-            ]
-            img_shape = img_metas[img_id]['img_shape']
-            scale_factor = img_metas[img_id]['scale_factor']
-            ori_shape = img_metas[img_id]['ori_shape']
-
-            cate_pred_list = torch.cat(cate_pred_list, dim=0)
-            seg_pred_list = torch.cat(seg_pred_list, dim=0)
-
-            result = self.get_seg_single(cate_pred_list, seg_pred_list,
-                                         featmap_size, img_shape, ori_shape,
-                                         scale_factor, cfg, rescale)
-            bbox_result, segm_result = segm2result(result, self.num_classes)
+        mask_format = cfg.get('mask_format', 'full')
+        for result, img_meta in zip(results, img_metas):
+            bbox_result, segm_result = segm2result(
+                result, self.num_classes, mask_format, img_meta['ori_shape'])
             bbox_result_list.append(bbox_result)
             segm_result_list.append(segm_result)
         return bbox_result_list, segm_result_list
 
+    def onnx_export(self, seg_preds, cate_preds, cfg):
+        """get_seg of a single image with fixed output shapes, see
+        `onnx_postprocess`. Needs the masks of all cells, i.e. no
+        test_cfg.lazy_masks.
+        """
+        cate_preds = torch.cat([
+            cate_pred.reshape(-1, self.cate_out_channels)
+            for cate_pred in cate_preds
+        ])
+        cell_inds, cate_labels, cate_scores, strides = \
+            self.onnx_select_candidates(cate_preds, cfg)
+        seg_preds = torch.cat(seg_preds, 1)[0, cell_inds]
+        return self.onnx_postprocess(seg_preds, cate_labels, cate_scores,
+                                     strides, cfg)
+
+    def selected_masks(self, ins_feats, img_inds, cell_inds, upsampled_size):
+        """Soft masks of the selected grid cells.
+        Only the rows of the solo_ins_list convs that belong to the cells
+        are evaluated and upsampled, so the cost does not grow with S^2.
+        Args:
+            ins_feats (list[Tensor]): mask features of every level, as
+                forward returns them with test_cfg.lazy_masks
+            img_inds (Tensor): shape (n), image of every cell
+            cell_inds (Tensor): shape (n), cell index over all levels
+            upsampled_size (tuple): (h, w) of the masks
+        Returns:
+            Tensor: shape (n, h, w)
+        """
+        seg_preds = ins_feats[0].new_empty(
+            (len(cell_inds), ) + tuple(upsampled_size))
+        level_start = 0
+        for ins_feat, solo_ins, num_grid in zip(
+                ins_feats, self.solo_ins_list, self.seg_num_grids):
+            level_end = level_start + num_grid**2
+            for img_id in range(ins_feat.size(0)):
+                inds = ((img_inds == img_id) & (cell_inds >= level_start) &
+                        (cell_inds < level_end)).nonzero(as_tuple=False)
+                if len(inds) == 0:
+                    continue
+                inds = inds.flatten()
+                cells = cell_inds[inds] - level_start
+                ins_pred = F.conv2d(ins_feat[img_id:img_id + 1],
+                                    solo_ins.weight[cells],
+                                    solo_ins.bias[cells])
+                seg_preds[inds] = F.interpolate(
+                    ins_pred.sigmoid(), size=upsampled_size,
+                    mode='bilinear')[0].detach()
+            level_start = level_end
+        return seg_preds
+
     def get_seg_single(self,
                        cate_preds,
                        seg_preds,
@@ -387,88 +479,11 @@ class SOLOHead(BaseDenseSegHead):
                        rescale=False):
         cfg = self.test_cfg if cfg is None else cfg
         assert len(cate_preds) == len(seg_preds)
-
-        # overall info.
-        h, w, _ = img_shape
-        upsampled_size_out = (featmap_size[0] * 4, featmap_size[1] * 4)
-
-        # process.
-        inds = (cate_preds > cfg.score_thr)
-        # category scores.
-        cate_scores = cate_preds[inds]
-        if len(cate_scores) == 0:
-            return None
-        # category labels.
-        inds = inds.nonzero(as_tuple=False)
-        cate_labels = inds[:, 1]
-
-        # strides.
-        size_trans = cate_labels.new_tensor(
-            self.seg_num_grids).pow(2).cumsum(0)
-        strides = cate_scores.new_ones(size_trans[-1])
-        n_stage = len(self.seg_num_grids)
-        strides[:size_trans[0]] *= self.strides[0]
-        for ind_ in range(1, n_stage):
-            strides[size_trans[ind_ - 1]:size_trans[ind_]] *= \
-                self.strides[ind_]
-        strides = strides[inds[:, 0]]
-
-        # masks.
-        seg_preds = seg_preds[inds[:, 0]]
-        seg_masks = seg_preds > cfg.mask_thr
-        sum_masks = seg_masks.sum((1, 2)).float()
-
-        # filter.
-        keep = sum_masks > strides
-        if keep.sum() == 0:
-            return None
-
-        seg_masks = seg_masks[keep, ...]
-        seg_preds = seg_preds[keep, ...]
-        sum_masks = sum_masks[keep]
-        cate_scores = cate_scores[keep]
-        cate_labels = cate_labels[keep]
-
-        # maskness.
-        seg_scores = (seg_preds * seg_masks.float()).sum((1, 2)) / sum_masks
-        cate_scores *= seg_scores
-
-        # sort and keep top nms_pre
-        sort_inds = torch.argsort(cate_scores, descending=True)
-        if len(sort_inds) > cfg.nms_pre:
-            sort_inds = sort_inds[:cfg.nms_pre]
-        seg_masks = seg_masks[sort_inds, :, :]
-        seg_preds = seg_preds[sort_inds, :, :]
-        sum_masks = sum_masks[sort_inds]
-        cate_scores = cate_scores[sort_inds]
-        cate_labels = cate_labels[sort_inds]
-
-        # Matrix NMS
-        cate_scores = matrix_nms(seg_masks, cate_labels, cate_scores,
-                                 kernel=cfg.kernel, sigma=cfg.sigma,
-                                 sum_masks=sum_masks)
-
-        # filter.
-        keep = cate_scores >= cfg.update_thr
-        if keep.sum() == 0:
-            return None
-        seg_preds = seg_preds[keep, :, :]
-        cate_scores = cate_scores[keep]
-        cate_labels = cate_labels[keep]
-
-        # sort and keep top_k
-        sort_inds = torch.argsort(cate_scores, descending=True)
-        if len(sort_inds) > cfg.max_per_img:
-            sort_inds = sort_inds[:cfg.max_per_img]
-        seg_preds = seg_preds[sort_inds, :, :]
-        cate_scores = cate_scores[sort_inds]
-        cate_labels = cate_labels[sort_inds]
-
-        seg_preds = F.interpolate(seg_preds.unsqueeze(0),
-                                  size=upsampled_size_out,
-                                  mode='bilinear', recompute_scale_factor=True)[:, :, :h, :w]
-        seg_masks = F.interpolate(seg_preds,
-                                  size=ori_shape[:2],
-                                  mode='bilinear', recompute_scale_factor=True).squeeze(0)
-        seg_masks = seg_masks > cfg.mask_thr
-        return seg_masks, cate_labels, cate_scores
+        img_meta = dict(img_shape=img_shape, ori_shape=ori_shape,
+                        scale_factor=scale_factor)
+
+        img_inds, cell_inds, cate_labels, cate_scores, strides = \
+            self.select_candidates(cate_preds[None], cfg)
+        return self.seg_postprocess(seg_preds[cell_inds], cate_labels,
+                                    cate_scores, strides, img_inds,
+                                    featmap_size, [img_meta], cfg)[0]
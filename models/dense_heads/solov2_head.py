@@ -1,4 +1,3 @@
-import mmcv
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,9 +5,9 @@ from mmcv.cnn import normal_init, bias_init_with_prob, ConvModule
 from mmdet.core import multi_apply
 from mmdet.models.builder import HEADS, build_loss
 from mmdet.core.utils import mask2ndarray
-from .base_dense_seg_head import BaseDenseSegHead
+from .base_dense_seg_head import BaseDenseSegHead, img_rank
 
-from ..utils import matrix_nms, segm2result
+from ..utils import coord_conv, coord_grid, imrescale_masks, segm2result
 
 INF = 1e8
 
@@ -34,13 +33,55 @@ def points_nms(heat, kernel=2):
     return heat * keep
 
 
-def dice_loss(input, target):
+class IndexedRowDot(torch.autograd.Function):
+    """Dot products of the rows of input with the rows target[index].
+    The rows are taken chunk_size at a time, in the forward and in the
+    backward, so target[index] is never built in full and only target
+    itself is saved for the backward.
+    """
+
+    @staticmethod
+    def forward(ctx, input, target, index, chunk_size):
+        out = input.new_empty(len(index))
+        for start in range(0, len(index), chunk_size):
+            end = start + chunk_size
+            out[start:end] = torch.sum(
+                input[start:end] * target[index[start:end]], 1)
+        ctx.save_for_backward(target, index)
+        ctx.chunk_size = chunk_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        target, index = ctx.saved_tensors
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            grad_input = grad_out.new_empty(len(index), target.size(1))
+            for start in range(0, len(index), ctx.chunk_size):
+                end = start + ctx.chunk_size
+                torch.mul(grad_out[start:end, None],
+                          target[index[start:end]],
+                          out=grad_input[start:end])
+        return grad_input, None, None, None
+
+
+def dice_loss(input, target, index=None, chunk_size=64):
+    """Dice loss between predicted masks and binary targets.
+    If index is given, target holds one mask per instance and input[k] is
+    compared with target[index[k]], without copying the targets per input:
+    the intersections are computed chunk_size rows at a time and the
+    target sums once per instance.
+    """
     input = input.contiguous().view(input.size()[0], -1)
     target = target.contiguous().view(target.size()[0], -1).float()
 
-    a = torch.sum(input * target, 1)
+    if index is None:
+        a = torch.sum(input * target, 1)
+        c = torch.sum(target * target, 1) + 0.001
+    else:
+        a = IndexedRowDot.apply(input, target, index, chunk_size)
+        c = torch.sum(target * target, 1)[index] + 0.001
     b = torch.sum(input * input, 1) + 0.001
-    c = torch.sum(target * target, 1) + 0.001
     d = (2 * a) / (b + c)
     return 1-d
 
@@ -68,7 +109,8 @@ class SOLOv2Head(BaseDenseSegHead):
                  train_cfg=None,
                  test_cfg=None,
                  use_dcn_in_tower=False,
-                 type_dcn=None):
+                 type_dcn=None,
+                 cached_coord=False):
         super(SOLOv2Head, self).__init__()
         self.num_classes = num_classes
         self.seg_num_grids = num_grids
@@ -96,6 +138,10 @@ class SOLOv2Head(BaseDenseSegHead):
         self.test_cfg = test_cfg
         self.use_dcn_in_tower = use_dcn_in_tower
         self.type_dcn = type_dcn
+        # at test time, add the cached conv of the coordinate channels
+        # instead of concatenating them
+        self.cached_coord = cached_coord and not use_dcn_in_tower
+        self._coord_cache = {}
         self._init_layers()
 
     def _init_layers(self):  # kernel_convs = ins_convs
@@ -161,32 +207,46 @@ class SOLOv2Head(BaseDenseSegHead):
                 feats[1],
                 feats[2],
                 feats[3],
-                F.interpolate(feats[4], size=feats[3].shape[-2:], mode='bilinear', recompute_scale_factor=True))
+                F.interpolate(feats[4], size=feats[3].shape[-2:], mode='bilinear'))
 
     def forward_single(self, x, idx, eval=False, upsampled_size=None):
         ins_kernel_feat = x
-        # ins branch
-        # concat coord
-        x_range = torch.linspace(-1, 1,
-                                 ins_kernel_feat.shape[-1], device=ins_kernel_feat.device)
-        y_range = torch.linspace(-1, 1,
-                                 ins_kernel_feat.shape[-2], device=ins_kernel_feat.device)
-        y, x = torch.meshgrid(y_range, x_range)
-        y = y.expand([ins_kernel_feat.shape[0], 1, -1, -1])
-        x = x.expand([ins_kernel_feat.shape[0], 1, -1, -1])
-        coord_feat = torch.cat([x, y], 1)
-        ins_kernel_feat = torch.cat([ins_kernel_feat, coord_feat], 1)
-
-        # kernel branch
-        kernel_feat = ins_kernel_feat
         seg_num_grid = self.seg_num_grids[idx]
-        kernel_feat = F.interpolate(
-            kernel_feat, size=seg_num_grid, mode='bilinear', recompute_scale_factor=True)
-
-        cate_feat = kernel_feat[:, :-2, :, :]
+        kernel_convs = self.kernel_convs
+        if self.cached_coord and not self.training:
+            # the coordinates are resized to the grid with the features
+            h, w = ins_kernel_feat.shape[-2:]
+            device = ins_kernel_feat.device
+            cate_feat = F.interpolate(
+                ins_kernel_feat, size=seg_num_grid, mode='bilinear')
+            kernel_feat = coord_conv(
+                kernel_convs[0], cate_feat,
+                lambda: F.interpolate(coord_grid(h, w, device),
+                                      size=seg_num_grid, mode='bilinear'),
+                self._coord_cache, (h, w, seg_num_grid))
+            kernel_convs = kernel_convs[1:]
+        else:
+            # ins branch
+            # concat coord
+            x_range = torch.linspace(-1, 1,
+                                     ins_kernel_feat.shape[-1], device=ins_kernel_feat.device)
+            y_range = torch.linspace(-1, 1,
+                                     ins_kernel_feat.shape[-2], device=ins_kernel_feat.device)
+            y, x = torch.meshgrid(y_range, x_range)
+            y = y.expand([ins_kernel_feat.shape[0], 1, -1, -1])
+            x = x.expand([ins_kernel_feat.shape[0], 1, -1, -1])
+            coord_feat = torch.cat([x, y], 1)
+            ins_kernel_feat = torch.cat([ins_kernel_feat, coord_feat], 1)
+
+            # kernel branch
+            kernel_feat = ins_kernel_feat
+            kernel_feat = F.interpolate(
+                kernel_feat, size=seg_num_grid, mode='bilinear')
+
+            cate_feat = kernel_feat[:, :-2, :, :]
 
         kernel_feat = kernel_feat.contiguous()
-        for i, kernel_layer in enumerate(self.kernel_convs):
+        for i, kernel_layer in enumerate(kernel_convs):
             kernel_feat = kernel_layer(kernel_feat)
         kernel_pred = self.solo_kernel(kernel_feat)
 
@@ -197,7 +257,7 @@ class SOLOv2Head(BaseDenseSegHead):
         cate_pred = self.solo_cate(cate_feat)
 
         if eval:
-            cate_pred = points_nms(cate_pred.sigmoid(),
+            cate_pred = points_nms(cate_pred.float().sigmoid(),
                                    kernel=2).permute(0, 2, 3, 1)
         return cate_pred, kernel_pred
 
@@ -211,44 +271,46 @@ class SOLOv2Head(BaseDenseSegHead):
              img_metas,
              gt_bboxes_ignore=None):
         mask_feat_size = ins_pred.size()[-2:]
-        ins_label_list, cate_label_list, ins_ind_label_list, grid_order_list = multi_apply(
-            self.solov2_target_single,
-            gt_bbox_list,
-            gt_label_list,
-            gt_mask_list,
-            mask_feat_size=mask_feat_size)
+        ins_label_list, cate_label_list, ins_ind_label_list, grid_order_list, \
+            ins_index_list = multi_apply(
+                self.solov2_target_single,
+                gt_bbox_list,
+                gt_label_list,
+                gt_mask_list,
+                mask_feat_size=mask_feat_size)
 
         # ins
-        ins_labels = [torch.cat([ins_labels_level_img
-                                 for ins_labels_level_img in ins_labels_level], 0)
-                      for ins_labels_level in zip(*ins_label_list)]
-
-        kernel_preds = [[kernel_preds_level_img.view(kernel_preds_level_img.shape[0], -1)[:, grid_orders_level_img]
-                         for kernel_preds_level_img, grid_orders_level_img in
-                         zip(kernel_preds_level, grid_orders_level)]
-                        for kernel_preds_level, grid_orders_level in zip(kernel_preds, zip(*grid_order_list))]
-        # generate masks
-        ins_pred = ins_pred
-        ins_pred_list = []
-        for b_kernel_pred in kernel_preds:
-            b_mask_pred = []
-            for idx, kernel_pred in enumerate(b_kernel_pred):
+        # targets of all images and levels, image-major, with the target
+        # index, image and grid cell of every selected kernel
+        ins_labels = []
+        ins_indexes = []
+        img_inds = []
+        cell_inds = []
+        num_prev_ins = 0
+        for img_id, (ins_label_img, ins_index_img, grid_order_img) in \
+                enumerate(zip(ins_label_list, ins_index_list, grid_order_list)):
+            level_start = 0
+            for ins_label, ins_index, grid_order, num_grid in zip(
+                    ins_label_img, ins_index_img, grid_order_img,
+                    self.seg_num_grids):
+                ins_labels.append(ins_label)
+                ins_indexes.append(ins_index + num_prev_ins)
+                cell_inds.append(ins_index.new_tensor(grid_order) + level_start)
+                img_inds.append(torch.full_like(ins_index, img_id))
+                num_prev_ins += len(ins_label)
+                level_start += num_grid ** 2
+        ins_labels = torch.cat(ins_labels)
+        ins_indexes = torch.cat(ins_indexes)
+        cell_inds = torch.cat(cell_inds)
+        img_inds = torch.cat(img_inds)
 
-                if kernel_pred.size()[-1] == 0:
-                    continue
-                cur_ins_pred = ins_pred[idx, ...]
-                H, W = cur_ins_pred.shape[-2:]
-                N, I = kernel_pred.shape
-                cur_ins_pred = cur_ins_pred.unsqueeze(0)
-                kernel_pred = kernel_pred.permute(1, 0).view(I, -1, 1, 1)
-                cur_ins_pred = F.conv2d(
-                    cur_ins_pred, kernel_pred, stride=1).view(-1, H, W)
-                b_mask_pred.append(cur_ins_pred)
-            if len(b_mask_pred) == 0:
-                b_mask_pred = None
-            else:
-                b_mask_pred = torch.cat(b_mask_pred, 0)
-            ins_pred_list.append(b_mask_pred)
+        # generate masks
+        # kernels of all levels, [N, sum(S^2), E]
+        kernel_preds = torch.cat([kernel_pred.flatten(2)
+                                  for kernel_pred in kernel_preds], 2)
+        kernel_preds = kernel_preds.permute(0, 2, 1)
+        mask_preds = self.generate_masks(kernel_preds[img_inds, cell_inds],
+                                         ins_pred, img_inds)
 
         ins_ind_labels = [
             torch.cat([ins_ind_labels_level_img.flatten()
@@ -260,13 +322,11 @@ class SOLOv2Head(BaseDenseSegHead):
         num_ins = flatten_ins_ind_labels.sum()
 
         # dice loss
-        loss_ins = []
-        for input, target in zip(ins_pred_list, ins_labels):
-            if input is None:
-                continue
-            input = torch.sigmoid(input)
-            loss_ins.append(dice_loss(input, target))
-        loss_ins = torch.cat(loss_ins).mean()
+        if len(mask_preds) == 0:
+            loss_ins = ins_pred.sum() * 0
+        else:
+            mask_preds = torch.sigmoid(mask_preds)
+            loss_ins = dice_loss(mask_preds, ins_labels, ins_indexes).mean()
         loss_ins = loss_ins * self.ins_loss_weight
 
         # cate
@@ -295,16 +355,22 @@ class SOLOv2Head(BaseDenseSegHead):
                              gt_masks_raw,
                              mask_feat_size):
 
-        device = gt_labels_raw[0].device
+        device = gt_labels_raw.device
 
         # ins
         gt_areas = torch.sqrt((gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0]) * (
             gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1]))
+        # copied to the device and rescaled once, shared by the levels
+        output_stride = 4
+        gt_masks_raw = torch.from_numpy(
+            mask2ndarray(gt_masks_raw)).to(device=device)
+        seg_masks_raw = imrescale_masks(gt_masks_raw, 1. / output_stride)
 
         ins_label_list = []
         cate_label_list = []
         ins_ind_label_list = []
         grid_order_list = []
+        ins_index_list = []
         for (lower_bound, upper_bound), stride, num_grid \
                 in zip(self.scale_ranges, self.strides, self.seg_num_grids):
 
@@ -314,6 +380,8 @@ class SOLOv2Head(BaseDenseSegHead):
 
             ins_label = []
             grid_order = []
+            # index into ins_label of every entry in grid_order
+            ins_index = []
             cate_label = torch.zeros(
                 [num_grid, num_grid], dtype=torch.int64, device=device)
             ins_ind_label = torch.zeros(
@@ -326,22 +394,22 @@ class SOLOv2Head(BaseDenseSegHead):
                 cate_label_list.append(cate_label)
                 ins_ind_label_list.append(ins_ind_label)
                 grid_order_list.append([])
+                ins_index_list.append(torch.zeros(
+                    [0], dtype=torch.int64, device=device))
                 continue
             gt_bboxes = gt_bboxes_raw[hit_indices]
             gt_labels = gt_labels_raw[hit_indices]
-            gt_masks = gt_masks_raw[hit_indices.cpu().numpy(), ...]
+            gt_masks_pt = gt_masks_raw[hit_indices]
+            seg_masks = seg_masks_raw[hit_indices]
 
             half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * self.sigma
             half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * self.sigma
 
-            gt_masks = mask2ndarray(gt_masks)
             # mass center
-            gt_masks_pt = torch.from_numpy(gt_masks).to(device=device)
             center_ws, center_hs = center_of_mass(gt_masks_pt)
             valid_mask_flags = gt_masks_pt.sum(dim=-1).sum(dim=-1) > 0
 
-            output_stride = 4
-            for seg_mask, gt_label, half_h, half_w, center_h, center_w, valid_mask_flag in zip(gt_masks, gt_labels, half_hs, half_ws, center_hs, center_ws, valid_mask_flags):
+            for seg_mask, gt_label, half_h, half_w, center_h, center_w, valid_mask_flag in zip(seg_masks, gt_labels, half_hs, half_ws, center_hs, center_ws, valid_mask_flags):
                 if not valid_mask_flag:
                     continue
                 upsampled_size = (mask_feat_size[0] * 4, mask_feat_size[1] * 4)
@@ -366,19 +434,20 @@ class SOLOv2Head(BaseDenseSegHead):
                 right = min(right_box, coord_w+1)
 
                 cate_label[top:(down+1), left:(right+1)] = gt_label
-                seg_mask = mmcv.imrescale(seg_mask, scale=1. / output_stride)
-                seg_mask = torch.from_numpy(seg_mask).to(device=device)
+                if top > down or left > right:
+                    continue
+                # the target is stored once and shared by all its cells
+                cur_ins_label = torch.zeros([mask_feat_size[0], mask_feat_size[1]], dtype=torch.uint8,
+                                            device=device)
+                cur_ins_label[:seg_mask.shape[0],
+                              :seg_mask.shape[1]] = seg_mask
                 for i in range(top, down+1):
                     for j in range(left, right+1):
                         label = int(i * num_grid + j)
-
-                        cur_ins_label = torch.zeros([mask_feat_size[0], mask_feat_size[1]], dtype=torch.uint8,
-                                                    device=device)
-                        cur_ins_label[:seg_mask.shape[0],
-                                      :seg_mask.shape[1]] = seg_mask
-                        ins_label.append(cur_ins_label)
                         ins_ind_label[label] = True
                         grid_order.append(label)
+                        ins_index.append(len(ins_label))
+                ins_label.append(cur_ins_label)
             if len(ins_label) == 0:
                 ins_label = torch.zeros(
                     [0, mask_feat_size[0], mask_feat_size[1]], dtype=torch.uint8, device=device)
@@ -388,38 +457,88 @@ class SOLOv2Head(BaseDenseSegHead):
             cate_label_list.append(cate_label)
             ins_ind_label_list.append(ins_ind_label)
             grid_order_list.append(grid_order)
-        return ins_label_list, cate_label_list, ins_ind_label_list, grid_order_list
+            ins_index_list.append(torch.tensor(
+                ins_index, dtype=torch.int64, device=device))
+        return (ins_label_list, cate_label_list, ins_ind_label_list,
+                grid_order_list, ins_index_list)
+
+    def generate_masks(self, kernel_preds, ins_pred, img_inds):
+        """Masks of dynamic kernels, all images in one bmm.
+        Args:
+            kernel_preds (Tensor): shape (n, E), selected kernels
+            ins_pred (Tensor): shape (n_imgs, E, h, w), mask features
+            img_inds (Tensor): shape (n), image of every kernel, the kernels
+                of an image are contiguous
+        Returns:
+            Tensor: mask logits of shape (n, h, w)
+        """
+        num_imgs, num_channels, h, w = ins_pred.shape
+        if len(kernel_preds) == 0:
+            return ins_pred.new_zeros([0, h, w])
+        # scatter the kernels into a zero-padded [n_imgs, n_max, E] batch
+        ranks = img_rank(img_inds)
+        kernel_batch = kernel_preds.new_zeros(
+            [num_imgs, int(ranks.max()) + 1, num_channels])
+        kernel_batch[img_inds, ranks] = kernel_preds
+        mask_preds = torch.bmm(kernel_batch, ins_pred.flatten(2))
+        return mask_preds[img_inds, ranks].view(-1, h, w)
 
     def get_seg(self, cate_preds, kernel_preds, seg_pred, img_metas, cfg, rescale=None):
-        num_levels = len(cate_preds)
         featmap_size = seg_pred.size()[-2:]
+        num_imgs = len(img_metas)
 
+        cate_preds = torch.cat([
+            cate_pred.reshape(num_imgs, -1, self.cate_out_channels).detach()
+            for cate_pred in cate_preds
+        ], dim=1)
+        kernel_preds = torch.cat([
+            kernel_pred.permute(0, 2, 3, 1).reshape(
+                num_imgs, -1, self.kernel_out_channels).detach()
+            for kernel_pred in kernel_preds
+        ], dim=1)
+        img_inds, cell_inds, cate_labels, cate_scores, strides = \
+            self.select_candidates(cate_preds, cfg)
+
+        # mask encoding.
+        seg_preds = self.generate_masks(kernel_preds[img_inds, cell_inds],
+                                        seg_pred, img_inds).sigmoid()
+
+        results = self.seg_postprocess(seg_preds, cate_labels, cate_scores,
+                                       strides, img_inds, featmap_size,
+                                       img_metas, cfg)
         bbox_result_list = []
         segm_result_list = []
-        for img_id in range(len(img_metas)):
-            cate_pred_list = [
-                cate_preds[i][img_id].view(-1, self.cate_out_channels).detach() for i in range(num_levels)
-            ]
-            seg_pred_list = seg_pred[img_id, ...].unsqueeze(0)
-            kernel_pred_list = [
-                kernel_preds[i][img_id].permute(
-                    1, 2, 0).view(-1, self.kernel_out_channels).detach()
-                for i in range(num_levels)
-            ]
-            img_shape = img_metas[img_id]['img_shape']
-            scale_factor = img_metas[img_id]['scale_factor']
-            ori_shape = img_metas[img_id]['ori_shape']
-
-            cate_pred_list = torch.cat(cate_pred_list, dim=0)
-            kernel_pred_list = torch.cat(kernel_pred_list, dim=0)
-
-            result = self.get_seg_single(cate_pred_list, seg_pred_list, kernel_pred_list,
-                                         featmap_size, img_shape, ori_shape, scale_factor, cfg, rescale)
-            bbox_result, segm_result = segm2result(result, self.num_classes)
+        mask_format = cfg.get('mask_format', 'full')
+        for result, img_meta in zip(results, img_metas):
+            bbox_result, segm_result = segm2result(
+                result, self.num_classes, mask_format, img_meta['ori_shape'])
             bbox_result_list.append(bbox_result)
             segm_result_list.append(segm_result)
         return bbox_result_list, segm_result_list
 
+    def onnx_export(self, cate_preds, kernel_preds, seg_pred, cfg):
+        """get_seg of a single image with fixed output shapes, see
+        `onnx_postprocess`.
+        """
+        h, w = seg_pred.shape[-2:]
+        cate_preds = torch.cat([
+            cate_pred.reshape(-1, self.cate_out_channels)
+            for cate_pred in cate_preds
+        ])
+        kernel_preds = torch.cat([
+            kernel_pred.permute(0, 2, 3, 1).reshape(
+                -1, self.kernel_out_channels)
+            for kernel_pred in kernel_preds
+        ])
+        cell_inds, cate_labels, cate_scores, strides = \
+            self.onnx_select_candidates(cate_preds, cfg)
+
+        # mask encoding.
+        seg_preds = torch.mm(kernel_preds[cell_inds],
+                             seg_pred[0].flatten(1)).view(-1, h, w).sigmoid()
+        return self.onnx_postprocess(seg_preds, cate_labels, cate_scores,
+                                     strides, cfg)
+
     def get_seg_single(self,
                        cate_preds,
                        seg_preds,
@@ -432,92 +551,14 @@ class SOLOv2Head(BaseDenseSegHead):
                        rescale=False, debug=False):
 
         assert len(cate_preds) == len(kernel_preds)
+        img_meta = dict(img_shape=img_shape, ori_shape=ori_shape,
+                        scale_factor=scale_factor)
 
-        # overall info.
-        h, w, _ = img_shape
-        upsampled_size_out = (featmap_size[0] * 4, featmap_size[1] * 4)
-
-        # process.
-        inds = (cate_preds > cfg.score_thr)
-        cate_scores = cate_preds[inds]
-        if len(cate_scores) == 0:
-            return None
-
-        # cate_labels & kernel_preds
-        inds = inds.nonzero(as_tuple=False)
-        cate_labels = inds[:, 1]
-        kernel_preds = kernel_preds[inds[:, 0]]
-
-        # trans vector.
-        size_trans = cate_labels.new_tensor(
-            self.seg_num_grids).pow(2).cumsum(0)
-        strides = kernel_preds.new_ones(size_trans[-1])
-
-        n_stage = len(self.seg_num_grids)
-        strides[:size_trans[0]] *= self.strides[0]
-        for ind_ in range(1, n_stage):
-            strides[size_trans[ind_-1]:size_trans[ind_]] *= self.strides[ind_]
-        strides = strides[inds[:, 0]]
-
+        img_inds, cell_inds, cate_labels, cate_scores, strides = \
+            self.select_candidates(cate_preds[None], cfg)
         # mask encoding.
-        I, N = kernel_preds.shape
-        kernel_preds = kernel_preds.view(I, N, 1, 1)
-        seg_preds = F.conv2d(seg_preds, kernel_preds,
-                             stride=1).squeeze(0).sigmoid()
-        # mask.
-        seg_masks = seg_preds > cfg.mask_thr
-        sum_masks = seg_masks.sum((1, 2)).float()
-
-        # filter.
-        keep = sum_masks > strides
-        if keep.sum() == 0:
-            return None
-
-        seg_masks = seg_masks[keep, ...]
-        seg_preds = seg_preds[keep, ...]
-        sum_masks = sum_masks[keep]
-        cate_scores = cate_scores[keep]
-        cate_labels = cate_labels[keep]
-
-        # maskness.
-        seg_scores = (seg_preds * seg_masks.float()).sum((1, 2)) / sum_masks
-        cate_scores *= seg_scores
-
-        # sort and keep top nms_pre
-        sort_inds = torch.argsort(cate_scores, descending=True)
-        if len(sort_inds) > cfg.nms_pre:
-            sort_inds = sort_inds[:cfg.nms_pre]
-        seg_masks = seg_masks[sort_inds, :, :]
-        seg_preds = seg_preds[sort_inds, :, :]
-        sum_masks = sum_masks[sort_inds]
-        cate_scores = cate_scores[sort_inds]
-        cate_labels = cate_labels[sort_inds]
-
-        # Matrix NMS
-        cate_scores = matrix_nms(seg_masks, cate_labels, cate_scores,
-                                 kernel=cfg.kernel, sigma=cfg.sigma, sum_masks=sum_masks)
-
-        # filter.
-        keep = cate_scores >= cfg.update_thr
-        if keep.sum() == 0:
-            return None
-        seg_preds = seg_preds[keep, :, :]
-        cate_scores = cate_scores[keep]
-        cate_labels = cate_labels[keep]
-
-        # sort and keep top_k
-        sort_inds = torch.argsort(cate_scores, descending=True)
-        if len(sort_inds) > cfg.max_per_img:
-            sort_inds = sort_inds[:cfg.max_per_img]
-        seg_preds = seg_preds[sort_inds, :, :]
-        cate_scores = cate_scores[sort_inds]
-        cate_labels = cate_labels[sort_inds]
-
-        seg_preds = F.interpolate(seg_preds.unsqueeze(0),
-                                  size=upsampled_size_out,
-                                  mode='bilinear', recompute_scale_factor=True)[:, :, :h, :w]
-        seg_masks = F.interpolate(seg_preds,
-                                  size=ori_shape[:2],
-                                  mode='bilinear', recompute_scale_factor=True).squeeze(0)
-        seg_masks = seg_masks > cfg.mask_thr
-        return seg_masks, cate_labels, cate_scores
+        seg_preds = self.generate_masks(kernel_preds[cell_inds], seg_preds,
+                                        img_inds).sigmoid()
+        return self.seg_postprocess(seg_preds, cate_labels, cate_scores,
+                                    strides, img_inds, featmap_size,
+                                    [img_meta], cfg)[0]
@@ -1,8 +1,14 @@
+import warnings
+
+import torch
 import torch.nn as nn
+from mmcv.runner.fp16_utils import cast_tensor_type
 
 from mmdet.models.builder import DETECTORS, build_backbone, build_head, build_neck
 from mmdet.models.detectors import BaseDetector
 
+from ..utils import pad_to_bucket
+
 
 @DETECTORS.register_module()
 class SingleStageSegDetector(BaseDetector):
@@ -83,8 +89,10 @@ class SingleStageSegDetector(BaseDetector):
                       gt_masks=None):
         """
         Args:
-            img (Tensor): Input images of shape (N, C, H, W).
+            img (Tensor | list[Tensor]): Input images of shape (N, C, H, W).
                 Typically these should be mean centered and std scaled.
+                A list holds neck outputs read from a feature store, see
+                `FeatureStoreDataset`.
             img_metas (list[dict]): A List of image info dict where each dict
                 has: 'img_shape', 'scale_factor', 'flip', and may also contain
                 'filename', 'ori_shape', 'pad_shape', and 'img_norm_cfg'.
@@ -100,7 +108,10 @@ class SingleStageSegDetector(BaseDetector):
         Returns:
             dict[str, Tensor]: A dictionary of loss components.
         """
-        x = self.extract_feat(img)
+        if isinstance(img, (list, tuple)):
+            x = tuple(img)
+        else:
+            x = self.extract_feat(img)
         if self.with_mask_feat_head:
             mask_feat_pred = self.mask_feat_head(
                 x[self.mask_feat_head.
@@ -112,22 +123,98 @@ class SingleStageSegDetector(BaseDetector):
                                               gt_bboxes_ignore, gt_masks, mask_feat_pred)
         return losses
 
-    def simple_test(self, img, img_meta, rescale=False):
-        """Test function without test time augmentation.
-        """
+    def network_outputs(self, img):
+        """Outputs of the networks that get_seg post-processes."""
         x = self.extract_feat(img)
         outs = self.bbox_head(x, eval=True)
-
         if self.with_mask_feat_head:
             mask_feat_pred = self.mask_feat_head(
                 x[self.mask_feat_head.
                   start_level:self.mask_feat_head.end_level + 1])
-            seg_inputs = outs + (mask_feat_pred, img_meta,
-                                 self.test_cfg, rescale)
-        else:
-            seg_inputs = outs + (img_meta, self.test_cfg, rescale)
+            outs = outs + (mask_feat_pred, )
+        return outs
+
+    def bucket_network(self, img, autocast=None):
+        """network_outputs for the shape of a bucketed batch.
+        With test_cfg.bucket_compile 'trace' (default) or 'compile' every
+        input shape gets its own traced or compiled instance, built on
+        first use and kept.
+        """
+        mode = (self.test_cfg or {}).get('bucket_compile', 'trace')
+        assert mode in (None, 'trace', 'compile')
+        if mode is None:
+            return self.network_outputs
+        if not hasattr(self, '_bucket_networks'):
+            self._bucket_networks = {}
+        key = (tuple(img.shape), img.device, autocast, mode)
+        network = self._bucket_networks.get(key)
+        if network is None:
+            if mode == 'trace':
+                network = torch.jit.trace_module(
+                    self, {'network_outputs': img},
+                    check_trace=False,
+                    strict=False).network_outputs
+            else:
+                network = torch.compile(self.network_outputs, dynamic=False)
+            self._bucket_networks[key] = network
+        return network
+
+    def simple_test(self, img, img_meta, rescale=False):
+        """Test function without test time augmentation.
+        With test_cfg.autocast ('bfloat16' or 'float16') the networks run
+        under autocast and their outputs are cast back to fp32 before
+        post-processing. With test_cfg.channels_last the weights and the
+        images use the channels_last memory format. With test_cfg.buckets,
+        a list of (h, w), the images are padded to the smallest bucket that
+        holds them, so that the networks only see a few fixed shapes, see
+        `bucket_network`.
+        """
+        test_cfg = self.test_cfg or {}
+        autocast = test_cfg.get('autocast')
+        if test_cfg.get('channels_last', False):
+            if not getattr(self, '_channels_last', False):
+                self.to(memory_format=torch.channels_last)
+                self._channels_last = True
+            img = img.contiguous(memory_format=torch.channels_last)
+        bucket = None
+        if test_cfg.get('buckets'):
+            img, bucket = pad_to_bucket(img, test_cfg.buckets)
+            if bucket is None:
+                warnings.warn(f'no bucket holds an image of shape '
+                              f'{tuple(img.shape[-2:])}, running it eagerly')
+            else:
+                if test_cfg.get('channels_last', False):
+                    img = img.contiguous(memory_format=torch.channels_last)
+                img_meta = [
+                    dict(meta, pad_shape=bucket + tuple(meta['pad_shape'][2:]))
+                    for meta in img_meta
+                ]
+
+        with torch.autocast(img.device.type,
+                            dtype=getattr(torch, autocast or 'bfloat16'),
+                            enabled=autocast is not None):
+            if bucket is not None:
+                outs = self.bucket_network(img, autocast)(img)
+            else:
+                outs = self.network_outputs(img)
+        if autocast is not None:
+            outs = cast_tensor_type(outs, getattr(torch, autocast),
+                                    torch.float)
+
+        seg_inputs = tuple(outs) + (img_meta, self.test_cfg, rescale)
         bbox_results, segm_results = self.bbox_head.get_seg(*seg_inputs)
         return list(zip(bbox_results, segm_results))
 
+    def onnx_export(self, img):
+        """Test function of a single image with fixed output shapes, to
+        export the model with its post-processing.
+        Returns:
+            tuple[Tensor]: scores (k), labels (k) and soft masks (k, h, w)
+                at stride 4 of the padded image, see
+                `BaseDenseSegHead.onnx_postprocess`
+        """
+        outs = self.network_outputs(img)
+        return self.bbox_head.onnx_export(*outs, self.test_cfg)
+
     def aug_test(self, imgs, img_metas, rescale=False):
         raise NotImplementedError
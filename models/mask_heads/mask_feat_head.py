@@ -6,6 +6,8 @@ from mmcv.cnn import ConvModule
 
 import torch
 
+from ..utils import coord_conv, coord_grid
+
 
 @HEADS.register_module()
 class MaskFeatHead(nn.Module):
@@ -16,7 +18,8 @@ class MaskFeatHead(nn.Module):
                  end_level,
                  mask_feat_channels,
                  conv_cfg=None,
-                 norm_cfg=None):
+                 norm_cfg=None,
+                 cached_coord=False):
         super(MaskFeatHead, self).__init__()
 
         self.in_channels = in_channels
@@ -27,6 +30,10 @@ class MaskFeatHead(nn.Module):
         self.mask_feat_channels = mask_feat_channels
         self.conv_cfg = conv_cfg
         self.norm_cfg = norm_cfg
+        # at test time, add the cached conv of the coordinate channels
+        # instead of concatenating them
+        self.cached_coord = cached_coord
+        self._coord_cache = {}
 
         self.convs_all_levels = nn.ModuleList()
         for i in range(self.start_level, self.end_level + 1):
@@ -100,19 +107,31 @@ class MaskFeatHead(nn.Module):
         feature_add_all_level = self.convs_all_levels[0](inputs[0])
         for i in range(1, len(inputs)):
             input_p = inputs[i]
-            if i == 3:
-                input_feat = input_p
-                x_range = torch.linspace(-1, 1,
-                                         input_feat.shape[-1], device=input_feat.device)
-                y_range = torch.linspace(-1, 1,
-                                         input_feat.shape[-2], device=input_feat.device)
-                y, x = torch.meshgrid(y_range, x_range)
-                y = y.expand([input_feat.shape[0], 1, -1, -1])
-                x = x.expand([input_feat.shape[0], 1, -1, -1])
-                coord_feat = torch.cat([x, y], 1)
-                input_p = torch.cat([input_p, coord_feat], 1)
-
-            feature_add_all_level += self.convs_all_levels[i](input_p)
+            if i == 3 and self.cached_coord and not self.training:
+                convs_per_level = self.convs_all_levels[i]
+                h, w = input_p.shape[-2:]
+                device = input_p.device
+                input_p = coord_conv(convs_per_level[0], input_p,
+                                     lambda: coord_grid(h, w, device),
+                                     self._coord_cache, (h, w))
+                level_feat = convs_per_level[1:](input_p)
+            else:
+                if i == 3:
+                    input_feat = input_p
+                    x_range = torch.linspace(-1, 1,
+                                             input_feat.shape[-1], device=input_feat.device)
+                    y_range = torch.linspace(-1, 1,
+                                             input_feat.shape[-2], device=input_feat.device)
+                    y, x = torch.meshgrid(y_range, x_range)
+                    y = y.expand([input_feat.shape[0], 1, -1, -1])
+                    x = x.expand([input_feat.shape[0], 1, -1, -1])
+                    coord_feat = torch.cat([x, y], 1)
+                    input_p = torch.cat([input_p, coord_feat], 1)
+                level_feat = self.convs_all_levels[i](input_p)
+
+            # not in place, the first level ends with a ReLU whose output
+            # its backward needs
+            feature_add_all_level = feature_add_all_level + level_feat
 
         feature_pred = self.conv_pred(feature_add_all_level)
         return feature_pred
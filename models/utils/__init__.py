@@ -1,4 +1,12 @@
-from .nms import matrix_nms
+from .bucket import pad_to_bucket, select_bucket
+from .coord import coord_conv, coord_grid
+from .crop import crop2rle, crop_upsample_masks
+from .nms import dense_matrix_nms, matrix_nms
+from .target import (center_of_mass, center_region, center_region_owner,
+                     imrescale_masks)
 from .util import segm2result
 
-__all__ = ['matrix_nms', 'segm2result']
+__all__ = ['matrix_nms', 'segm2result', 'center_of_mass', 'center_region',
+           'center_region_owner', 'imrescale_masks', 'crop_upsample_masks',
+           'crop2rle', 'coord_conv', 'coord_grid', 'dense_matrix_nms',
+           'pad_to_bucket', 'select_bucket']
@@ -0,0 +1,36 @@
+import torch.nn.functional as F
+
+
+def select_bucket(shape, buckets):
+    """Smallest bucket that holds an image.
+    Args:
+        shape (tuple): (h, w) of the padded image
+        buckets (list[tuple]): (h, w) of the buckets
+    Returns:
+        tuple | None: (h, w) of the bucket, None if the image is larger
+            than all of them
+    """
+    h, w = shape
+    fits = [tuple(bucket) for bucket in buckets
+            if bucket[0] >= h and bucket[1] >= w]
+    if not fits:
+        return None
+    return min(fits, key=lambda bucket: (bucket[0] * bucket[1], bucket))
+
+
+def pad_to_bucket(img, buckets):
+    """Pad a batch on the bottom and the right to the smallest bucket that
+    holds it. Post-processing crops the masks to img_shape, so the padding
+    only changes the shapes the networks see.
+    Args:
+        img (Tensor): shape (n, c, h, w)
+        buckets (list[tuple]): (h, w) of the buckets
+    Returns:
+        tuple: the padded batch and the bucket, or the batch and None if
+            no bucket holds it
+    """
+    h, w = img.shape[-2:]
+    bucket = select_bucket((h, w), buckets)
+    if bucket is None or bucket == (h, w):
+        return img, bucket
+    return F.pad(img, (0, bucket[1] - w, 0, bucket[0] - h)), bucket
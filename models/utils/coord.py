@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def coord_grid(height, width, device=None):
+    """CoordConv channels of a feature map.
+    Returns:
+        Tensor: shape (1, 2, height, width), x then y, both in [-1, 1]
+    """
+    x_range = torch.linspace(-1, 1, width, device=device)
+    y_range = torch.linspace(-1, 1, height, device=device)
+    y, x = torch.meshgrid(y_range, x_range)
+    return torch.stack([x, y])[None]
+
+
+def coord_conv(layer, feat, make_coord, cache, key, max_entries=32):
+    """``layer(torch.cat([feat, coord], 1))`` without the concat.
+    The conv is linear in its input channels, so the coordinate channels
+    only add a fixed map, the conv of the coordinates with their rows of
+    the weight. The map is computed once per key, feature dtype, device
+    and weight version and kept in cache.
+    Args:
+        layer (ConvModule): layer with a plain nn.Conv2d and conv first
+        feat (Tensor): shape (n, c, h, w), the features
+        make_coord (callable): returns the (1, k, h', w') coordinate
+            channels, only called when the map is not cached
+        cache (dict): cache of the layer
+        key (tuple): identifies the coordinate channels, e.g. their shape
+        max_entries (int): the oldest map is dropped beyond this
+    Returns:
+        Tensor: output of the layer
+    """
+    conv = layer.conv
+    assert type(conv) is nn.Conv2d and layer.order[0] == 'conv'
+    num_feat = feat.size(1)
+    key = key + (feat.device, feat.dtype, conv.weight._version)
+    coord_map = cache.get(key)
+    if coord_map is None:
+        with torch.no_grad():
+            coord_map = F.conv2d(
+                make_coord().to(feat.dtype), conv.weight[:, num_feat:],
+                None, conv.stride, conv.padding, conv.dilation, conv.groups)
+        if len(cache) >= max_entries:
+            cache.pop(next(iter(cache)))
+        cache[key] = coord_map
+
+    for name in layer.order:
+        if name == 'conv':
+            x = F.conv2d(feat, conv.weight[:, :num_feat], conv.bias,
+                         conv.stride, conv.padding, conv.dilation,
+                         conv.groups) + coord_map
+        elif name == 'norm' and layer.with_norm:
+            x = layer.norm(x)
+        elif name == 'act' and layer.with_activation:
+            x = layer.activate(x)
+    return x
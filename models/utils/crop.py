@@ -0,0 +1,164 @@
+import numpy as np
+import torch
+from pycocotools import mask as mask_util
+
+
+def linear_taps(in_size, out_size, device=None):
+    """Source taps of bilinear resizing along one axis.
+    Follows F.interpolate(mode='bilinear', align_corners=False).
+    Args:
+        in_size (int): input length
+        out_size (int): output length
+    Returns:
+        tuple[Tensor]: i0, i1, source indices, and l0, l1, their weights,
+            each of shape (out_size)
+    """
+    scale = in_size / out_size
+    src = (torch.arange(out_size, dtype=torch.float32, device=device) +
+           0.5) * scale - 0.5
+    src = src.clamp(min=0)
+    i0 = src.long()
+    i1 = (i0 + 1).clamp(max=in_size - 1)
+    l1 = (src - i0).clamp(min=0, max=1)
+    l0 = 1 - l1
+    return i0, i1, l0, l1
+
+
+def _axis_taps(feat_size, upsampled_size, crop_size, ori_size, device):
+    """Taps of both resizing stages along one axis, and the feature range
+    every output pixel depends on."""
+    i0, i1, l0, l1 = linear_taps(feat_size, upsampled_size, device)
+    j0, j1, k0, k1 = linear_taps(crop_size, ori_size, device)
+    dep_lo = i0[j0]
+    dep_hi = i1[j1]
+    return (i0, i1, l0, l1), (j0, j1, k0, k1), dep_lo, dep_hi
+
+
+def crop_upsample_masks(seg_preds, img_shape, ori_shape, mask_thr):
+    """Binary masks in the original frame, evaluated only inside their
+    bounding boxes.
+    The result equals resizing the soft masks to 4x the feature size,
+    cropping to img_shape, resizing to ori_shape and thresholding, up to
+    float rounding of values at the threshold, but never allocates a full
+    frame.
+    Args:
+        seg_preds (Tensor): shape (n, h, w), soft masks at feature
+            resolution
+        img_shape (tuple): (h, w, c) of the resized image
+        ori_shape (tuple): (h, w, c) of the original image
+        mask_thr (float): mask threshold
+    Returns:
+        tuple: crops, a list of n bool tensors, and boxes, a long tensor
+            of shape (n, 4) with the (x1, y1, x2, y2) of every crop in the
+            original frame, x2 and y2 excluded
+    """
+    device = seg_preds.device
+    feat_h, feat_w = seg_preds.shape[-2:]
+    h, w = img_shape[:2]
+    ori_h, ori_w = ori_shape[:2]
+    row_s1, row_s2, row_lo, row_hi = _axis_taps(
+        feat_h, feat_h * 4, h, ori_h, device)
+    col_s1, col_s2, col_lo, col_hi = _axis_taps(
+        feat_w, feat_w * 4, w, ori_w, device)
+
+    # bounding boxes at feature resolution, with a margin for rounding
+    # in the interpolation
+    feat_masks = seg_preds > mask_thr * (1 - 1e-5)
+    rows = feat_masks.any(dim=2)
+    cols = feat_masks.any(dim=1)
+    feat_y1 = rows.float().argmax(dim=1)
+    feat_y2 = feat_h - 1 - rows.flip(1).float().argmax(dim=1)
+    feat_x1 = cols.float().argmax(dim=1)
+    feat_x2 = feat_w - 1 - cols.flip(1).float().argmax(dim=1)
+    # output pixels that depend on the boxes
+    out_y1 = torch.searchsorted(row_hi, feat_y1)
+    out_y2 = torch.searchsorted(row_lo, feat_y2, right=True)
+    out_x1 = torch.searchsorted(col_hi, feat_x1)
+    out_x2 = torch.searchsorted(col_lo, feat_x2, right=True)
+
+    crops = []
+    boxes = seg_preds.new_zeros((len(seg_preds), 4), dtype=torch.long)
+    for ind, (y1, y2, x1, x2) in enumerate(
+            zip(out_y1.tolist(), out_y2.tolist(), out_x1.tolist(),
+                out_x2.tolist())):
+        if y2 <= y1 or x2 <= x1:
+            # the mask only covers the padding
+            crops.append(seg_preds.new_zeros((0, 0), dtype=torch.bool))
+            continue
+        crop = _resize_crop(seg_preds[ind], row_s1, row_s2, y1, y2,
+                            col_s1, col_s2, x1, x2) > mask_thr
+        # shrink to the tight box of the mask
+        crop_rows = crop.any(dim=1).nonzero(as_tuple=False).flatten()
+        crop_cols = crop.any(dim=0).nonzero(as_tuple=False).flatten()
+        if len(crop_rows) == 0:
+            crops.append(crop[:0, :0])
+            continue
+        top, bottom = int(crop_rows[0]), int(crop_rows[-1]) + 1
+        left, right = int(crop_cols[0]), int(crop_cols[-1]) + 1
+        crops.append(crop[top:bottom, left:right])
+        boxes[ind] = boxes.new_tensor(
+            [x1 + left, y1 + top, x1 + right, y1 + bottom])
+    return crops, boxes
+
+
+def _resize_crop(seg_pred, row_s1, row_s2, y1, y2, col_s1, col_s2, x1, x2):
+    """Rows y1:y2 and cols x1:x2 of the two-stage bilinear resize of one
+    soft mask, width first then height in each stage like F.interpolate.
+    """
+    i0, i1, l0, l1 = row_s1
+    j0, j1, k0, k1 = row_s2
+    ci0, ci1, cl0, cl1 = col_s1
+    cj0, cj1, ck0, ck1 = col_s2
+    # stage 2 rows / cols and the stage 1 range they read
+    r0, r1, g0, g1 = j0[y1:y2], j1[y1:y2], k0[y1:y2], k1[y1:y2]
+    c0, c1, v0, v1 = cj0[x1:x2], cj1[x1:x2], ck0[x1:x2], ck1[x1:x2]
+    r_start, r_end = int(r0[0]), int(r1[-1]) + 1
+    c_start, c_end = int(c0[0]), int(c1[-1]) + 1
+    # stage 1 rows / cols and the feature range they read
+    s_i0, s_i1 = i0[r_start:r_end], i1[r_start:r_end]
+    s_l0, s_l1 = l0[r_start:r_end], l1[r_start:r_end]
+    s_j0, s_j1 = ci0[c_start:c_end], ci1[c_start:c_end]
+    s_k0, s_k1 = cl0[c_start:c_end], cl1[c_start:c_end]
+    f_y, f_x = int(s_i0[0]), int(s_j0[0])
+    feat = seg_pred[f_y:int(s_i1[-1]) + 1, f_x:int(s_j1[-1]) + 1]
+
+    # stage 1
+    stage1 = feat[:, s_j0 - f_x] * s_k0 + feat[:, s_j1 - f_x] * s_k1
+    stage1 = s_l0[:, None] * stage1[s_i0 - f_y] + \
+        s_l1[:, None] * stage1[s_i1 - f_y]
+    # stage 2
+    stage2 = stage1[:, c0 - c_start] * v0 + stage1[:, c1 - c_start] * v1
+    return g0[:, None] * stage2[r0 - r_start] + \
+        g1[:, None] * stage2[r1 - r_start]
+
+
+def crop2rle(crop, offset, size):
+    """COCO RLE of a cropped binary mask placed into a full frame.
+    Args:
+        crop (ndarray): shape (h, w), binary mask
+        offset (tuple): (x, y) of the crop in the frame
+        size (tuple): (height, width) of the frame
+    Returns:
+        dict: compressed RLE
+    """
+    height, width = size
+    x, y = offset
+    crop_h, crop_w = crop.shape
+    # pad every column with a background pixel above and below, so the
+    # runs never cross columns, and walk the crop in column-major order
+    padded = np.zeros((crop_h + 2, crop_w), dtype=np.uint8)
+    padded[1:-1] = crop
+    padded = padded.ravel(order='F')
+    changes = np.flatnonzero(padded[1:] != padded[:-1]) + 1
+    # positions of the changes in the frame
+    cols, rows = np.divmod(changes, crop_h + 2)
+    changes = (x + cols) * height + y + rows - 1
+    # runs touching the bottom and top of adjacent columns are one run
+    joints = np.flatnonzero(changes[1:] == changes[:-1])
+    changes = np.delete(changes, np.concatenate([joints, joints + 1]))
+    counts = np.diff(np.concatenate([[0], changes, [height * width]]))
+    if len(counts) > 1 and counts[-1] == 0:
+        counts = counts[:-1]
+    counts = counts.tolist()
+    return mask_util.frPyObjects(
+        dict(counts=counts, size=[height, width]), height, width)
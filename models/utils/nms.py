@@ -1,8 +1,15 @@
 import torch
 
+from .util import extract_bboxes
+
+# Tensor.scatter_reduce, which _sparse_matrix_nms needs, came in torch 1.12
+SCATTER_REDUCE = tuple(
+    int(v) for v in torch.__version__.split('.')[:2]) >= (1, 12)
+
 
 def matrix_nms(seg_masks, cate_labels, cate_scores,
-               kernel='gaussian', sigma=2.0, sum_masks=None):
+               kernel='gaussian', sigma=2.0, sum_masks=None, img_inds=None,
+               chunk_size=None, half=False, box_prefilter=False):
     """Matrix NMS for multi-class masks.
     Args:
         seg_masks (Tensor): shape (n, h, w)
@@ -11,6 +18,19 @@ def matrix_nms(seg_masks, cate_labels, cate_scores,
         kernel (str):  'linear' or 'gaussian'
         sigma (float): std in gaussian method
         sum_masks (Tensor): The sum of seg_masks
+        img_inds (Tensor): shape (n), image of every mask. Masks of
+            different images never suppress each other, the masks of an
+            image must be contiguous and in descending score order.
+        chunk_size (int, optional): pixels per block when counting the
+            intersections, which bounds the float copy of the masks to
+            n * chunk_size elements. All pixels at once if None.
+        half (bool): count in half precision on GPUs, with blocks of at
+            most 2048 pixels so that the counts stay exact. Masks on the
+            CPU, where torch may have no half bmm, are counted in float.
+        box_prefilter (bool): only count the intersections of mask pairs
+            that share a label and whose boxes overlap, see
+            `_sparse_matrix_nms`. Needs torch>=1.12, the dense path gives
+            the same scores before.
     Returns:
         Tensor: cate_scores_update, tensors of shape (n)
     """
@@ -19,23 +39,71 @@ def matrix_nms(seg_masks, cate_labels, cate_scores,
         return []
     if sum_masks is None:
         sum_masks = seg_masks.sum((1, 2)).float()
-    seg_masks = seg_masks.reshape(n_samples, -1).float()
-    # inter.
-    inter_matrix = torch.mm(seg_masks, seg_masks.transpose(1, 0))
-    # union.
-    sum_masks_x = sum_masks.expand(n_samples, n_samples)
+    if img_inds is None:
+        img_inds = cate_labels.new_zeros(n_samples)
+    if box_prefilter and SCATTER_REDUCE:
+        return _sparse_matrix_nms(seg_masks, cate_labels, cate_scores,
+                                  kernel, sigma, sum_masks, img_inds)
+
+    # pad the masks of every image to [n_imgs, n_max]
+    num_per_img = img_inds.bincount()
+    n_imgs, n_max = len(num_per_img), int(num_per_img.max())
+    ranks = torch.arange(n_samples, device=img_inds.device) - \
+        (num_per_img.cumsum(0) - num_per_img)[img_inds]
+    sum_masks_pad = sum_masks.new_zeros(n_imgs, n_max)
+    sum_masks_pad[img_inds, ranks] = sum_masks
+    cate_labels_pad = cate_labels.new_full((n_imgs, n_max), -1)
+    cate_labels_pad[img_inds, ranks] = cate_labels
+
+    # inter, counted block by block over the pixels. The counts are
+    # integers, so the sum of the blocks is exact.
+    seg_masks = seg_masks.reshape(n_samples, -1)
+    num_pixels = seg_masks.size(1)
+    dtype = torch.half if half and seg_masks.is_cuda else torch.float
+    chunk_size = num_pixels if chunk_size is None else chunk_size
+    if half:
+        chunk_size = min(chunk_size, 2048)
+    chunk_size = max(min(chunk_size, num_pixels), 1)
+    seg_masks_pad = seg_masks.new_zeros((n_imgs, n_max, chunk_size),
+                                        dtype=dtype)
+    # the masks of an image are contiguous, so every block is cast once,
+    # straight into the padded buffer
+    img_starts = (num_per_img.cumsum(0) - num_per_img).tolist()
+    inter_matrix = sum_masks.new_zeros((n_imgs, n_max, n_max))
+    for start in range(0, num_pixels, chunk_size):
+        chunk = seg_masks[:, start:start + chunk_size]
+        block = seg_masks_pad[:, :, :chunk.size(1)]
+        for img_id, (img_start, num) in enumerate(
+                zip(img_starts, num_per_img.tolist())):
+            block[img_id, :num] = chunk[img_start:img_start + num]
+        inter_matrix += torch.bmm(block, block.transpose(1, 2)).float()
+    # union, padded pairs have an empty union.
+    sum_masks_x = sum_masks_pad[:, None, :].expand(n_imgs, n_max, n_max)
+    union_matrix = (sum_masks_x + sum_masks_x.transpose(1, 2) -
+                    inter_matrix).clamp(min=1)
     # iou.
-    iou_matrix = (inter_matrix / (sum_masks_x +
-                                  sum_masks_x.transpose(1, 0) - inter_matrix)).triu(diagonal=1)
+    iou_matrix = (inter_matrix / union_matrix).triu(diagonal=1)
     # label_specific matrix.
-    cate_labels_x = cate_labels.expand(n_samples, n_samples)
-    label_matrix = (cate_labels_x == cate_labels_x.transpose(1, 0)
+    cate_labels_x = cate_labels_pad[:, None, :].expand(n_imgs, n_max, n_max)
+    label_matrix = (cate_labels_x == cate_labels_x.transpose(1, 2)
                     ).float().triu(diagonal=1)
 
+    decay_coefficient = _decay_coefficient(iou_matrix, label_matrix,
+                                           kernel, sigma)
+
+    # update the score.
+    cate_scores_update = cate_scores * decay_coefficient[img_inds, ranks]
+    return cate_scores_update
+
+
+def _decay_coefficient(iou_matrix, label_matrix, kernel, sigma):
+    """Score decay of every mask from its (n_imgs, n, n) IoU matrix."""
+    n_imgs, n_samples = iou_matrix.shape[:2]
+
     # IoU compensation
-    compensate_iou, _ = (iou_matrix * label_matrix).max(0)
-    compensate_iou = compensate_iou.expand(
-        n_samples, n_samples).transpose(1, 0)
+    compensate_iou, _ = (iou_matrix * label_matrix).max(1)
+    compensate_iou = compensate_iou[:, :, None].expand(
+        n_imgs, n_samples, n_samples)
 
     # IoU decay
     decay_iou = iou_matrix * label_matrix
@@ -44,14 +112,102 @@ def matrix_nms(seg_masks, cate_labels, cate_scores,
     if kernel == 'gaussian':
         decay_matrix = torch.exp(-1 * sigma * (decay_iou ** 2))
         compensate_matrix = torch.exp(-1 * sigma * (compensate_iou ** 2))
-        decay_coefficient, _ = (decay_matrix / compensate_matrix).min(0)
+        decay_coefficient, _ = (decay_matrix / compensate_matrix).min(1)
     elif kernel == 'linear':
         decay_matrix = (1-decay_iou)/(1-compensate_iou)
-        decay_coefficient, _ = decay_matrix.min(0)
+        decay_coefficient, _ = decay_matrix.min(1)
+    else:
+        raise NotImplementedError('{} kernel is not supported in matrix nms!'.
+                                  format(kernel))
+    return decay_coefficient
+
+
+def _sparse_matrix_nms(seg_masks, cate_labels, cate_scores, kernel, sigma,
+                       sum_masks, img_inds):
+    """Matrix NMS over the list of mask pairs that can overlap.
+    Pairs of different labels or with disjoint boxes have IoU 0 and their
+    decay is at least 1, while the top mask of every image always gives a
+    decay of exactly 1. So the decay of a mask is the minimum of 1 and the
+    decay of its overlapping pairs, and the scores equal the dense ones.
+    """
+    n_samples = len(cate_labels)
+    boxes = extract_bboxes(seg_masks)
+    # pairs (j, i) where j scores higher than i.
+    overlap = (boxes[:, None, 0] < boxes[None, :, 2]) & \
+        (boxes[None, :, 0] < boxes[:, None, 2]) & \
+        (boxes[:, None, 1] < boxes[None, :, 3]) & \
+        (boxes[None, :, 1] < boxes[:, None, 3])
+    pair_matrix = overlap & (cate_labels[:, None] == cate_labels[None, :]) & \
+        (img_inds[:, None] == img_inds[None, :])
+    high_inds, low_inds = pair_matrix.triu(diagonal=1).nonzero(
+        as_tuple=True)
+
+    # inter, at most n_samples pairs at a time.
+    seg_masks = seg_masks.reshape(n_samples, -1)
+    inter = sum_masks.new_zeros(len(high_inds))
+    for start in range(0, len(high_inds), n_samples):
+        end = start + n_samples
+        inter[start:end] = (seg_masks[high_inds[start:end]] &
+                            seg_masks[low_inds[start:end]]).sum(1).float()
+    # union.
+    union = (sum_masks[low_inds] + sum_masks[high_inds] - inter).clamp(min=1)
+    # iou.
+    decay_iou = inter / union
+
+    # IoU compensation
+    compensate_iou = sum_masks.new_zeros(n_samples).scatter_reduce(
+        0, low_inds, decay_iou, 'amax')
+    compensate_iou = compensate_iou[high_inds]
+
+    # matrix nms
+    if kernel == 'gaussian':
+        decay_pairs = torch.exp(-1 * sigma * (decay_iou ** 2))
+        compensate_pairs = torch.exp(-1 * sigma * (compensate_iou ** 2))
+        decay_pairs = decay_pairs / compensate_pairs
+    elif kernel == 'linear':
+        decay_pairs = (1 - decay_iou) / (1 - compensate_iou)
     else:
         raise NotImplementedError('{} kernel is not supported in matrix nms!'.
                                   format(kernel))
+    decay_coefficient = sum_masks.new_ones(n_samples).scatter_reduce(
+        0, low_inds, decay_pairs, 'amin')
 
     # update the score.
     cate_scores_update = cate_scores * decay_coefficient
     return cate_scores_update
+
+
+def dense_matrix_nms(seg_masks, cate_labels, cate_scores, kernel='gaussian',
+                     sigma=2.0, sum_masks=None):
+    """Matrix NMS of a single image without data-dependent shapes or
+    control flow, so that it can be traced and exported.
+    Args:
+        seg_masks (Tensor): shape (n, h, w), binary masks
+        cate_labels (Tensor): shape (n), mask labels in descending order
+        cate_scores (Tensor): shape (n), mask scores in descending order
+        kernel (str):  'linear' or 'gaussian'
+        sigma (float): std in gaussian method
+        sum_masks (Tensor): The sum of seg_masks
+    Returns:
+        Tensor: cate_scores_update, tensors of shape (n)
+    """
+    n_samples = seg_masks.size(0)
+    seg_masks = seg_masks.reshape(n_samples, -1).float()
+    if sum_masks is None:
+        sum_masks = seg_masks.sum(1)
+    # inter.
+    inter_matrix = torch.mm(seg_masks, seg_masks.t())
+    # union.
+    sum_masks_x = sum_masks[None, :].expand(n_samples, n_samples)
+    union_matrix = (sum_masks_x + sum_masks_x.t() - inter_matrix).clamp(min=1)
+    # iou, triu(diagonal=1) as a product for the export to opset 11.
+    ranks = torch.arange(n_samples, device=seg_masks.device)
+    upper = (ranks[:, None] < ranks[None, :]).float()
+    iou_matrix = inter_matrix / union_matrix * upper
+    # label_specific matrix.
+    cate_labels_x = cate_labels[None, :].expand(n_samples, n_samples)
+    label_matrix = (cate_labels_x == cate_labels_x.t()).float() * upper
+
+    decay_coefficient = _decay_coefficient(iou_matrix[None],
+                                           label_matrix[None], kernel, sigma)
+    return cate_scores * decay_coefficient[0]
@@ -0,0 +1,109 @@
+import torch
+import torch.nn.functional as F
+
+
+def center_of_mass(masks):
+    """Mass centers of binary masks.
+    The moments are accumulated in int64 and divided in float64, so the
+    centers are identical to ``scipy.ndimage.center_of_mass``.
+    Args:
+        masks (Tensor): shape (n, h, w), binary masks
+    Returns:
+        tuple[Tensor]: center_hs, center_ws, float64 tensors of shape (n)
+    """
+    h, w = masks.shape[-2:]
+    ys = torch.arange(h, dtype=torch.int64, device=masks.device)
+    xs = torch.arange(w, dtype=torch.int64, device=masks.device)
+    rows = masks.sum(dim=-1, dtype=torch.int64)
+    cols = masks.sum(dim=-2, dtype=torch.int64)
+    m00 = rows.sum(dim=-1).clamp(min=1).double()
+    center_hs = (rows * ys).sum(dim=-1).double() / m00
+    center_ws = (cols * xs).sum(dim=-1).double() / m00
+    return center_hs, center_ws
+
+
+def center_region(center_hs, center_ws, half_hs, half_ws,
+                  upsampled_size, num_grid):
+    """Grid cells covered by the center regions of instances.
+    The center cell is computed in the dtype of the centers and the box
+    bounds in the dtype of the half sizes, following the scalar code the
+    heads used before.
+    Args:
+        center_hs (Tensor): shape (n), mass center rows
+        center_ws (Tensor): shape (n), mass center cols
+        half_hs (Tensor): shape (n), half heights of the center regions
+        half_ws (Tensor): shape (n), half widths of the center regions
+        upsampled_size (tuple): (h, w) of the padded image
+        num_grid (int): S of the level
+    Returns:
+        tuple[Tensor]: top, down, left, right, inclusive cell bounds of
+            shape (n)
+    """
+    grid_size = 1. / num_grid
+    coord_h = (center_hs / upsampled_size[0] // grid_size).long()
+    coord_w = (center_ws / upsampled_size[1] // grid_size).long()
+
+    center_hs = center_hs.to(half_hs.dtype)
+    center_ws = center_ws.to(half_ws.dtype)
+    top_box = ((center_hs - half_hs) / upsampled_size[0]
+               // grid_size).long().clamp(min=0)
+    down_box = ((center_hs + half_hs) / upsampled_size[0]
+                // grid_size).long().clamp(max=num_grid - 1)
+    left_box = ((center_ws - half_ws) / upsampled_size[1]
+                // grid_size).long().clamp(min=0)
+    right_box = ((center_ws + half_ws) / upsampled_size[1]
+                 // grid_size).long().clamp(max=num_grid - 1)
+
+    top = torch.max(top_box, coord_h - 1)
+    down = torch.min(down_box, coord_h + 1)
+    left = torch.max(left_box, coord_w - 1)
+    right = torch.min(right_box, coord_w + 1)
+    return top, down, left, right
+
+
+def center_region_owner(top, down, left, right, num_grid):
+    """Assign every grid cell to the instance whose center region covers it.
+    When regions overlap the instance with the larger index wins, which is
+    what writing the regions one after another in a loop gives.
+    Args:
+        top, down, left, right (Tensor): shape (n), from `center_region`
+        num_grid (int): S of the level
+    Returns:
+        Tensor: shape (S, S), index of the owning instance, -1 if none
+    """
+    cells = torch.arange(num_grid, device=top.device)
+    in_rows = (cells >= top[:, None]) & (cells <= down[:, None])
+    in_cols = (cells >= left[:, None]) & (cells <= right[:, None])
+    in_region = in_rows[:, :, None] & in_cols[:, None, :]
+    order = torch.arange(1, len(top) + 1, device=top.device)
+    owner = (in_region.long() * order[:, None, None]).max(dim=0)[0]
+    return owner - 1
+
+
+def imrescale_masks(masks, scale):
+    """Rescale binary masks by a ratio with bilinear interpolation.
+    For masks padded to a multiple of 1 / scale the output is identical
+    to calling ``mmcv.imrescale`` on every mask.
+    Args:
+        masks (Tensor): shape (n, h, w), binary masks
+        scale (float): scaling ratio
+    Returns:
+        Tensor: uint8 masks of shape (n, h * scale, w * scale)
+    """
+    h, w = masks.shape[-2:]
+    new_size = (int(h * scale + 0.5), int(w * scale + 0.5))
+    if masks.size(0) == 0:
+        return masks.new_zeros((0, ) + new_size, dtype=torch.uint8)
+    step = int(round(1. / scale))
+    if step * scale == 1 and step % 2 == 0 and h % step == 0 \
+            and w % step == 0:
+        # every output pixel sits halfway between two input rows and two
+        # input cols, so it is set iff at least 2 of the 4 taps are
+        r = step // 2
+        masks = masks.to(torch.uint8)
+        taps = masks[:, r - 1::step] + masks[:, r::step]
+        taps = taps[..., r - 1::step] + taps[..., r::step]
+        return (taps >= 2).to(torch.uint8)
+    masks = F.interpolate(masks[None].float(), size=new_size,
+                          mode='bilinear', align_corners=False)[0]
+    return (masks >= 0.5).to(torch.uint8)
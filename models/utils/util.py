@@ -1,24 +1,36 @@
 import numpy as np
+import torch
 
+from .crop import crop2rle
 
-def segm2result(result, num_classes):
+
+def segm2result(result, num_classes, mask_format='full', ori_shape=None):
+    """Convert the post-processed masks of an image to mmdet results.
+    mask_format is 'full' for masks of the whole image, 'crop' for dicts
+    holding the mask cropped to its box, its (x, y) offset and the image
+    size, and 'rle' for COCO RLE. The last two need ori_shape.
+    """
     if result is None:
         bbox_result = [np.zeros((0, 5), dtype=np.float32) for _ in
                        range(num_classes)]
         # BG is not included in num_classes
         segm_result = [[] for _ in range(num_classes)]
     else:
+        if mask_format != 'full':
+            return crop2result(result, num_classes, mask_format, ori_shape)
         bbox_result = [np.zeros((0, 5), dtype=np.float32) for _ in
                        range(num_classes)]
         segm_result = [[] for _ in range(num_classes)]
+        # extract bboxes from segmentation result, before the masks
+        # leave the device
+        mask_bboxes = extract_bboxes(result[0].detach()).cpu().numpy()
         seg_pred = result[0].detach().cpu().numpy()
         cate_label = result[1].detach().cpu().numpy()
         cate_score = result[2].detach().cpu().numpy()
         num_ins = seg_pred.shape[0]
-        # extract bboxes from segmentation result
         bboxes = np.zeros((num_ins, 5), dtype=np.float32)
         bboxes[:, -1] = cate_score
-        bboxes[:, :-1] = extract_bboxes(seg_pred)
+        bboxes[:, :-1] = mask_bboxes
 
         bbox_result = [bboxes[cate_label == i, :] for i in
                        range(num_classes)]
@@ -28,27 +40,59 @@ def segm2result(result, num_classes):
     return bbox_result, segm_result
 
 
+def crop2result(result, num_classes, mask_format, ori_shape):
+    crops, cate_label, cate_score, boxes = result
+    cate_label = cate_label.detach().cpu().numpy()
+    cate_score = cate_score.detach().cpu().numpy()
+    boxes = boxes.detach().cpu().numpy()
+    num_ins = len(crops)
+    # the crops are tight, so their boxes are the mask boxes
+    bboxes = np.zeros((num_ins, 5), dtype=np.float32)
+    bboxes[:, -1] = cate_score
+    bboxes[:, :-1] = boxes
+    bbox_result = [bboxes[cate_label == i, :] for i in range(num_classes)]
+
+    segm_result = [[] for _ in range(num_classes)]
+    size = tuple(ori_shape[:2])
+    for idx in range(num_ins):
+        crop = crops[idx].detach().cpu().numpy()
+        offset = (int(boxes[idx, 0]), int(boxes[idx, 1]))
+        if mask_format == 'crop':
+            segm = dict(mask=crop, offset=offset, size=size)
+        else:
+            segm = crop2rle(crop, offset, size)
+        segm_result[cate_label[idx]].append(segm)
+    return bbox_result, segm_result
+
+
 def extract_bboxes(mask):
     """Compute bounding boxes from masks.
-    mask: [num_instances, height, width]. Mask pixels are either 1 or 0.
-    Returns: bbox array [num_instances, (x1, y1, x2, y2)].
+    mask: [num_instances, height, width] tensor or ndarray. Mask pixels are
+    either 1 or 0.
+    Returns: bbox [num_instances, (x1, y1, x2, y2)], float32, of the same
+    type and on the same device as mask.
     """
-    num_ins = mask.shape[0]
-    boxes = np.zeros([num_ins, 4], dtype=np.float32)
-    for i in range(num_ins):
-        m = mask[i, :, :]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([x1, y1, x2, y2])
+    is_ndarray = isinstance(mask, np.ndarray)
+    height, width = mask.shape[-2:]
+    # row and column projections, reduced by numpy on the host, where it
+    # is faster than torch, and by torch on the GPU
+    if is_ndarray or not mask.is_cuda:
+        mask = mask if is_ndarray else mask.numpy()
+        rows = torch.from_numpy(np.any(mask, axis=2).view(np.uint8))
+        cols = torch.from_numpy(np.any(mask, axis=1).view(np.uint8))
+    else:
+        mask = mask.to(torch.uint8)
+        rows = mask.amax(dim=2)
+        cols = mask.amax(dim=1)
+    # the first nonzero entry from each side
+    y1 = rows.argmax(dim=1)
+    y2 = height - rows.flip(1).argmax(dim=1)
+    x1 = cols.argmax(dim=1)
+    x2 = width - cols.flip(1).argmax(dim=1)
+    boxes = torch.stack([x1, y1, x2, y2], dim=1).float()
+    # No mask for this instance. Might happen due to resizing or cropping.
+    # Set bbox to zeros
+    boxes[rows.amax(dim=1) == 0] = 0
+    if is_ndarray:
+        boxes = boxes.numpy()
     return boxes
@@ -1,32 +1,61 @@
 import argparse
+import multiprocessing
 import os
+import os.path as osp
+import queue
+import time
 import warnings
 
 import mmcv
+import numpy as np
 import torch
-from mmcv import Config, DictAction
+from mmcv import Config, ConfigDict, DictAction
 from mmcv.cnn import fuse_conv_bn
-from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
+from mmcv.image import tensor2imgs
+from mmcv.parallel import MMDataParallel, MMDistributedDataParallel, scatter
 from mmcv.runner import (get_dist_info, init_dist, load_checkpoint,
                          wrap_fp16_model)
+from pycocotools import mask as mask_util
+from torch.utils.data import Subset
 
-from mmdet.apis import multi_gpu_test, single_gpu_test
+from mmdet.apis.test import collect_results_cpu, collect_results_gpu
 from mmdet.datasets import (build_dataloader, build_dataset,
                             replace_ImageToTensor)
 from mmdet.models import build_detector
 
+from models.datasets import (FastCocoDataset, ResultsFile, StreamingCocoEval,
+                             dump_results, fast_coco_eval, load_results)
+from models.utils import crop2rle
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description='MMDet test (and eval) a model')
     parser.add_argument('config', help='test config file path')
-    parser.add_argument('checkpoint', help='checkpoint file')
-    parser.add_argument('--out', help='output result file in pickle format')
+    parser.add_argument(
+        'checkpoint', nargs='?', help='checkpoint file, unused with --results')
+    parser.add_argument(
+        '--results',
+        help='evaluate or format the results of an earlier --out, a pickle '
+        'or .res file, instead of testing the model')
+    parser.add_argument(
+        '--out',
+        help='output result file in pickle format, or as a columnar results '
+        'file if it ends with .res')
     parser.add_argument(
         '--fuse-conv-bn',
         action='store_true',
         help='Whether to fuse conv and bn, this will slightly increase'
         'the inference speed')
+    parser.add_argument(
+        '--autocast',
+        choices=['bfloat16', 'float16'],
+        help='run the networks of single-stage segmenters under autocast '
+        'with this dtype, post-processing stays in fp32')
+    parser.add_argument(
+        '--channels-last',
+        action='store_true',
+        help='run single-stage segmenters in the channels_last memory format')
     parser.add_argument(
         '--format-only',
         action='store_true',
@@ -78,11 +107,35 @@ def parse_args():
         action=DictAction,
         help='custom options for evaluation, the key-value pair in xxx=yyy '
         'format will be kwargs for dataset.evaluate() function')
+    parser.add_argument(
+        '--eval-nproc',
+        type=int,
+        default=None,
+        help='evaluate COCO metrics with FastCOCOeval in this many '
+        'processes, 0 for the calling process, pycocotools if not given')
+    parser.add_argument(
+        '--stream-eval',
+        action='store_true',
+        help='match every image against the GTs as soon as it is detected, '
+        'keeping only the match statistics instead of the results, for '
+        'COCO style datasets')
     parser.add_argument(
         '--launcher',
-        choices=['none', 'pytorch', 'slurm', 'mpi'],
+        choices=['none', 'pytorch', 'slurm', 'mpi', 'cpu'],
         default='none',
-        help='job launcher')
+        help='job launcher, cpu shards the dataset across --cpu-workers '
+        'processes on this machine')
+    parser.add_argument(
+        '--cpu-workers',
+        type=int,
+        default=4,
+        help='processes of the cpu launcher, each with its own model')
+    parser.add_argument(
+        '--cpu-threads',
+        type=int,
+        default=None,
+        help='intra-op threads of every cpu worker, cpu count / workers if '
+        'not given')
     parser.add_argument('--local_rank', type=int, default=0)
     args = parser.parse_args()
     if 'LOCAL_RANK' not in os.environ:
@@ -98,6 +151,243 @@ def parse_args():
     return args
 
 
+def encode_mask_results(mask_results):
+    """RLE-encode the masks of an image.
+    Masks the head already emitted as RLE (test_cfg.mask_format='rle') are
+    kept, and cropped masks are encoded without pasting them into a frame.
+    """
+    encoded_mask_results = [[] for _ in range(len(mask_results))]
+    for cls_segms, encoded in zip(mask_results, encoded_mask_results):
+        for segm in cls_segms:
+            if isinstance(segm, dict) and 'counts' in segm:
+                encoded.append(segm)
+            elif isinstance(segm, dict):
+                encoded.append(
+                    crop2rle(segm['mask'], segm['offset'], segm['size']))
+            else:
+                encoded.append(
+                    mask_util.encode(
+                        np.array(
+                            segm[:, :, np.newaxis], order='F',
+                            dtype='uint8'))[0])
+    return encoded_mask_results
+
+
+def decode_mask_results(mask_results):
+    """Dense masks of an image, for drawing."""
+    return [[mask_util.decode(segm).astype(bool) for segm in cls_segms]
+            for cls_segms in encode_mask_results(mask_results)]
+
+
+def single_gpu_test(model,
+                    data_loader,
+                    show=False,
+                    out_dir=None,
+                    show_score_thr=0.3,
+                    evaluator=None,
+                    collect=True):
+    """Test with a single gpu.
+    Args:
+        evaluator (StreamingCocoEval): processes every result as soon as it
+            is detected
+        collect (bool): return the results, else an empty list
+    """
+    model.eval()
+    results = []
+    dataset = data_loader.dataset
+    prog_bar = mmcv.ProgressBar(len(dataset))
+    num_done = 0
+    for i, data in enumerate(data_loader):
+        with torch.no_grad():
+            result = model(return_loss=False, rescale=True, **data)
+
+        batch_size = len(result)
+        if show or out_dir:
+            if batch_size == 1 and isinstance(data['img'][0], torch.Tensor):
+                img_tensor = data['img'][0]
+            else:
+                img_tensor = data['img'][0].data[0]
+            img_metas = data['img_metas'][0].data[0]
+            imgs = tensor2imgs(img_tensor, **img_metas[0]['img_norm_cfg'])
+            assert len(imgs) == len(img_metas)
+
+            for j, (img, img_meta) in enumerate(zip(imgs, img_metas)):
+                h, w, _ = img_meta['img_shape']
+                img_show = img[:h, :w, :]
+
+                ori_h, ori_w = img_meta['ori_shape'][:-1]
+                img_show = mmcv.imresize(img_show, (ori_w, ori_h))
+
+                if out_dir:
+                    out_file = osp.join(out_dir, img_meta['ori_filename'])
+                else:
+                    out_file = None
+
+                bbox_result, segm_result = result[j]
+                model.module.show_result(
+                    img_show, (bbox_result, decode_mask_results(segm_result)),
+                    show=show,
+                    out_file=out_file,
+                    score_thr=show_score_thr)
+
+        # encode mask results
+        if isinstance(result[0], tuple):
+            result = [(bbox_results, encode_mask_results(mask_results))
+                      for bbox_results, mask_results in result]
+        if evaluator is not None:
+            for j, img_result in enumerate(result):
+                evaluator.process(num_done + j, img_result)
+        if collect:
+            results.extend(result)
+        num_done += batch_size
+
+        for _ in range(batch_size):
+            prog_bar.update()
+    return results
+
+
+def multi_gpu_test(model, data_loader, tmpdir=None, gpu_collect=False):
+    model.eval()
+    results = []
+    dataset = data_loader.dataset
+    rank, world_size = get_dist_info()
+    if rank == 0:
+        prog_bar = mmcv.ProgressBar(len(dataset))
+    time.sleep(2)  # This line can prevent deadlock problem in some cases.
+    for i, data in enumerate(data_loader):
+        with torch.no_grad():
+            result = model(return_loss=False, rescale=True, **data)
+            # encode mask results
+            if isinstance(result[0], tuple):
+                result = [(bbox_results, encode_mask_results(mask_results))
+                          for bbox_results, mask_results in result]
+        results.extend(result)
+
+        if rank == 0:
+            batch_size = len(result)
+            for _ in range(batch_size * world_size):
+                prog_bar.update()
+
+    # collect results from all ranks
+    if gpu_collect:
+        results = collect_results_gpu(results, len(dataset))
+    else:
+        results = collect_results_cpu(results, len(dataset), tmpdir)
+    return results
+
+
+def build_test_model(cfg, checkpoint_file, fuse=False, classes=None):
+    """Detector with its checkpoint loaded, ready to test."""
+    cfg.model.train_cfg = None
+    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
+    fp16_cfg = cfg.get('fp16', None)
+    if fp16_cfg is not None:
+        wrap_fp16_model(model)
+    checkpoint = load_checkpoint(model, checkpoint_file, map_location='cpu')
+    if fuse:
+        model = fuse_conv_bn(model)
+    # old versions did not save class info in checkpoints, this walkaround is
+    # for backward compatibility
+    if 'CLASSES' in checkpoint.get('meta', {}):
+        model.CLASSES = checkpoint['meta']['CLASSES']
+    else:
+        model.CLASSES = classes
+    return model
+
+
+def cpu_worker(rank, num_workers, cfg, checkpoint, fuse, samples_per_gpu,
+               threads, results):
+    """Test every num_workers-th image from rank on in a worker of the cpu
+    launcher, and put the result of every image in the results queue with
+    its index."""
+    torch.set_num_threads(threads)
+    if cfg.get('custom_imports', None):
+        from mmcv.utils import import_modules_from_strings
+        import_modules_from_strings(**cfg['custom_imports'])
+    dataset = build_dataset(cfg.data.test)
+    indices = list(range(rank, len(dataset), num_workers))
+    data_loader = build_dataloader(
+        Subset(dataset, indices),
+        samples_per_gpu=samples_per_gpu,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False)
+    # no MMDataParallel, which would move the model to GPU 0 on hosts
+    # with CUDA. The batches are scattered to the cpu instead.
+    model = build_test_model(cfg, checkpoint, fuse, dataset.CLASSES)
+    model.eval()
+    num_done = 0
+    for data in data_loader:
+        data = scatter(data, [-1])[0]
+        with torch.no_grad():
+            result = model(return_loss=False, rescale=True, **data)
+        # encode mask results
+        if isinstance(result[0], tuple):
+            result = [(bbox_results, encode_mask_results(mask_results))
+                      for bbox_results, mask_results in result]
+        for img_result in result:
+            results.put((indices[num_done], img_result))
+            num_done += 1
+    results.put((None, rank))
+
+
+def cpu_parallel_test(cfg,
+                      checkpoint,
+                      num_imgs,
+                      num_workers,
+                      threads=None,
+                      fuse=False,
+                      samples_per_gpu=1,
+                      evaluator=None,
+                      collect=True):
+    """Test with the dataset sharded across cpu worker processes.
+    The results are sent back per image and put in dataset order.
+    Args:
+        num_imgs (int): images in the dataset
+        num_workers (int): worker processes, each with its own model
+        threads (int): intra-op threads of every worker, cpu count /
+            num_workers if not given
+        evaluator (StreamingCocoEval): processes every result as soon as it
+            is received
+        collect (bool): return the results, else an empty list
+    """
+    threads = threads or max(os.cpu_count() // num_workers, 1)
+    # forked workers can hang in the OpenMP pool the parent already used
+    ctx = multiprocessing.get_context('spawn')
+    results_queue = ctx.Queue()
+    workers = [
+        ctx.Process(
+            target=cpu_worker,
+            args=(rank, num_workers, cfg, checkpoint, fuse, samples_per_gpu,
+                  threads, results_queue)) for rank in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    results = [None] * num_imgs if collect else []
+    prog_bar = mmcv.ProgressBar(num_imgs)
+    num_finished = 0
+    while num_finished < num_workers:
+        try:
+            idx, result = results_queue.get(timeout=10)
+        except queue.Empty:
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError('a cpu test worker failed')
+            continue
+        if idx is None:
+            num_finished += 1
+            continue
+        if evaluator is not None:
+            evaluator.process(idx, result)
+        if collect:
+            results[idx] = result
+        prog_bar.update()
+    for worker in workers:
+        worker.join()
+    return results
+
+
 def main():
     args = parse_args()
 
@@ -110,8 +400,27 @@ def main():
     if args.eval and args.format_only:
         raise ValueError('--eval and --format_only cannot be both specified')
 
-    if args.out is not None and not args.out.endswith(('.pkl', '.pickle')):
-        raise ValueError('The output file must be a pkl file.')
+    if args.results is None and args.checkpoint is None:
+        raise ValueError('Please specify the checkpoint, or --results')
+
+    if args.results is not None and (
+            args.out or args.show or args.show_dir or args.stream_eval
+            or args.launcher != 'none'):
+        raise ValueError(
+            '--results only evaluates or formats the results, it cannot be '
+            'combined with --out, --show, --show-dir, --stream-eval or a '
+            'launcher. tools/convert_results.py converts a pickle to .res')
+
+    if args.stream_eval and not args.eval:
+        raise ValueError('--stream-eval requires --eval')
+
+    if args.launcher == 'cpu' and (args.show or args.show_dir):
+        raise ValueError('--show and --show-dir are not supported with the '
+                         'cpu launcher')
+
+    if args.out is not None and not args.out.endswith(
+            ('.pkl', '.pickle', '.res')):
+        raise ValueError('The output file must be a pkl or res file.')
 
     cfg = Config.fromfile(args.config)
     if args.cfg_options is not None:
@@ -124,6 +433,14 @@ def main():
     if cfg.get('cudnn_benchmark', False):
         torch.backends.cudnn.benchmark = True
     cfg.model.pretrained = None
+    if args.autocast or args.channels_last:
+        test_cfg = cfg.model.get('test_cfg') or cfg.get('test_cfg')
+        if test_cfg is None:
+            test_cfg = cfg.model.test_cfg = ConfigDict()
+        if args.autocast:
+            test_cfg.autocast = args.autocast
+        if args.channels_last:
+            test_cfg.channels_last = True
     if cfg.model.get('neck'):
         if isinstance(cfg.model.neck, list):
             for neck_cfg in cfg.model.neck:
@@ -153,7 +470,7 @@ def main():
                 ds_cfg.pipeline = replace_ImageToTensor(ds_cfg.pipeline)
 
     # init distributed env first, since logger depends on the dist info.
-    if args.launcher == 'none':
+    if args.launcher in ['none', 'cpu']:
         distributed = False
     else:
         distributed = True
@@ -161,33 +478,73 @@ def main():
 
     # build the dataloader
     dataset = build_dataset(cfg.data.test)
-    data_loader = build_dataloader(
-        dataset,
-        samples_per_gpu=samples_per_gpu,
-        workers_per_gpu=cfg.data.workers_per_gpu,
-        dist=distributed,
-        shuffle=False)
+    if args.launcher != 'cpu' and args.results is None:
+        data_loader = build_dataloader(
+            dataset,
+            samples_per_gpu=samples_per_gpu,
+            workers_per_gpu=cfg.data.workers_per_gpu,
+            dist=distributed,
+            shuffle=False)
 
-    # build the model and load checkpoint
-    cfg.model.train_cfg = None
-    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
-    fp16_cfg = cfg.get('fp16', None)
-    if fp16_cfg is not None:
-        wrap_fp16_model(model)
-    checkpoint = load_checkpoint(model, args.checkpoint, map_location='cpu')
-    if args.fuse_conv_bn:
-        model = fuse_conv_bn(model)
-    # old versions did not save class info in checkpoints, this walkaround is
-    # for backward compatibility
-    if 'CLASSES' in checkpoint.get('meta', {}):
-        model.CLASSES = checkpoint['meta']['CLASSES']
-    else:
-        model.CLASSES = dataset.CLASSES
+        # build the model and load checkpoint
+        model = build_test_model(cfg, args.checkpoint, args.fuse_conv_bn,
+                                 dataset.CLASSES)
+
+    kwargs = {} if args.eval_options is None else args.eval_options
+    if args.eval:
+        eval_kwargs = cfg.get('evaluation', {}).copy()
+        # hard-code way to remove EvalHook args
+        for key in [
+                'interval', 'tmpdir', 'start', 'gpu_collect', 'save_best',
+                'rule'
+        ]:
+            eval_kwargs.pop(key, None)
+        eval_kwargs.update(dict(metric=args.eval, **kwargs))
+    evaluator = None
+    if args.stream_eval:
+        if distributed:
+            raise ValueError('--stream-eval is not supported with a launcher')
+        # the results are not kept, so e.g. jsonfile_prefix has no file to
+        # write
+        unsupported = sorted(
+            set(eval_kwargs) - {
+                'metric', 'classwise', 'proposal_nums', 'iou_thrs',
+                'metric_items'
+            })
+        if unsupported:
+            raise ValueError(
+                f'--stream-eval does not support the evaluation options '
+                f'{unsupported}, run without it or drop them')
+        evaluator = StreamingCocoEval(dataset, **eval_kwargs)
 
-    if not distributed:
+    collect = evaluator is None or bool(args.out or args.format_only)
+    if args.results is not None:
+        outputs = load_results(args.results)
+        if isinstance(outputs, ResultsFile) and \
+                not isinstance(dataset, FastCocoDataset):
+            # only FastCocoDataset reads the results file image by image
+            outputs = list(outputs)
+    elif args.launcher == 'cpu':
+        outputs = cpu_parallel_test(
+            cfg,
+            args.checkpoint,
+            len(dataset),
+            args.cpu_workers,
+            threads=args.cpu_threads,
+            fuse=args.fuse_conv_bn,
+            samples_per_gpu=samples_per_gpu,
+            evaluator=evaluator,
+            collect=collect)
+    elif not distributed:
         model = MMDataParallel(model, device_ids=[0])
-        outputs = single_gpu_test(model, data_loader, args.show, args.show_dir,
-                                  args.show_score_thr)
+        outputs = single_gpu_test(
+            model,
+            data_loader,
+            args.show,
+            args.show_dir,
+            args.show_score_thr,
+            evaluator=evaluator,
+            collect=collect)
     else:
         model = MMDistributedDataParallel(
             model.cuda(),
@@ -200,20 +557,20 @@ def main():
     if rank == 0:
         if args.out:
             print(f'\nwriting results to {args.out}')
-            mmcv.dump(outputs, args.out)
-        kwargs = {} if args.eval_options is None else args.eval_options
+            if args.out.endswith('.res'):
+                dump_results(outputs, args.out)
+            else:
+                mmcv.dump(outputs, args.out)
         if args.format_only:
             dataset.format_results(outputs, **kwargs)
-        if args.eval:
-            eval_kwargs = cfg.get('evaluation', {}).copy()
-            # hard-code way to remove EvalHook args
-            for key in [
-                    'interval', 'tmpdir', 'start', 'gpu_collect', 'save_best',
-                    'rule'
-            ]:
-                eval_kwargs.pop(key, None)
-            eval_kwargs.update(dict(metric=args.eval, **kwargs))
-            print(dataset.evaluate(outputs, **eval_kwargs))
+        if evaluator is not None:
+            print(evaluator.evaluate())
+        elif args.eval:
+            if args.eval_nproc is not None:
+                with fast_coco_eval(args.eval_nproc):
+                    print(dataset.evaluate(outputs, **eval_kwargs))
+            else:
+                print(dataset.evaluate(outputs, **eval_kwargs))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,141 @@
+import json
+
+import numpy as np
+import pytest
+
+CLASSES = ('apple', 'bread', 'pasta')
+IMG_SIZE = (64, 80)
+
+
+def box_mask(box, img_h, img_w):
+    x1, y1, x2, y2 = box
+    mask = np.zeros((img_h, img_w), dtype=np.uint8)
+    mask[y1:y2, x1:x2] = 1
+    return mask
+
+
+def random_box(rng, img_h, img_w):
+    x1, y1 = rng.integers(0, img_w - 8), rng.integers(0, img_h - 8)
+    x2 = rng.integers(x1 + 4, img_w + 1)
+    y2 = rng.integers(y1 + 4, img_h + 1)
+    return [int(x1), int(y1), int(x2), int(y2)]
+
+
+def tiny_solov2_cfg(test_cfg):
+    """Model config of a small SOLOv2 on a ResNet-18, for tests that
+    need a whole detector."""
+    norm_cfg = dict(type='GN', num_groups=8, requires_grad=True)
+    return dict(
+        type='SOLOv2',
+        backbone=dict(
+            type='ResNet',
+            depth=18,
+            num_stages=4,
+            out_indices=(0, 1, 2, 3),
+            style='pytorch'),
+        neck=dict(
+            type='FPN',
+            in_channels=[64, 128, 256, 512],
+            out_channels=32,
+            start_level=0,
+            num_outs=5),
+        bbox_head=dict(
+            type='SOLOv2Head',
+            num_classes=3,
+            in_channels=32,
+            stacked_convs=2,
+            seg_feat_channels=32,
+            strides=[8, 8, 16, 32, 32],
+            scale_ranges=((1, 96), (48, 192), (96, 384), (192, 768),
+                          (384, 2048)),
+            sigma=0.2,
+            num_grids=[40, 36, 24, 16, 12],
+            ins_out_channels=16,
+            loss_mask=dict(type='DiceLoss', use_sigmoid=True,
+                           loss_weight=3.0),
+            loss_cls=dict(type='FocalLoss', use_sigmoid=True, gamma=2.0,
+                          alpha=0.25, loss_weight=1.0),
+            norm_cfg=norm_cfg),
+        mask_feat_head=dict(
+            type='MaskFeatHead',
+            in_channels=32,
+            out_channels=16,
+            start_level=0,
+            end_level=3,
+            mask_feat_channels=16,
+            norm_cfg=norm_cfg),
+        train_cfg=None,
+        test_cfg=test_cfg)
+
+
+@pytest.fixture
+def coco_gt(tmp_path):
+    """A small COCO annotation file of rectangular instances, with a
+    crowd annotation and an image without annotations. Returns its path."""
+    rng = np.random.default_rng(0)
+    img_h, img_w = IMG_SIZE
+    images, annotations = [], []
+    for img_id in range(1, 9):
+        images.append(
+            dict(id=img_id, file_name=f'{img_id}.jpg', height=img_h,
+                 width=img_w))
+        num_gts = 0 if img_id == 8 else int(rng.integers(1, 6))
+        for _ in range(num_gts):
+            x1, y1, x2, y2 = random_box(rng, img_h, img_w)
+            annotations.append(
+                dict(
+                    id=len(annotations) + 1,
+                    image_id=img_id,
+                    category_id=int(rng.integers(1, len(CLASSES) + 1)),
+                    bbox=[x1, y1, x2 - x1, y2 - y1],
+                    area=(x2 - x1) * (y2 - y1),
+                    segmentation=[[x1, y1, x2, y1, x2, y2, x1, y2]],
+                    iscrowd=int(len(annotations) == 3)))
+    categories = [
+        dict(id=i + 1, name=name) for i, name in enumerate(CLASSES)
+    ]
+    ann_file = tmp_path / 'gt.json'
+    ann_file.write_text(
+        json.dumps(
+            dict(images=images, annotations=annotations,
+                 categories=categories)))
+    return str(ann_file)
+
+
+@pytest.fixture
+def coco_results(coco_gt):
+    """mmdet results of every image of `coco_gt`: jittered GTs and false
+    positives, with their masks as RLE."""
+    from pycocotools import mask as mask_util
+
+    rng = np.random.default_rng(1)
+    img_h, img_w = IMG_SIZE
+    with open(coco_gt) as f:
+        gt = json.load(f)
+    results = []
+    for img in gt['images']:
+        dets = [[] for _ in CLASSES]
+        for ann in gt['annotations']:
+            if ann['image_id'] != img['id']:
+                continue
+            x, y, w, h = ann['bbox']
+            box = np.clip(
+                np.array([x, y, x + w, y + h]) + rng.integers(-3, 4, 4),
+                0, [img_w, img_h, img_w, img_h])
+            dets[ann['category_id'] - 1].append(box)
+        for _ in range(int(rng.integers(0, 4))):
+            dets[int(rng.integers(0, len(CLASSES)))].append(
+                np.array(random_box(rng, img_h, img_w)))
+        bbox_results, segm_results = [], []
+        for boxes in dets:
+            boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+            scores = rng.random(len(boxes)).astype(np.float32)
+            bbox_results.append(
+                np.hstack([boxes, scores[:, None]]).astype(np.float32))
+            segm_results.append([
+                mask_util.encode(
+                    np.asfortranarray(box_mask(box, img_h, img_w)))
+                for box in boxes
+            ])
+        results.append((bbox_results, segm_results))
+    return results
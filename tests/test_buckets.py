@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+pytest.importorskip('mmdet')
+from mmcv import ConfigDict  # noqa: E402
+from mmdet.models import build_detector  # noqa: E402
+
+import models.dense_heads.solov2_head  # noqa: E402,F401
+import models.detectors.solov2  # noqa: E402,F401
+import models.mask_heads.mask_feat_head  # noqa: E402,F401
+
+from .conftest import tiny_solov2_cfg  # noqa: E402
+
+BUCKET = (128, 160)
+
+
+def img_meta(img_shape, pad_shape):
+    return dict(img_shape=img_shape + (3, ), ori_shape=img_shape + (3, ),
+                pad_shape=pad_shape + (3, ), scale_factor=1.0, flip=False)
+
+
+def assert_same_results(results, expected):
+    num_dets = 0
+    for (bbox_results, segm_results), (exp_bbox_results, exp_segm_results) \
+            in zip(results, expected):
+        for bboxes, segms, exp_bboxes, exp_segms in zip(
+                bbox_results, segm_results, exp_bbox_results,
+                exp_segm_results):
+            assert np.allclose(bboxes, exp_bboxes, atol=1e-5)
+            assert len(segms) == len(exp_segms)
+            assert all(
+                np.array_equal(segm, exp_segm)
+                for segm, exp_segm in zip(segms, exp_segms))
+            num_dets += len(bboxes)
+    return num_dets
+
+
+def test_bucketed_simple_test_matches_padded_input(monkeypatch):
+    test_cfg = ConfigDict(
+        nms_pre=100,
+        score_thr=0.1,
+        mask_thr=0.5,
+        update_thr=0.05,
+        kernel='gaussian',
+        sigma=2.0,
+        max_per_img=20,
+        buckets=[(96, 96), BUCKET, (256, 320)])
+    torch.manual_seed(0)
+    model = build_detector(ConfigDict(tiny_solov2_cfg(test_cfg))).eval()
+    # scores around 0.5 instead of the focal loss prior, so that there are
+    # detections
+    torch.nn.init.zeros_(model.bbox_head.solo_cate.bias)
+
+    traces = []
+    trace_module = torch.jit.trace_module
+
+    def counted_trace_module(mod, inputs, **kwargs):
+        traces.append({name: inp.shape for name, inp in inputs.items()})
+        return trace_module(mod, inputs, **kwargs)
+
+    monkeypatch.setattr(torch.jit, 'trace_module', counted_trace_module)
+
+    # two padded sizes that both go to the same bucket
+    num_dets = 0
+    for img_shape, pad_shape in [((120, 150), (128, 160)),
+                                 ((90, 100), (96, 128))]:
+        img = torch.randn(1, 3, *pad_shape)
+        with torch.no_grad():
+            results = model.simple_test(
+                img, [img_meta(img_shape, pad_shape)], rescale=True)
+
+            test_cfg.buckets = None
+            padded = F.pad(img, (0, BUCKET[1] - pad_shape[1], 0,
+                                 BUCKET[0] - pad_shape[0]))
+            expected = model.simple_test(
+                padded, [img_meta(img_shape, BUCKET)], rescale=True)
+            test_cfg.buckets = [(96, 96), BUCKET, (256, 320)]
+        num_dets += assert_same_results(results, expected)
+    assert num_dets > 0
+
+    # the second image reused the trace of the first one
+    assert traces == [{'network_outputs': (1, 3) + BUCKET}]
+    assert list(model._bucket_networks) == [
+        ((1, 3) + BUCKET, img.device, None, 'trace')
+    ]
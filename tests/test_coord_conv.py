@@ -0,0 +1,116 @@
+import pytest
+import torch
+
+pytest.importorskip('mmdet')
+from models.dense_heads.decoupled_solo_head import \
+    DecoupledSOLOHead  # noqa: E402
+from models.dense_heads.solo_head import SOLOHead  # noqa: E402
+from models.dense_heads.solov2_head import SOLOv2Head  # noqa: E402
+from models.mask_heads.mask_feat_head import MaskFeatHead  # noqa: E402
+
+NUM_GRIDS = [40, 36, 24, 16, 12]
+# FPN levels of a 128x160 image, strides 4 to 64
+FEATMAP_SIZES = [(32, 40), (16, 20), (8, 10), (4, 5), (2, 3)]
+NORM_CFG = dict(type='GN', num_groups=4, requires_grad=True)
+LOSSES = dict(
+    loss_mask=dict(type='DiceLoss', use_sigmoid=True, loss_weight=3.0),
+    loss_cls=dict(type='FocalLoss', use_sigmoid=True, gamma=2.0, alpha=0.25,
+                  loss_weight=1.0))
+
+
+def solo_head(head_type=SOLOHead):
+    return head_type(
+        num_classes=3,
+        in_channels=8,
+        seg_feat_channels=8,
+        stacked_convs=2,
+        num_grids=NUM_GRIDS,
+        norm_cfg=NORM_CFG,
+        **LOSSES)
+
+
+def solov2_head():
+    return SOLOv2Head(
+        num_classes=3,
+        in_channels=8,
+        seg_feat_channels=8,
+        stacked_convs=2,
+        strides=[8, 8, 16, 32, 32],
+        scale_ranges=((1, 96), (48, 192), (96, 384), (192, 768),
+                      (384, 2048)),
+        num_grids=NUM_GRIDS,
+        ins_out_channels=8,
+        norm_cfg=NORM_CFG,
+        **LOSSES)
+
+
+def mask_feat_head():
+    return MaskFeatHead(
+        in_channels=8,
+        out_channels=8,
+        start_level=0,
+        end_level=3,
+        mask_feat_channels=8,
+        norm_cfg=NORM_CFG)
+
+
+HEADS = {
+    'solo': (solo_head, 5),
+    'decoupled_solo': (lambda: solo_head(DecoupledSOLOHead), 5),
+    'solov2': (solov2_head, 5),
+    'mask_feat': (mask_feat_head, 4),
+}
+
+
+def flatten(outs):
+    """Outputs of a head, as a list of tensors."""
+    if isinstance(outs, torch.Tensor):
+        return [outs]
+    return [out for level_outs in outs for out in level_outs]
+
+
+def outputs(head, feats, cached_coord):
+    head.cached_coord = cached_coord
+    with torch.no_grad():
+        return flatten(head(feats))
+
+
+def assert_close(outs, expected):
+    assert len(outs) == len(expected)
+    for out, exp_out in zip(outs, expected):
+        assert torch.allclose(out, exp_out, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('head_name', list(HEADS))
+def test_cached_coord_matches_concat(head_name):
+    build, num_levels = HEADS[head_name]
+    torch.manual_seed(0)
+    head = build()
+    # weights of the scale of a trained model rather than of the init
+    for param in head.parameters():
+        torch.nn.init.normal_(param, std=0.3)
+    head.eval()
+    feats = [torch.randn(2, 8, *size) for size in FEATMAP_SIZES[:num_levels]]
+
+    expected = outputs(head, feats, cached_coord=False)
+    assert_close(outputs(head, feats, cached_coord=True), expected)
+    num_cached = len(head._coord_cache)
+    assert num_cached > 0
+    # from the cache this time
+    assert_close(outputs(head, feats, cached_coord=True), expected)
+    assert len(head._coord_cache) == num_cached
+
+    # an optimizer step updates the weights in place, which must not reuse
+    # the maps of the old weights
+    head.train()
+    head.cached_coord = False
+    sum(out.sum() for out in flatten(head(feats))).backward()
+    torch.optim.SGD(head.parameters(), lr=0.1).step()
+    head.eval()
+
+    updated = outputs(head, feats, cached_coord=False)
+    assert not all(
+        torch.allclose(out, exp_out)
+        for out, exp_out in zip(updated, expected))
+    assert_close(outputs(head, feats, cached_coord=True), updated)
+    assert len(head._coord_cache) == 2 * num_cached
@@ -0,0 +1,129 @@
+import os.path as osp
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('mmdet')
+from mmcv import Config  # noqa: E402
+from mmcv.parallel import MMDataParallel  # noqa: E402
+from mmcv.runner import save_checkpoint  # noqa: E402
+from mmdet.datasets import build_dataloader, build_dataset  # noqa: E402
+from mmdet.models import build_detector  # noqa: E402
+
+import models.dense_heads.solov2_head  # noqa: E402,F401
+import models.detectors.solov2  # noqa: E402,F401
+import models.mask_heads.mask_feat_head  # noqa: E402,F401
+
+from .conftest import CLASSES, IMG_SIZE, tiny_solov2_cfg  # noqa: E402
+
+# test.py of the repository, the workers are spawned and import it by name
+test_script = pytest.importorskip('test')
+if not hasattr(test_script, 'cpu_parallel_test'):
+    pytest.skip('test.py of the repository is shadowed',
+                allow_module_level=True)
+
+
+@pytest.fixture
+def test_cfg(tmp_path, coco_gt):
+    """Config of a tiny random SOLOv2 on the images of `coco_gt`, and the
+    path of its checkpoint."""
+    import mmcv
+
+    rng = np.random.default_rng(0)
+    for img_id in range(1, 9):
+        mmcv.imwrite(
+            rng.integers(0, 256, IMG_SIZE + (3, ), dtype=np.uint8),
+            str(tmp_path / f'{img_id}.jpg'))
+    img_norm_cfg = dict(
+        mean=[123.675, 116.28, 103.53], std=[58.395, 57.12, 57.375],
+        to_rgb=True)
+    cfg = Config(
+        dict(
+            custom_imports=dict(
+                imports=[
+                    'models.dense_heads.solov2_head',
+                    'models.detectors.solov2',
+                    'models.mask_heads.mask_feat_head'
+                ],
+                allow_failed_imports=False),
+            model=tiny_solov2_cfg(
+                dict(
+                    nms_pre=100,
+                    score_thr=0.1,
+                    mask_thr=0.5,
+                    update_thr=0.05,
+                    kernel='gaussian',
+                    sigma=2.0,
+                    max_per_img=20)),
+            data=dict(
+                workers_per_gpu=0,
+                test=dict(
+                    type='CocoDataset',
+                    ann_file=coco_gt,
+                    img_prefix=str(tmp_path),
+                    classes=CLASSES,
+                    test_mode=True,
+                    pipeline=[
+                        dict(type='LoadImageFromFile'),
+                        dict(
+                            type='MultiScaleFlipAug',
+                            img_scale=IMG_SIZE[::-1],
+                            flip=False,
+                            transforms=[
+                                dict(type='Resize', keep_ratio=True),
+                                dict(type='Normalize', **img_norm_cfg),
+                                dict(type='Pad', size_divisor=32),
+                                dict(type='ImageToTensor', keys=['img']),
+                                dict(type='Collect', keys=['img']),
+                            ])
+                    ]))))
+    torch.manual_seed(0)
+    model = build_detector(cfg.model)
+    # scores around 0.5 instead of the focal loss prior, so that there are
+    # detections
+    torch.nn.init.zeros_(model.bbox_head.solo_cate.bias)
+    checkpoint = str(tmp_path / 'model.pth')
+    save_checkpoint(model, checkpoint, meta=dict(CLASSES=CLASSES))
+    return cfg, checkpoint
+
+
+def test_cpu_parallel_test_matches_single_gpu_test(test_cfg):
+    cfg, checkpoint = test_cfg
+    dataset = build_dataset(cfg.data.test)
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        model = test_script.build_test_model(cfg.copy(), checkpoint,
+                                             classes=CLASSES)
+        data_loader = build_dataloader(
+            dataset, samples_per_gpu=1, workers_per_gpu=0, dist=False,
+            shuffle=False)
+        expected = test_script.single_gpu_test(
+            MMDataParallel(model, device_ids=[0]), data_loader)
+    finally:
+        torch.set_num_threads(num_threads)
+
+    # every worker gets every other image, and the results come back in
+    # dataset order
+    results = test_script.cpu_parallel_test(
+        cfg, checkpoint, len(dataset), 2, threads=1)
+    assert len(results) == len(expected) == len(dataset)
+    num_dets = 0
+    for (bbox_results, segm_results), (exp_bbox_results, exp_segm_results) \
+            in zip(results, expected):
+        for bboxes, segms, exp_bboxes, exp_segms in zip(
+                bbox_results, segm_results, exp_bbox_results,
+                exp_segm_results):
+            assert np.array_equal(bboxes, exp_bboxes)
+            assert segms == exp_segms
+            num_dets += len(bboxes)
+    assert num_dets > 0
+
+
+def test_cpu_parallel_test_raises_on_failed_worker(test_cfg):
+    cfg, checkpoint = test_cfg
+    with pytest.raises(RuntimeError, match='worker failed'):
+        test_script.cpu_parallel_test(
+            cfg, osp.join(osp.dirname(checkpoint), 'missing.pth'), 8, 2,
+            threads=1)
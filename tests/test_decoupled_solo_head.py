@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+import torch
+
+from .test_solo_target import ellipse_masks
+
+pytest.importorskip('mmdet')
+from mmcv import ConfigDict  # noqa: E402
+from mmdet.core import BitmapMasks  # noqa: E402
+
+from models.dense_heads.decoupled_solo_head import \
+    DecoupledSOLOHead  # noqa: E402
+from models.dense_heads.solo_head import SOLOHead  # noqa: E402
+
+NUM_CLASSES = 3
+NUM_GRIDS = [40, 36, 24, 16, 12]
+STRIDES = [8, 8, 16, 32, 32]
+IMG_SIZE = (256, 320)
+TEST_CFG = dict(
+    nms_pre=500,
+    score_thr=0.1,
+    mask_thr=0.5,
+    update_thr=0.05,
+    kernel='gaussian',
+    sigma=2.0,
+    max_per_img=100)
+
+
+def build_heads(sparse_ins_label=False):
+    kwargs = dict(
+        num_classes=NUM_CLASSES,
+        in_channels=8,
+        seg_feat_channels=8,
+        stacked_convs=1,
+        strides=STRIDES,
+        num_grids=NUM_GRIDS,
+        sparse_ins_label=sparse_ins_label,
+        loss_mask=dict(type='DiceLoss', use_sigmoid=True, loss_weight=3.0),
+        loss_cls=dict(type='FocalLoss', use_sigmoid=True, gamma=2.0,
+                      alpha=0.25, loss_weight=1.0),
+        test_cfg=ConfigDict(TEST_CFG))
+    return DecoupledSOLOHead(**kwargs), SOLOHead(**kwargs)
+
+
+def products(preds_x, preds_y):
+    """The S^2 masks of the cells of a level, cell (i, j) being the product
+    of the j-th X mask and the i-th Y mask."""
+    num_imgs, num_grid = preds_x.shape[:2]
+    return (preds_y[:, :, None] * preds_x[:, None, :]).reshape(
+        num_imgs, num_grid**2, *preds_x.shape[2:])
+
+
+def gts(seed, num_imgs=2):
+    rng = np.random.default_rng(seed)
+    gt_bboxes, gt_labels, gt_masks = [], [], []
+    for _ in range(num_imgs):
+        masks, boxes = ellipse_masks(rng, 6, *IMG_SIZE)
+        gt_bboxes.append(torch.from_numpy(boxes))
+        gt_labels.append(
+            torch.from_numpy(rng.integers(0, NUM_CLASSES, len(masks))))
+        gt_masks.append(BitmapMasks(masks, *IMG_SIZE))
+    return gt_bboxes, gt_labels, gt_masks
+
+
+@pytest.mark.parametrize('sparse_ins_label', [False, True],
+                         ids=['dense', 'sparse'])
+@pytest.mark.parametrize('seed', range(2))
+def test_loss_matches_solo_head_on_products(sparse_ins_label, seed):
+    decoupled_head, solo_head = build_heads(sparse_ins_label)
+    generator = torch.Generator().manual_seed(seed)
+    featmap_sizes = [(IMG_SIZE[0] // stride * 2, IMG_SIZE[1] // stride * 2)
+                     for stride in STRIDES]
+    preds_x, preds_y, cate_preds = [], [], []
+    for num_grid, featmap_size in zip(NUM_GRIDS, featmap_sizes):
+        preds_x.append(
+            torch.randn((2, num_grid) + featmap_size, generator=generator,
+                        dtype=torch.float64))
+        preds_y.append(
+            torch.randn((2, num_grid) + featmap_size, generator=generator,
+                        dtype=torch.float64))
+        cate_preds.append(
+            torch.randn(2, NUM_CLASSES, num_grid, num_grid,
+                        generator=generator, dtype=torch.float64))
+    gt_bboxes, gt_labels, gt_masks = gts(seed)
+
+    losses = decoupled_head.loss(preds_x, preds_y, cate_preds, gt_bboxes,
+                                 gt_labels, gt_masks, None)
+    # logits whose sigmoid is the product of the X and Y masks
+    ins_preds = [
+        torch.logit(products(pred_x.sigmoid(), pred_y.sigmoid()))
+        for pred_x, pred_y in zip(preds_x, preds_y)
+    ]
+    expected = solo_head.loss(ins_preds, cate_preds, gt_bboxes, gt_labels,
+                              gt_masks, None)
+    for key in ['loss_mask', 'loss_cls']:
+        assert torch.allclose(losses[key], expected[key], rtol=1e-9), key
+
+
+def test_get_seg_matches_solo_head_on_products():
+    decoupled_head, solo_head = build_heads()
+    generator = torch.Generator().manual_seed(0)
+    featmap_size = (IMG_SIZE[0] // 4, IMG_SIZE[1] // 4)
+    # smooth masks, upsampled from a coarse grid
+    seg_preds_x, seg_preds_y, cate_preds = [], [], []
+    for num_grid in NUM_GRIDS:
+        for seg_preds in (seg_preds_x, seg_preds_y):
+            seg_preds.append(
+                torch.nn.functional.interpolate(
+                    torch.rand(2, num_grid, 8, 10, generator=generator),
+                    size=featmap_size,
+                    mode='bilinear'))
+        cate_preds.append(
+            torch.rand(2, num_grid, num_grid, NUM_CLASSES,
+                       generator=generator))
+    img_meta = dict(img_shape=IMG_SIZE + (3, ), ori_shape=IMG_SIZE + (3, ),
+                    pad_shape=IMG_SIZE + (3, ), scale_factor=1.0, flip=False)
+    img_metas = [img_meta, img_meta]
+
+    results = decoupled_head.get_seg(seg_preds_x, seg_preds_y, cate_preds,
+                                     img_metas, None, rescale=True)
+    seg_preds = [
+        products(seg_pred_x, seg_pred_y)
+        for seg_pred_x, seg_pred_y in zip(seg_preds_x, seg_preds_y)
+    ]
+    expected = solo_head.get_seg(seg_preds, cate_preds, img_metas, None,
+                                 rescale=True)
+    num_dets = 0
+    for bbox_results, segm_results, exp_bbox_results, exp_segm_results in \
+            zip(*results, *expected):
+        for bboxes, segms, exp_bboxes, exp_segms in zip(
+                bbox_results, segm_results, exp_bbox_results,
+                exp_segm_results):
+            assert np.array_equal(bboxes, exp_bboxes)
+            assert len(segms) == len(exp_segms)
+            assert all(
+                np.array_equal(segm, exp_segm)
+                for segm, exp_segm in zip(segms, exp_segms))
+            num_dets += len(bboxes)
+    assert num_dets > 0
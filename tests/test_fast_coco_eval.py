@@ -0,0 +1,82 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mmdet')
+from pycocotools.coco import COCO  # noqa: E402
+from pycocotools.cocoeval import COCOeval  # noqa: E402
+
+from models.datasets import FastCOCOeval  # noqa: E402
+from models.datasets import coco as fast_coco  # noqa: E402
+
+
+def results2json(results):
+    """COCO detections of the mmdet results of the images 1, 2, ..."""
+    dets = []
+    for img_id, (bbox_results, segm_results) in enumerate(results, 1):
+        for label, (bboxes, segms) in enumerate(
+                zip(bbox_results, segm_results)):
+            for bbox, segm in zip(bboxes, segms):
+                x1, y1, x2, y2, score = bbox.tolist()
+                dets.append(
+                    dict(
+                        image_id=img_id,
+                        category_id=label + 1,
+                        bbox=[x1, y1, x2 - x1, y2 - y1],
+                        score=score,
+                        segmentation=dict(
+                            size=segm['size'],
+                            counts=segm['counts'].decode())))
+    return dets
+
+
+def run(coco_eval):
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return coco_eval
+
+
+def assert_same_eval_imgs(eval_imgs, exp_eval_imgs):
+    assert len(eval_imgs) == len(exp_eval_imgs)
+    for entry, exp_entry in zip(eval_imgs, exp_eval_imgs):
+        if exp_entry is None:
+            assert entry is None
+            continue
+        assert entry.keys() == exp_entry.keys()
+        for key, value in exp_entry.items():
+            assert np.array_equal(entry[key], value), key
+
+
+@pytest.mark.parametrize('iou_type', ['bbox', 'segm'])
+@pytest.mark.parametrize('nproc', [0, 2])
+@pytest.mark.parametrize('max_dets', [[1, 10, 100], [1, 2, 3]])
+@pytest.mark.parametrize('use_cats', [1, 0])
+def test_fast_coco_eval_matches_pycocotools(coco_gt, coco_results,
+                                            monkeypatch, iou_type, nproc,
+                                            max_dets, use_cats):
+    # blocks of two pairs, so that the pool is used on this small set
+    monkeypatch.setattr(fast_coco, 'PAIRS_PER_BLOCK', 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        gt = COCO(coco_gt)
+        dt = gt.loadRes(results2json(coco_results))
+
+    coco_evals = []
+    for coco_eval in (COCOeval(gt, dt, iou_type),
+                      FastCOCOeval(gt, dt, iou_type, nproc=nproc)):
+        coco_eval.params.maxDets = max_dets
+        coco_eval.params.useCats = use_cats
+        coco_evals.append(run(coco_eval))
+    expected, fast = coco_evals
+
+    assert_same_eval_imgs(fast.evalImgs, expected.evalImgs)
+    for key in ['precision', 'recall', 'scores']:
+        assert np.array_equal(fast.eval[key], expected.eval[key])
+    assert np.array_equal(fast.stats, expected.stats)
+    # the detections are not all misses or all hits
+    precision = expected.eval['precision']
+    assert 0 < precision.max() and 0 <= precision[precision >= 0].min() < 1
+
@@ -0,0 +1,115 @@
+import pytest
+import torch
+
+from models.utils import dense_matrix_nms, matrix_nms
+from models.utils import nms as nms_module
+
+
+def baseline_matrix_nms(seg_masks, cate_labels, cate_scores,
+                        kernel='gaussian', sigma=2.0, sum_masks=None):
+    """Matrix NMS of a single image as it was before it was batched."""
+    n_samples = len(cate_labels)
+    if n_samples == 0:
+        return []
+    if sum_masks is None:
+        sum_masks = seg_masks.sum((1, 2)).float()
+    seg_masks = seg_masks.reshape(n_samples, -1).float()
+    inter_matrix = torch.mm(seg_masks, seg_masks.transpose(1, 0))
+    sum_masks_x = sum_masks.expand(n_samples, n_samples)
+    iou_matrix = (inter_matrix / (sum_masks_x + sum_masks_x.transpose(1, 0) -
+                                  inter_matrix)).triu(diagonal=1)
+    cate_labels_x = cate_labels.expand(n_samples, n_samples)
+    label_matrix = (cate_labels_x == cate_labels_x.transpose(1, 0)
+                    ).float().triu(diagonal=1)
+    compensate_iou, _ = (iou_matrix * label_matrix).max(0)
+    compensate_iou = compensate_iou.expand(n_samples,
+                                           n_samples).transpose(1, 0)
+    decay_iou = iou_matrix * label_matrix
+    if kernel == 'gaussian':
+        decay_matrix = torch.exp(-1 * sigma * (decay_iou ** 2))
+        compensate_matrix = torch.exp(-1 * sigma * (compensate_iou ** 2))
+        decay_coefficient, _ = (decay_matrix / compensate_matrix).min(0)
+    else:
+        decay_matrix = (1 - decay_iou) / (1 - compensate_iou)
+        decay_coefficient, _ = decay_matrix.min(0)
+    return cate_scores * decay_coefficient
+
+
+def random_candidates(generator, num, h=48, w=64, num_classes=3):
+    """Non-empty overlapping box masks with labels, and scores in
+    descending order."""
+    x1 = torch.randint(0, w - 8, (num, ), generator=generator)
+    y1 = torch.randint(0, h - 8, (num, ), generator=generator)
+    x2 = x1 + 4 + torch.randint(0, w // 2, (num, ), generator=generator)
+    y2 = y1 + 4 + torch.randint(0, h // 2, (num, ), generator=generator)
+    xs = torch.arange(w)
+    ys = torch.arange(h)
+    seg_masks = ((ys[None, :, None] >= y1[:, None, None]) &
+                 (ys[None, :, None] < y2[:, None, None]) &
+                 (xs[None, None, :] >= x1[:, None, None]) &
+                 (xs[None, None, :] < x2[:, None, None]))
+    cate_labels = torch.randint(0, num_classes, (num, ), generator=generator)
+    cate_scores = torch.rand(num, generator=generator).sort(
+        descending=True)[0]
+    return seg_masks, cate_labels, cate_scores
+
+
+def batch(generator, nums):
+    """Candidates of several images, concatenated, with their images."""
+    imgs = [random_candidates(generator, num) for num in nums]
+    img_inds = torch.cat([
+        torch.full((num, ), img_id, dtype=torch.int64)
+        for img_id, num in enumerate(nums)
+    ])
+    return imgs, [torch.cat(tensors) for tensors in zip(*imgs)], img_inds
+
+
+@pytest.mark.parametrize('kernel', ['gaussian', 'linear'])
+@pytest.mark.parametrize('options', [
+    dict(),
+    dict(chunk_size=100),
+    dict(chunk_size=1),
+    dict(half=True),
+    dict(box_prefilter=True),
+],
+                         ids=['dense', 'chunked', 'pixelwise', 'half',
+                              'box_prefilter'])
+def test_matrix_nms_matches_baseline(kernel, options):
+    generator = torch.Generator().manual_seed(0)
+    imgs, (seg_masks, cate_labels, cate_scores), img_inds = batch(
+        generator, [12, 1, 30, 5])
+    scores = matrix_nms(seg_masks, cate_labels, cate_scores, kernel=kernel,
+                        sigma=2.0, img_inds=img_inds, **options)
+    expected = torch.cat([
+        baseline_matrix_nms(*img, kernel=kernel, sigma=2.0) for img in imgs
+    ])
+    assert torch.allclose(scores, expected, atol=1e-6)
+
+
+def test_matrix_nms_single_image_matches_baseline():
+    generator = torch.Generator().manual_seed(1)
+    candidates = random_candidates(generator, 40)
+    sum_masks = candidates[0].sum((1, 2)).float()
+    expected = baseline_matrix_nms(*candidates, sum_masks=sum_masks)
+    assert torch.allclose(
+        matrix_nms(*candidates, sum_masks=sum_masks), expected, atol=1e-6)
+    assert torch.allclose(
+        dense_matrix_nms(*candidates, sum_masks=sum_masks), expected,
+        atol=1e-6)
+
+
+def test_box_prefilter_without_scatter_reduce(monkeypatch):
+    # torch<1.12 falls back to the dense path
+    monkeypatch.setattr(nms_module, 'SCATTER_REDUCE', False)
+    monkeypatch.setattr(nms_module, '_sparse_matrix_nms', None)
+    generator = torch.Generator().manual_seed(2)
+    candidates = random_candidates(generator, 20)
+    assert torch.allclose(
+        matrix_nms(*candidates, box_prefilter=True),
+        baseline_matrix_nms(*candidates), atol=1e-6)
+
+
+def test_matrix_nms_empty():
+    seg_masks = torch.zeros((0, 8, 8), dtype=torch.bool)
+    labels = torch.zeros(0, dtype=torch.int64)
+    assert len(matrix_nms(seg_masks, labels, labels.float())) == 0
@@ -0,0 +1,97 @@
+import os.path as osp
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('mmdet')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from mmcv import ConfigDict  # noqa: E402
+from mmdet.models import build_detector  # noqa: E402
+
+import models.dense_heads.solov2_head  # noqa: E402,F401
+import models.detectors.solov2  # noqa: E402,F401
+import models.mask_heads.mask_feat_head  # noqa: E402,F401
+
+TOOLS_DIR = osp.join(osp.dirname(osp.dirname(osp.abspath(__file__))),
+                     'tools')
+
+from .conftest import tiny_solov2_cfg  # noqa: E402
+
+
+def tiny_solov2(test_cfg):
+    return build_detector(ConfigDict(tiny_solov2_cfg(test_cfg))).eval()
+
+
+TEST_CFG = dict(
+    nms_pre=100,
+    # parity is only exact with a fixed number of candidates
+    max_candidates=100,
+    score_thr=0.1,
+    mask_thr=0.5,
+    update_thr=0.05,
+    kernel='gaussian',
+    sigma=2.0,
+    max_per_img=20,
+    lazy_masks=False,
+    mask_format='full')
+
+
+@pytest.fixture(scope='module')
+def exported(tmp_path_factory):
+    """A tiny random SOLOv2, its input and its ONNX export."""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.syspath_prepend(TOOLS_DIR)
+        from pytorch2onnx import export
+
+    torch.manual_seed(0)
+    model = tiny_solov2(ConfigDict(TEST_CFG))
+    # scores around 0.5 instead of the focal loss prior, so that there are
+    # detections
+    torch.nn.init.zeros_(model.bbox_head.solo_cate.bias)
+    img = torch.randn(1, 3, 128, 160)
+    img_meta = dict(img_shape=(120, 150, 3), ori_shape=(120, 150, 3),
+                    pad_shape=(128, 160, 3), scale_factor=1.0, flip=False)
+    output_file = str(tmp_path_factory.mktemp('onnx') / 'solov2.onnx')
+    export(model, img, output_file)
+    return model, img, img_meta, output_file
+
+
+def test_onnx_export_matches_simple_test(exported, monkeypatch):
+    monkeypatch.syspath_prepend(TOOLS_DIR)
+    from pytorch2onnx import verify
+
+    model, img, img_meta, output_file = exported
+    ious = verify(model, output_file, img, img_meta, 3, TEST_CFG['mask_thr'])
+    assert len(ious) > 0
+    assert np.mean(ious) > 0.99
+
+
+def test_excluded_nodes_match_module_names(exported, monkeypatch):
+    import onnx
+
+    monkeypatch.syspath_prepend(TOOLS_DIR)
+    from quantize_onnx import SENSITIVE_LAYERS, excluded_nodes
+
+    output_file = exported[-1]
+    with pytest.warns(UserWarning, match='dsolo_ins_list'):
+        nodes = excluded_nodes(output_file, SENSITIVE_LAYERS)
+    convs = {
+        node.name: [node.name, *node.output, *node.input[1:]]
+        for node in onnx.load(output_file).graph.node
+        if node.op_type == 'Conv'
+    }
+    assert set(nodes) <= set(convs)
+    # the output convs of both branches on every level, not the towers
+    names = [' '.join(convs[node]).replace('/', '.') for node in nodes]
+    assert all('solo_cate' in name or 'solo_kernel' in name
+               for name in names)
+    assert sum('solo_cate' in name for name in names) == 5
+    assert sum('solo_kernel' in name for name in names) == 5
+    # the TorchScript exporter scopes the node names by module
+    assert all('solo_' in node for node in nodes)
+
+    with pytest.raises(ValueError), pytest.warns(UserWarning):
+        excluded_nodes(output_file, ['no_such_module'])
@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mmdet')
+pytest.importorskip('pycocotools')
+
+from mmdet.datasets import CocoDataset  # noqa: E402
+
+from models.datasets import (FastCocoDataset, ResultsFile,  # noqa: E402
+                             dump_results, load_results)
+
+from .conftest import CLASSES  # noqa: E402
+
+
+def build(dataset_type, ann_file, **kwargs):
+    return dataset_type(
+        ann_file=ann_file, pipeline=[], classes=CLASSES, test_mode=True,
+        **kwargs)
+
+
+def test_results_file_round_trip(tmp_path, coco_results):
+    file = str(tmp_path / 'results.res')
+    dump_results(coco_results, file)
+    results = load_results(file)
+    assert isinstance(results, ResultsFile)
+    assert len(results) == len(coco_results)
+    for (bbox_results, segm_results), (exp_bbox_results, exp_segm_results) \
+            in zip(results, coco_results):
+        for bboxes, exp_bboxes in zip(bbox_results, exp_bbox_results):
+            assert np.array_equal(bboxes, exp_bboxes)
+        for segms, exp_segms in zip(segm_results, exp_segm_results):
+            assert [(segm['size'], segm['counts']) for segm in segms] == \
+                [(list(segm['size']), segm['counts']) for segm in exp_segms]
+
+
+def test_evaluate_results_file_matches_list(tmp_path, coco_gt, coco_results):
+    file = str(tmp_path / 'results.res')
+    dump_results(coco_results, file)
+    expected = build(CocoDataset, coco_gt).evaluate(
+        coco_results, metric=['bbox', 'segm'])
+    dataset = build(FastCocoDataset, coco_gt, eval_nproc=0)
+    assert dataset.evaluate(file, metric=['bbox', 'segm']) == expected
+    assert dataset.evaluate(
+        ResultsFile(file), metric=['bbox', 'segm']) == expected
+
+
+def test_format_results_file_matches_list(tmp_path, coco_gt, coco_results):
+    file = str(tmp_path / 'results.res')
+    dump_results(coco_results, file)
+    expected, _ = build(CocoDataset, coco_gt).format_results(
+        coco_results, str(tmp_path / 'list'))
+    result_files, _ = build(FastCocoDataset, coco_gt).format_results(
+        file, str(tmp_path / 'file'))
+    assert result_files.keys() == expected.keys()
+    for key in expected:
+        with open(result_files[key]) as f, open(expected[key]) as g:
+            assert json.load(f) == json.load(g)
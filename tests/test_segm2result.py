@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+import torch
+from pycocotools import mask as mask_util
+
+from models.utils import segm2result
+from models.utils.util import extract_bboxes
+
+
+def baseline_extract_bboxes(mask):
+    """extract_bboxes as it was before it was vectorized."""
+    num_ins = mask.shape[0]
+    boxes = np.zeros([num_ins, 4], dtype=np.float32)
+    for i in range(num_ins):
+        m = mask[i, :, :]
+        horizontal_indicies = np.where(np.any(m, axis=0))[0]
+        vertical_indicies = np.where(np.any(m, axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            x2 += 1
+            y2 += 1
+        else:
+            x1, x2, y1, y2 = 0, 0, 0, 0
+        boxes[i] = np.array([x1, y1, x2, y2])
+    return boxes
+
+
+def baseline_segm2result(result, num_classes):
+    """segm2result as it was before, for full masks."""
+    bbox_result = [np.zeros((0, 5), dtype=np.float32)
+                   for _ in range(num_classes)]
+    segm_result = [[] for _ in range(num_classes)]
+    if result is None:
+        return bbox_result, segm_result
+    seg_pred = result[0].detach().cpu().numpy()
+    cate_label = result[1].detach().cpu().numpy()
+    cate_score = result[2].detach().cpu().numpy()
+    num_ins = seg_pred.shape[0]
+    bboxes = np.zeros((num_ins, 5), dtype=np.float32)
+    bboxes[:, -1] = cate_score
+    bboxes[:, :-1] = baseline_extract_bboxes(seg_pred)
+    bbox_result = [bboxes[cate_label == i, :] for i in range(num_classes)]
+    for idx in range(num_ins):
+        segm_result[cate_label[idx]].append(seg_pred[idx])
+    return bbox_result, segm_result
+
+
+def random_masks(num, h=40, w=56, seed=0):
+    """Random sparse masks, with an empty mask, a single pixel and a full
+    mask among them."""
+    rng = np.random.default_rng(seed)
+    masks = rng.random((num, h, w)) > 0.995
+    masks[0] = False
+    masks[1] = False
+    masks[1, h - 1, w - 1] = True
+    masks[2] = True
+    return masks
+
+
+@pytest.mark.parametrize('to_input', [
+    lambda masks: masks,
+    lambda masks: masks.astype(np.uint8),
+    lambda masks: torch.from_numpy(masks),
+    lambda masks: torch.from_numpy(masks).to(torch.uint8),
+],
+                         ids=['ndarray_bool', 'ndarray_uint8', 'tensor_bool',
+                              'tensor_uint8'])
+def test_extract_bboxes_matches_baseline(to_input):
+    masks = random_masks(20)
+    boxes = extract_bboxes(to_input(masks))
+    if isinstance(boxes, torch.Tensor):
+        boxes = boxes.numpy()
+    assert boxes.dtype == np.float32
+    assert np.array_equal(boxes, baseline_extract_bboxes(masks))
+
+
+def test_extract_bboxes_no_instances():
+    masks = np.zeros((0, 8, 8), dtype=bool)
+    assert extract_bboxes(masks).shape == (0, 4)
+    assert extract_bboxes(torch.from_numpy(masks)).shape == (0, 4)
+
+
+def test_segm2result_matches_baseline():
+    num_classes = 4
+    masks = torch.from_numpy(random_masks(12, seed=1))
+    labels = torch.tensor([0, 3, 3, 1, 0, 0, 2, 3, 1, 1, 0, 2])
+    scores = torch.rand(12)
+    result = (masks, labels, scores)
+    bbox_result, segm_result = segm2result(result, num_classes)
+    exp_bbox_result, exp_segm_result = baseline_segm2result(
+        result, num_classes)
+    for label in range(num_classes):
+        assert np.array_equal(bbox_result[label], exp_bbox_result[label])
+        assert len(segm_result[label]) == len(exp_segm_result[label])
+        for segm, exp_segm in zip(segm_result[label],
+                                  exp_segm_result[label]):
+            assert np.array_equal(segm, exp_segm)
+
+    bbox_result, segm_result = segm2result(None, num_classes)
+    assert all(len(bboxes) == 0 for bboxes in bbox_result)
+    assert all(len(segms) == 0 for segms in segm_result)
+
+
+def test_segm2result_rle_matches_full_masks():
+    num_classes = 3
+    masks = random_masks(10, seed=2)
+    masks[0, 5:9, 7:20] = True
+    labels = torch.tensor([0, 1, 2, 2, 0, 1, 0, 2, 1, 0])
+    scores = torch.rand(10)
+    boxes = torch.from_numpy(baseline_extract_bboxes(masks))
+    crops = [
+        torch.from_numpy(mask[int(y1):int(y2), int(x1):int(x2)])
+        for mask, (x1, y1, x2, y2) in zip(masks, boxes.tolist())
+    ]
+    bbox_result, segm_result = segm2result(
+        (crops, labels, scores, boxes), num_classes, mask_format='rle',
+        ori_shape=masks.shape[1:] + (3, ))
+    exp_bbox_result, exp_segm_result = baseline_segm2result(
+        (torch.from_numpy(masks), labels, scores), num_classes)
+    for label in range(num_classes):
+        assert np.array_equal(bbox_result[label], exp_bbox_result[label])
+        assert segm_result[label] == [
+            mask_util.encode(np.asfortranarray(segm.astype(np.uint8)))
+            for segm in exp_segm_result[label]
+        ]
@@ -0,0 +1,240 @@
+import numpy as np
+import pytest
+import torch
+from scipy import ndimage
+
+from models.utils import center_of_mass, center_region, center_region_owner
+
+NUM_GRIDS = [40, 36, 24, 16, 12]
+IMG_SIZE = (256, 320)
+
+
+def ellipse_masks(rng, num_gts, img_h, img_w):
+    """Elliptic GT masks with their boxes."""
+    masks = np.zeros((num_gts, img_h, img_w), dtype=np.uint8)
+    ys, xs = np.ogrid[:img_h, :img_w]
+    for i in range(num_gts):
+        cy, cx = rng.integers(0, img_h), rng.integers(0, img_w)
+        ry = rng.integers(3, img_h // 2)
+        rx = rng.integers(3, img_w // 2)
+        masks[i] = ((ys - cy) / ry)**2 + ((xs - cx) / rx)**2 <= 1
+    return masks, masks_to_boxes(masks)
+
+
+def masks_to_boxes(masks):
+    boxes = np.zeros((len(masks), 4), dtype=np.float32)
+    for i, mask in enumerate(masks):
+        ys, xs = np.nonzero(mask)
+        if len(ys):
+            boxes[i] = [xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]
+    return boxes
+
+
+def loop_target_single(head, gt_bboxes_raw, gt_labels_raw, gt_masks_raw,
+                       featmap_sizes):
+    """The per-instance loop `SOLOHead.solo_target_single` used before it
+    was vectorized."""
+    import mmcv
+
+    device = gt_labels_raw.device
+    gt_areas = torch.sqrt((gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0]) *
+                          (gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1]))
+    ins_label_list = []
+    cate_label_list = []
+    ins_ind_label_list = []
+    for (lower_bound, upper_bound), stride, featmap_size, num_grid \
+            in zip(head.scale_ranges, head.strides, featmap_sizes,
+                   head.seg_num_grids):
+        ins_label = torch.zeros([num_grid ** 2,
+                                 featmap_size[0], featmap_size[1]],
+                                dtype=torch.uint8, device=device)
+        cate_label = torch.zeros([num_grid, num_grid], dtype=torch.int64,
+                                 device=device) + head.num_classes
+        ins_ind_label = torch.zeros([num_grid ** 2], dtype=torch.bool,
+                                    device=device)
+        hit_indices = ((gt_areas >= lower_bound) &
+                       (gt_areas <= upper_bound)).nonzero(
+                           as_tuple=False).flatten()
+        gt_bboxes = gt_bboxes_raw[hit_indices]
+        gt_labels = gt_labels_raw[hit_indices]
+        gt_masks = gt_masks_raw[hit_indices.cpu().numpy(), ...]
+        half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * head.sigma
+        half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * head.sigma
+        output_stride = stride / 2
+        for seg_mask, gt_label, half_h, half_w in \
+                zip(gt_masks, gt_labels, half_hs, half_ws):
+            if seg_mask.sum() < 10:
+                continue
+            upsampled_size = (featmap_sizes[0][0] * 4,
+                              featmap_sizes[0][1] * 4)
+            center_h, center_w = ndimage.center_of_mass(seg_mask)
+            coord_w = int((center_w / upsampled_size[1]) // (1. / num_grid))
+            coord_h = int((center_h / upsampled_size[0]) // (1. / num_grid))
+            top_box = max(0, int(((center_h - half_h) / upsampled_size[0])
+                                 // (1. / num_grid)))
+            down_box = min(num_grid - 1,
+                           int(((center_h + half_h) / upsampled_size[0])
+                               // (1. / num_grid)))
+            left_box = max(0, int(((center_w - half_w) / upsampled_size[1])
+                                  // (1. / num_grid)))
+            right_box = min(num_grid - 1,
+                            int(((center_w + half_w) / upsampled_size[1])
+                                // (1. / num_grid)))
+            top = max(top_box, coord_h - 1)
+            down = min(down_box, coord_h + 1)
+            left = max(coord_w - 1, left_box)
+            right = min(right_box, coord_w + 1)
+
+            cate_label[top:(down + 1), left:(right + 1)] = gt_label
+            seg_mask = mmcv.imrescale(seg_mask, scale=1. / output_stride)
+            seg_mask = torch.Tensor(seg_mask)
+            for i in range(top, down + 1):
+                for j in range(left, right + 1):
+                    label = int(i * num_grid + j)
+                    ins_label[label, :seg_mask.shape[0],
+                              :seg_mask.shape[1]] = seg_mask
+                    ins_ind_label[label] = True
+        ins_label_list.append(ins_label)
+        cate_label_list.append(cate_label)
+        ins_ind_label_list.append(ins_ind_label)
+    return ins_label_list, cate_label_list, ins_ind_label_list
+
+
+def test_center_of_mass_matches_scipy():
+    rng = np.random.default_rng(0)
+    masks, _ = ellipse_masks(rng, 8, 64, 96)
+    center_hs, center_ws = center_of_mass(torch.from_numpy(masks))
+    for mask, center_h, center_w in zip(masks, center_hs, center_ws):
+        assert (center_h.item(), center_w.item()) == \
+            ndimage.center_of_mass(mask)
+
+
+def test_center_region_owner_last_instance_wins():
+    # the regions of both instances cover cell (2, 2)
+    top = torch.tensor([1, 2])
+    down = torch.tensor([3, 4])
+    left = torch.tensor([1, 2])
+    right = torch.tensor([3, 4])
+    owner = center_region_owner(top, down, left, right, 6)
+    expected = torch.full((6, 6), -1, dtype=torch.int64)
+    for i in range(2):
+        expected[top[i]:down[i] + 1, left[i]:right[i] + 1] = i
+    assert torch.equal(owner, expected)
+
+
+def test_center_region_matches_scalar_code():
+    rng = np.random.default_rng(1)
+    masks, boxes = ellipse_masks(rng, 16, *IMG_SIZE)
+    boxes = torch.from_numpy(boxes)
+    half_ws = 0.5 * (boxes[:, 2] - boxes[:, 0]) * 0.2
+    half_hs = 0.5 * (boxes[:, 3] - boxes[:, 1]) * 0.2
+    center_hs, center_ws = center_of_mass(torch.from_numpy(masks))
+    for num_grid in NUM_GRIDS:
+        regions = center_region(center_hs, center_ws, half_hs, half_ws,
+                                IMG_SIZE, num_grid)
+        for i, mask in enumerate(masks):
+            center_h, center_w = ndimage.center_of_mass(mask)
+            coord_h = int((center_h / IMG_SIZE[0]) // (1. / num_grid))
+            coord_w = int((center_w / IMG_SIZE[1]) // (1. / num_grid))
+            top_box = max(0, int(((center_h - half_hs[i]) / IMG_SIZE[0])
+                                 // (1. / num_grid)))
+            down_box = min(num_grid - 1,
+                           int(((center_h + half_hs[i]) / IMG_SIZE[0])
+                               // (1. / num_grid)))
+            left_box = max(0, int(((center_w - half_ws[i]) / IMG_SIZE[1])
+                                  // (1. / num_grid)))
+            right_box = min(num_grid - 1,
+                            int(((center_w + half_ws[i]) / IMG_SIZE[1])
+                                // (1. / num_grid)))
+            expected = (max(top_box, coord_h - 1), min(down_box, coord_h + 1),
+                        max(coord_w - 1, left_box),
+                        min(right_box, coord_w + 1))
+            assert tuple(int(r[i]) for r in regions) == expected
+
+
+@pytest.fixture(params=[False, True], ids=['dense', 'sparse'])
+def solo_head(request):
+    pytest.importorskip('mmdet')
+    from models.dense_heads.solo_head import SOLOHead
+    return SOLOHead(
+        num_classes=4,
+        in_channels=8,
+        seg_feat_channels=8,
+        stacked_convs=1,
+        num_grids=NUM_GRIDS,
+        sparse_ins_label=request.param,
+        loss_mask=dict(type='DiceLoss', use_sigmoid=True, loss_weight=3.0),
+        loss_cls=dict(type='FocalLoss', use_sigmoid=True, gamma=2.0,
+                      alpha=0.25, loss_weight=1.0))
+
+
+def assert_same_targets(head, masks, boxes, labels):
+    from mmdet.core import BitmapMasks
+
+    featmap_sizes = [(IMG_SIZE[0] // stride * 2, IMG_SIZE[1] // stride * 2)
+                     for stride in head.strides]
+    gt_bboxes = torch.from_numpy(boxes)
+    gt_labels = torch.from_numpy(labels)
+    expected = loop_target_single(head, gt_bboxes, gt_labels, masks,
+                                  featmap_sizes)
+    targets = head.solo_target_single(
+        gt_bboxes, gt_labels, BitmapMasks(masks, *IMG_SIZE),
+        featmap_sizes=featmap_sizes)
+    for (ins_label, cate_label, ins_ind_label, ins_index,
+         exp_ins_label, exp_cate_label, exp_ins_ind_label) in \
+            zip(*targets, *expected):
+        assert torch.equal(cate_label, exp_cate_label)
+        assert torch.equal(ins_ind_label, exp_ins_ind_label)
+        if head.sparse_ins_label:
+            assert len(ins_label) == 0 or \
+                ins_label.shape[1:] == exp_ins_label.shape[1:]
+            assert torch.equal(ins_label[ins_index],
+                               exp_ins_label[exp_ins_ind_label])
+        else:
+            assert torch.equal(ins_label, exp_ins_label)
+            assert torch.equal(ins_index, ins_ind_label.nonzero().flatten())
+    return targets
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_solo_target_single_matches_loop(solo_head, seed):
+    rng = np.random.default_rng(seed)
+    masks, boxes = ellipse_masks(rng, 12, *IMG_SIZE)
+    labels = rng.integers(0, 4, len(masks))
+    assert_same_targets(solo_head, masks, boxes, labels)
+
+
+def test_solo_target_single_overlap_last_instance_wins(solo_head):
+    # three instances centered on the same pixel, in the scale range of the
+    # same levels, and one with less than 10 pixels that is ignored
+    ys, xs = np.ogrid[:IMG_SIZE[0], :IMG_SIZE[1]]
+    masks = np.stack([
+        ((ys - 128) / r)**2 + ((xs - 160) / r)**2 <= 1 for r in (40, 36, 32)
+    ] + [((ys - 128) / 1)**2 + ((xs - 160) / 1)**2 <= 1]).astype(np.uint8)
+    boxes = masks_to_boxes(masks)
+    labels = np.array([0, 1, 2, 3])
+    targets = assert_same_targets(solo_head, masks, boxes, labels)
+
+    # the center cell of the level belongs to the last valid instance
+    ins_label, cate_label, ins_ind_label, ins_index = \
+        [target[1] for target in targets]
+    import mmcv
+    num_grid = NUM_GRIDS[1]
+    cell = int((128 / IMG_SIZE[0]) // (1. / num_grid)) * num_grid + \
+        int((160 / IMG_SIZE[1]) // (1. / num_grid))
+    assert cate_label.flatten()[cell] == 2
+    assert ins_ind_label[cell]
+    last_mask = ins_label[ins_index[ins_ind_label[:cell].sum()]]
+    assert torch.equal(last_mask,
+                       torch.from_numpy(mmcv.imrescale(masks[2], 0.25)))
+
+
+def test_solo_target_single_empty_image(solo_head):
+    masks = np.zeros((0, ) + IMG_SIZE, dtype=np.uint8)
+    boxes = np.zeros((0, 4), dtype=np.float32)
+    labels = np.zeros(0, dtype=np.int64)
+    targets = assert_same_targets(solo_head, masks, boxes, labels)
+    for cate_label, ins_ind_label, ins_index in zip(*targets[1:]):
+        assert (cate_label == solo_head.num_classes).all()
+        assert not ins_ind_label.any()
+        assert len(ins_index) == 0
@@ -0,0 +1,180 @@
+import numpy as np
+import pytest
+import torch
+
+from .test_solo_target import ellipse_masks, masks_to_boxes
+
+NUM_GRIDS = [40, 36, 24, 16, 12]
+IMG_SIZE = (256, 320)
+MASK_FEAT_SIZE = (IMG_SIZE[0] // 4, IMG_SIZE[1] // 4)
+
+
+def loop_target_single(head, gt_bboxes_raw, gt_labels_raw, gt_masks_raw,
+                       mask_feat_size):
+    """The loop `SOLOv2Head.solov2_target_single` used before it stored
+    every target once, with a mask per grid cell."""
+    import mmcv
+    from models.dense_heads.solov2_head import center_of_mass
+
+    device = gt_labels_raw.device
+    gt_areas = torch.sqrt((gt_bboxes_raw[:, 2] - gt_bboxes_raw[:, 0]) *
+                          (gt_bboxes_raw[:, 3] - gt_bboxes_raw[:, 1]))
+    ins_label_list = []
+    cate_label_list = []
+    ins_ind_label_list = []
+    grid_order_list = []
+    for (lower_bound, upper_bound), num_grid in zip(head.scale_ranges,
+                                                    head.seg_num_grids):
+        hit_indices = ((gt_areas >= lower_bound) &
+                       (gt_areas <= upper_bound)).nonzero(
+                           as_tuple=False).flatten()
+        ins_label = []
+        grid_order = []
+        cate_label = torch.zeros([num_grid, num_grid], dtype=torch.int64)
+        ins_ind_label = torch.zeros([num_grid**2], dtype=torch.bool)
+        gt_bboxes = gt_bboxes_raw[hit_indices]
+        gt_labels = gt_labels_raw[hit_indices]
+        gt_masks = gt_masks_raw[hit_indices.numpy()]
+        half_ws = 0.5 * (gt_bboxes[:, 2] - gt_bboxes[:, 0]) * head.sigma
+        half_hs = 0.5 * (gt_bboxes[:, 3] - gt_bboxes[:, 1]) * head.sigma
+        gt_masks_pt = torch.from_numpy(gt_masks).to(device=device)
+        center_ws, center_hs = center_of_mass(gt_masks_pt)
+        valid_mask_flags = gt_masks_pt.sum(dim=-1).sum(dim=-1) > 0
+        upsampled_size = (mask_feat_size[0] * 4, mask_feat_size[1] * 4)
+        for seg_mask, gt_label, half_h, half_w, center_h, center_w, \
+                valid_mask_flag in zip(gt_masks, gt_labels, half_hs, half_ws,
+                                       center_hs, center_ws,
+                                       valid_mask_flags):
+            if not valid_mask_flag:
+                continue
+            coord_w = int((center_w / upsampled_size[1]) // (1. / num_grid))
+            coord_h = int((center_h / upsampled_size[0]) // (1. / num_grid))
+            top_box = max(0, int(((center_h - half_h) / upsampled_size[0])
+                                 // (1. / num_grid)))
+            down_box = min(num_grid - 1,
+                           int(((center_h + half_h) / upsampled_size[0])
+                               // (1. / num_grid)))
+            left_box = max(0, int(((center_w - half_w) / upsampled_size[1])
+                                  // (1. / num_grid)))
+            right_box = min(num_grid - 1,
+                            int(((center_w + half_w) / upsampled_size[1])
+                                // (1. / num_grid)))
+            top = max(top_box, coord_h - 1)
+            down = min(down_box, coord_h + 1)
+            left = max(coord_w - 1, left_box)
+            right = min(right_box, coord_w + 1)
+
+            cate_label[top:(down + 1), left:(right + 1)] = gt_label
+            seg_mask = mmcv.imrescale(seg_mask, scale=1. / 4)
+            seg_mask = torch.from_numpy(seg_mask)
+            for i in range(top, down + 1):
+                for j in range(left, right + 1):
+                    label = int(i * num_grid + j)
+                    cur_ins_label = torch.zeros(mask_feat_size,
+                                                dtype=torch.uint8)
+                    cur_ins_label[:seg_mask.shape[0],
+                                  :seg_mask.shape[1]] = seg_mask
+                    ins_label.append(cur_ins_label)
+                    ins_ind_label[label] = True
+                    grid_order.append(label)
+        if len(ins_label) == 0:
+            ins_label = torch.zeros((0, ) + mask_feat_size, dtype=torch.uint8)
+        else:
+            ins_label = torch.stack(ins_label, 0)
+        ins_label_list.append(ins_label)
+        cate_label_list.append(cate_label)
+        ins_ind_label_list.append(ins_ind_label)
+        grid_order_list.append(grid_order)
+    return ins_label_list, cate_label_list, ins_ind_label_list, \
+        grid_order_list
+
+
+@pytest.fixture
+def solov2_head():
+    pytest.importorskip('mmdet')
+    from models.dense_heads.solov2_head import SOLOv2Head
+    return SOLOv2Head(
+        num_classes=4,
+        in_channels=8,
+        seg_feat_channels=8,
+        stacked_convs=1,
+        num_grids=NUM_GRIDS,
+        ins_out_channels=8,
+        loss_mask=dict(type='DiceLoss', use_sigmoid=True, loss_weight=3.0),
+        loss_cls=dict(type='FocalLoss', use_sigmoid=True, gamma=2.0,
+                      alpha=0.25, loss_weight=1.0))
+
+
+def assert_same_targets(head, masks, boxes, labels):
+    from mmdet.core import BitmapMasks
+
+    gt_bboxes = torch.from_numpy(boxes)
+    gt_labels = torch.from_numpy(labels)
+    expected = loop_target_single(head, gt_bboxes, gt_labels, masks,
+                                  MASK_FEAT_SIZE)
+    targets = head.solov2_target_single(
+        gt_bboxes, gt_labels, BitmapMasks(masks, *IMG_SIZE),
+        mask_feat_size=MASK_FEAT_SIZE)
+    for (ins_label, cate_label, ins_ind_label, grid_order, ins_index,
+         exp_ins_label, exp_cate_label, exp_ins_ind_label,
+         exp_grid_order) in zip(*targets, *expected):
+        assert torch.equal(cate_label, exp_cate_label)
+        assert torch.equal(ins_ind_label, exp_ins_ind_label)
+        assert grid_order == exp_grid_order
+        assert len(ins_index) == len(grid_order)
+        # every target is stored once, and at most once per cell
+        assert len(ins_label) <= len(ins_index)
+        assert ins_label.shape[1:] == exp_ins_label.shape[1:]
+        assert torch.equal(ins_label[ins_index], exp_ins_label)
+    return targets
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_solov2_target_single_matches_loop(solov2_head, seed):
+    rng = np.random.default_rng(seed)
+    masks, boxes = ellipse_masks(rng, 12, *IMG_SIZE)
+    labels = rng.integers(0, 4, len(masks))
+    assert_same_targets(solov2_head, masks, boxes, labels)
+
+
+def test_solov2_target_single_overlap(solov2_head):
+    # three instances centered on the same pixel, in the scale range of the
+    # same levels, and an empty one that is ignored
+    ys, xs = np.ogrid[:IMG_SIZE[0], :IMG_SIZE[1]]
+    masks = np.stack([
+        ((ys - 128) / r)**2 + ((xs - 160) / r)**2 <= 1 for r in (40, 36, 32)
+    ] + [np.zeros(IMG_SIZE, dtype=bool)]).astype(np.uint8)
+    boxes = masks_to_boxes(masks)
+    boxes[3] = [150, 118, 170, 138]
+    labels = np.array([0, 1, 2, 3])
+    targets = assert_same_targets(solov2_head, masks, boxes, labels)
+
+    # the center cell of the level keeps a target per instance, and the
+    # label of the last one
+    import mmcv
+    ins_label, cate_label, _, grid_order, ins_index = \
+        [target[2] for target in targets]
+    num_grid = NUM_GRIDS[2]
+    cell = int((128 / IMG_SIZE[0]) // (1. / num_grid)) * num_grid + \
+        int((160 / IMG_SIZE[1]) // (1. / num_grid))
+    assert cate_label.flatten()[cell] == 2
+    cell_targets = ins_index[torch.tensor(grid_order) == cell]
+    assert len(cell_targets) == 3
+    assert len(ins_label) == 3
+    for target, mask in zip(cell_targets, masks):
+        expected = torch.zeros(MASK_FEAT_SIZE, dtype=torch.uint8)
+        expected[:] = torch.from_numpy(mmcv.imrescale(mask, 0.25))
+        assert torch.equal(ins_label[target], expected)
+
+
+def test_solov2_target_single_empty_image(solov2_head):
+    masks = np.zeros((0, ) + IMG_SIZE, dtype=np.uint8)
+    boxes = np.zeros((0, 4), dtype=np.float32)
+    labels = np.zeros(0, dtype=np.int64)
+    targets = assert_same_targets(solov2_head, masks, boxes, labels)
+    for ins_label, cate_label, ins_ind_label, grid_order, ins_index in \
+            zip(*targets):
+        assert len(ins_label) == 0
+        assert not cate_label.any()
+        assert not ins_ind_label.any()
+        assert grid_order == [] and len(ins_index) == 0
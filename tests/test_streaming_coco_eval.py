@@ -0,0 +1,67 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mmdet')
+pytest.importorskip('pycocotools')
+
+from mmdet.datasets import CocoDataset  # noqa: E402
+from pycocotools.cocoeval import COCOeval  # noqa: E402
+
+from models.datasets import StreamingCocoEval  # noqa: E402
+
+from .conftest import CLASSES  # noqa: E402
+
+
+def assert_same_metrics(eval_results, expected):
+    """Metrics equal up to the rounding of the installed mmdet, which
+    rounds them to 3 decimals before 2.12 and to 4 after."""
+    assert eval_results.keys() == expected.keys()
+    for key, value in expected.items():
+        if isinstance(value, str):
+            values = [float(v) for v in eval_results[key].split()]
+            value = [float(v) for v in value.split()]
+        else:
+            values = eval_results[key]
+        assert np.allclose(values, value, rtol=0, atol=5e-4 + 1e-9), key
+
+
+@pytest.mark.parametrize('metric', [['bbox', 'segm'], 'bbox', 'segm'])
+def test_streaming_eval_matches_coco_dataset(coco_gt, coco_results, metric):
+    dataset = CocoDataset(
+        ann_file=coco_gt, pipeline=[], classes=CLASSES, test_mode=True)
+    # the results of an unprocessed image count as no detections
+    skipped = 2
+    results = list(coco_results)
+    results[skipped] = ([np.zeros((0, 5), dtype=np.float32)
+                         for _ in CLASSES], [[] for _ in CLASSES])
+    expected = dataset.evaluate(results, metric=metric, classwise=True)
+
+    evaluator = StreamingCocoEval(dataset, metric=metric, classwise=True)
+    order = np.random.default_rng(0).permutation(len(coco_results))
+    for idx in order:
+        if idx != skipped:
+            evaluator.process(idx, coco_results[idx])
+    with contextlib.redirect_stdout(io.StringIO()):
+        eval_results = evaluator.evaluate()
+    assert_same_metrics(eval_results, expected)
+
+    # and exactly the stats of pycocotools on the json results
+    result_files, tmp_dir = dataset.format_results(results)
+    for iou_type, coco_eval in evaluator.coco_evals.items():
+        with contextlib.redirect_stdout(io.StringIO()):
+            dt = dataset.coco.loadRes(result_files[iou_type])
+            reference = COCOeval(dataset.coco, dt, iou_type)
+            reference.params.imgIds = dataset.img_ids
+            reference.params.catIds = dataset.cat_ids
+            reference.params.maxDets = [100, 300, 1000]
+            reference.evaluate()
+            reference.accumulate()
+            reference.summarize()
+        assert np.array_equal(coco_eval.stats, reference.stats)
+    tmp_dir.cleanup()
+    # the detections are not all misses or all hits
+    assert all(0 < value < 1 for key, value in eval_results.items()
+               if key.endswith('_mAP'))
@@ -0,0 +1,68 @@
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+
+from models.datasets import FastCOCOeval
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare FastCOCOeval with pycocotools on a result file')
+    parser.add_argument('ann_file', help='COCO annotation file')
+    parser.add_argument(
+        'result_file',
+        help='COCO result file, e.g. the .segm.json written by test.py '
+        '--format-only')
+    parser.add_argument(
+        '--iou-type',
+        choices=['segm', 'bbox'],
+        default='segm',
+        help='evaluated annotation type')
+    parser.add_argument(
+        '--nproc',
+        type=int,
+        nargs='+',
+        default=[0, 2, 4, 8],
+        help='worker processes of FastCOCOeval to benchmark')
+    args = parser.parse_args()
+    return args
+
+
+def run(coco_eval):
+    """Time evaluate + accumulate + summarize."""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt = COCO(args.ann_file)
+        coco_dt = coco_gt.loadRes(args.result_file)
+
+    reference = COCOeval(coco_gt, coco_dt, args.iou_type)
+    base = run(reference)
+    print(f'{"pycocotools":>14}: {base:7.2f} s')
+    for nproc in args.nproc:
+        coco_eval = FastCOCOeval(coco_gt, coco_dt, args.iou_type, nproc=nproc)
+        seconds = run(coco_eval)
+        identical = np.array_equal(coco_eval.stats, reference.stats) and all(
+            np.array_equal(coco_eval.eval[key], reference.eval[key])
+            for key in ['precision', 'recall', 'scores'])
+        print(f'{f"nproc={nproc}":>14}: {seconds:7.2f} s, '
+              f'{base / seconds:5.1f}x, '
+              f'{"identical" if identical else "DIFFERENT"} metrics')
+    print('AP: ' + ' '.join(f'{stat:.3f}' for stat in reference.stats))
+
+
+if __name__ == '__main__':
+    main()
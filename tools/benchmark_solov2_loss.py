@@ -0,0 +1,211 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmcv import Config, DictAction
+
+from mmdet.core import BitmapMasks
+from mmdet.models import build_head
+
+from models.dense_heads.solov2_head import dice_loss
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the SOLOv2 mask loss on CPU')
+    parser.add_argument('config', help='SOLOv2 config file path')
+    parser.add_argument(
+        '--batch-sizes',
+        type=int,
+        nargs='+',
+        default=[2, 4, 8, 16],
+        help='batch sizes to benchmark')
+    parser.add_argument(
+        '--img-size',
+        type=int,
+        nargs=2,
+        default=[800, 1088],
+        help='padded image size (h, w)')
+    parser.add_argument(
+        '--num-gts', type=int, default=8, help='GT instances per image')
+    parser.add_argument(
+        '--repeat', type=int, default=5, help='timed runs per setting')
+    parser.add_argument(
+        '--threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    args = parser.parse_args()
+    return args
+
+
+def random_gts(rng, num_gts, img_h, img_w, num_classes):
+    """Elliptic GT masks with their boxes and labels."""
+    masks = np.zeros((num_gts, img_h, img_w), dtype=np.uint8)
+    bboxes = np.zeros((num_gts, 4), dtype=np.float32)
+    ys, xs = np.ogrid[:img_h, :img_w]
+    for i in range(num_gts):
+        cy, cx = rng.integers(0, img_h), rng.integers(0, img_w)
+        ry = rng.integers(img_h // 20, img_h // 4)
+        rx = rng.integers(img_w // 20, img_w // 4)
+        masks[i] = ((ys - cy) / ry)**2 + ((xs - cx) / rx)**2 <= 1
+        bboxes[i] = [max(cx - rx, 0), max(cy - ry, 0),
+                     min(cx + rx, img_w), min(cy + ry, img_h)]
+    labels = rng.integers(0, num_classes, num_gts)
+    return (torch.from_numpy(bboxes), torch.from_numpy(labels),
+            BitmapMasks(masks, img_h, img_w))
+
+
+def loop_mask_preds(kernel_preds, ins_pred, grid_order_list):
+    """Per image and level conv2d, the way masks were generated before."""
+    mask_preds = []
+    for kernel_preds_level, grid_orders_level in zip(
+            kernel_preds, zip(*grid_order_list)):
+        for img_id, (kernel_pred, grid_order) in enumerate(
+                zip(kernel_preds_level, grid_orders_level)):
+            if len(grid_order) == 0:
+                continue
+            kernel_pred = kernel_pred.flatten(1)[:, grid_order]
+            mask_preds.append(F.conv2d(
+                ins_pred[img_id:img_id + 1],
+                kernel_pred.t()[:, :, None, None]).squeeze(0))
+    return torch.cat(mask_preds)
+
+
+def batched_mask_preds(head, kernel_preds, ins_pred, grid_order_list):
+    """One bmm over the zero-padded kernels of all images."""
+    kernel_preds = torch.cat([kernel_pred.flatten(2)
+                              for kernel_pred in kernel_preds], 2)
+    kernel_preds = kernel_preds.permute(0, 2, 1)
+    level_starts = np.cumsum([0] + [num_grid**2
+                                    for num_grid in head.seg_num_grids])
+    cell_inds = [[cell + level_start for grid_order, level_start in
+                  zip(grid_order_img, level_starts) for cell in grid_order]
+                 for grid_order_img in grid_order_list]
+    img_inds = torch.tensor([img_id for img_id, inds in enumerate(cell_inds)
+                             for _ in inds], dtype=torch.int64)
+    cell_inds = torch.tensor(sum(cell_inds, []), dtype=torch.int64)
+    return head.generate_masks(kernel_preds[img_inds, cell_inds], ins_pred,
+                               img_inds)
+
+
+def multi_targets(head, gts, mask_feat_size):
+    """Selected grid cells of every image, as `solov2_target_single`
+    returns them."""
+    return [head.solov2_target_single(
+        *gt, mask_feat_size=mask_feat_size)[3] for gt in gts]
+
+
+def dice_inputs(head, gts, mask_feat_size):
+    """Targets of all images once per instance, and the target of every
+    selected kernel, as `SOLOv2Head.loss` passes them to `dice_loss`."""
+    ins_labels = []
+    ins_indexes = []
+    num_prev_ins = 0
+    for gt in gts:
+        ins_label_img, _, _, _, ins_index_img = head.solov2_target_single(
+            *gt, mask_feat_size=mask_feat_size)
+        for ins_label, ins_index in zip(ins_label_img, ins_index_img):
+            ins_labels.append(ins_label)
+            ins_indexes.append(ins_index + num_prev_ins)
+            num_prev_ins += len(ins_label)
+    return torch.cat(ins_labels), torch.cat(ins_indexes)
+
+
+def saved_mb(func):
+    """MB of the tensors autograd keeps for the backward of func."""
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        func()
+    return sum(storages.values()) / 2**20
+
+
+def timeit(func, repeat):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    # import modules from string list.
+    if cfg.get('custom_imports', None):
+        from mmcv.utils import import_modules_from_strings
+        import_modules_from_strings(**cfg['custom_imports'])
+
+    head_cfg = cfg.model.bbox_head
+    head_cfg.update(train_cfg=cfg.model.get('train_cfg'))
+    head_cfg.update(test_cfg=cfg.model.get('test_cfg'))
+    head = build_head(head_cfg)
+    num_classes = head_cfg.num_classes
+    num_channels = head_cfg.ins_out_channels
+    num_grids = head_cfg.num_grids
+    img_h, img_w = args.img_size
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+
+    print(f'{"batch":>5} {"loop masks (ms)":>16} {"bmm masks (ms)":>15} '
+          f'{"loss step (ms)":>15} {"dice copy (MB)":>15} '
+          f'{"dice index (MB)":>16}')
+    for batch_size in args.batch_sizes:
+        gts = [random_gts(rng, args.num_gts, img_h, img_w, num_classes)
+               for _ in range(batch_size)]
+        gt_bbox_list, gt_label_list, gt_mask_list = map(list, zip(*gts))
+        cate_preds = [torch.randn(batch_size, num_classes, num_grid, num_grid)
+                      for num_grid in num_grids]
+        kernel_preds = [
+            torch.randn(batch_size, num_channels, num_grid, num_grid,
+                        requires_grad=True) for num_grid in num_grids
+        ]
+        ins_pred = torch.randn(batch_size, num_channels, img_h // 4,
+                               img_w // 4, requires_grad=True)
+        grid_order_list = multi_targets(head, gts, ins_pred.shape[-2:])
+
+        with torch.no_grad():
+            loop_ms = timeit(lambda: loop_mask_preds(
+                kernel_preds, ins_pred, grid_order_list), args.repeat)
+            bmm_ms = timeit(lambda: batched_mask_preds(
+                head, kernel_preds, ins_pred, grid_order_list), args.repeat)
+
+        def loss_step():
+            losses = head.loss(cate_preds, kernel_preds, ins_pred,
+                               gt_bbox_list, gt_label_list, gt_mask_list,
+                               None)
+            sum(losses.values()).backward()
+
+        step_ms = timeit(loss_step, args.repeat)
+
+        # memory kept for the backward of the dice loss, with the targets
+        # copied per kernel as before and indexed per instance
+        ins_labels, ins_indexes = dice_inputs(head, gts, ins_pred.shape[-2:])
+        mask_preds = torch.randn(len(ins_indexes), *ins_labels.shape[1:],
+                                 requires_grad=True)
+        copy_mb = saved_mb(lambda: dice_loss(
+            torch.sigmoid(mask_preds), ins_labels[ins_indexes]))
+        index_mb = saved_mb(lambda: dice_loss(
+            torch.sigmoid(mask_preds), ins_labels, ins_indexes))
+        print(f'{batch_size:>5} {loop_ms:>16.1f} {bmm_ms:>15.1f} '
+              f'{step_ms:>15.1f} {copy_mb:>15.1f} {index_mb:>16.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import os.path as osp
+import random
+
+import mmcv
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmcv import Config, DictAction
+from mmcv.runner import load_checkpoint
+
+from mmdet.datasets import build_dataset
+from mmdet.models import build_detector
+
+from models.datasets import FeatureStoreWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Cache the neck outputs of the training set, to train '
+        'the heads of SOLO / SOLOv2 with train.py --feature-store')
+    parser.add_argument('config', help='train config file path')
+    parser.add_argument(
+        'checkpoint', help='checkpoint of the frozen backbone and neck')
+    parser.add_argument(
+        '--out',
+        help='directory of the feature store, features/ in the work_dir of '
+        'the config if not given')
+    parser.add_argument(
+        '--variants',
+        type=int,
+        default=4,
+        help='augmented samples of every image, drawn from the train '
+        'pipeline')
+    parser.add_argument(
+        '--pad-size',
+        type=int,
+        nargs=2,
+        metavar=('H', 'W'),
+        help='pad every image to this size before the backbone, so that '
+        'the samples can be batched like images padded to it. Without it '
+        'train.py needs samples_per_gpu=1')
+    parser.add_argument(
+        '--device', default='cuda:0', help='device used for the networks')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    # import modules from string list.
+    if cfg.get('custom_imports', None):
+        from mmcv.utils import import_modules_from_strings
+        import_modules_from_strings(**cfg['custom_imports'])
+    out = args.out
+    if out is None:
+        work_dir = cfg.get('work_dir') or osp.join(
+            './work_dirs', osp.splitext(osp.basename(args.config))[0])
+        out = osp.join(work_dir, 'features')
+    device = args.device if torch.cuda.is_available() else 'cpu'
+
+    cfg.model.pretrained = None
+    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
+    load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model.to(device).eval()
+
+    # the images themselves, RepeatDataset and the like would repeat them
+    data_cfg = cfg.data.train
+    while 'dataset' in data_cfg:
+        data_cfg = data_cfg.dataset
+    dataset = build_dataset(data_cfg)
+
+    writer = FeatureStoreWriter(out, dataset.CLASSES, args.variants,
+                                args.checkpoint, args.pad_size)
+    prog_bar = mmcv.ProgressBar(len(dataset))
+    for idx in range(len(dataset)):
+        for variant in range(args.variants):
+            # the random augmentations of a sample only depend on the seed
+            np.random.seed([args.seed, idx, variant])
+            random.seed(f'{args.seed}-{idx}-{variant}')
+            data = dataset.prepare_train_img(idx)
+            if data is None:
+                break
+            img = data['img'].data[None].to(device)
+            img_meta = data['img_metas'].data
+            if args.pad_size is not None:
+                # the zero padding collate gives a batch of larger images
+                h, w = img.shape[-2:]
+                pad_h, pad_w = args.pad_size
+                if h > pad_h or w > pad_w:
+                    raise ValueError(
+                        f'image {idx} is padded to {h}x{w} by the '
+                        f'pipeline, larger than --pad-size {pad_h} {pad_w}')
+                img = F.pad(img, (0, pad_w - w, 0, pad_h - h))
+                img_meta['pad_shape'] = (pad_h, pad_w, 3)
+            with torch.no_grad():
+                feats = model.extract_feat(img)
+            writer.add(idx, [feat[0] for feat in feats], img_meta,
+                       data['gt_bboxes'].data.numpy(),
+                       data['gt_labels'].data.numpy(), data['gt_masks'].data)
+        prog_bar.update()
+    size = writer.close()
+    print(f'\n{size / 2**30:.2f} GB of features written to {out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import argparse
+import os.path as osp
+import time
+
+import mmcv
+
+from models.datasets import dump_results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert a test.py --out pickle to a columnar results '
+        'file')
+    parser.add_argument('pkl', help='results pickle written by test.py')
+    parser.add_argument(
+        '--out', help='results file, the pickle path with .res if not given')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    out = args.out or osp.splitext(args.pkl)[0] + '.res'
+    start = time.perf_counter()
+    results = mmcv.load(args.pkl)
+    load_time = time.perf_counter() - start
+    size = dump_results(results, out)
+    print(f'{len(results)} images, {osp.getsize(args.pkl) / 2**20:.1f} MB '
+          f'pickle loaded in {load_time:.1f} s, {size / 2**20:.1f} MB '
+          f'written to {out}')
+
+
+if __name__ == '__main__':
+    main()
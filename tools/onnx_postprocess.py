@@ -0,0 +1,66 @@
+"""Post-processing of the SOLO / SOLOv2 ONNX graphs exported by
+pytorch2onnx.py. It only needs numpy and OpenCV, so that the graphs can be
+served with ONNX Runtime alone.
+"""
+import cv2
+import numpy as np
+
+# OpenCV resizes at most 512 channels at once
+MAX_CHANNELS = 512
+
+
+def resize_masks(masks, size):
+    """Bilinear resize of soft masks.
+    Args:
+        masks (ndarray): shape (n, h, w), float32
+        size (tuple): (h, w) of the output
+    Returns:
+        ndarray: shape (n, size[0], size[1])
+    """
+    out = np.empty((len(masks), ) + tuple(size), dtype=np.float32)
+    for start in range(0, len(masks), MAX_CHANNELS):
+        chunk = masks[start:start + MAX_CHANNELS].transpose(1, 2, 0)
+        chunk = cv2.resize(chunk, (size[1], size[0]),
+                           interpolation=cv2.INTER_LINEAR)
+        out[start:start + MAX_CHANNELS] = chunk.reshape(
+            size + (-1, )).transpose(2, 0, 1)
+    return out
+
+
+def postprocess(scores, labels, masks, img_shape, ori_shape, num_classes,
+                mask_thr=0.5):
+    """mmdet results of an image from the outputs of the graph.
+    Args:
+        scores (ndarray): shape (k), 0 for the masks that were dropped
+        labels (ndarray): shape (k)
+        masks (ndarray): shape (k, h, w), soft masks at stride 4 of the
+            padded image
+        img_shape (tuple): (h, w, c) of the resized image, before padding
+        ori_shape (tuple): (h, w, c) of the original image
+        num_classes (int): number of classes
+        mask_thr (float): test_cfg.mask_thr
+    Returns:
+        tuple[list]: bbox_result and segm_result, as simple_test gives
+            them
+    """
+    keep = scores > 0
+    scores, labels, masks = scores[keep], labels[keep], masks[keep]
+    h, w = img_shape[:2]
+    ori_h, ori_w = ori_shape[:2]
+    # upsample to the padded image, crop and resize to the original image
+    masks = resize_masks(masks, (masks.shape[1] * 4, masks.shape[2] * 4))
+    masks = resize_masks(masks[:, :h, :w], (ori_h, ori_w)) > mask_thr
+
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    bboxes = np.zeros((len(masks), 5), dtype=np.float32)
+    bboxes[:, 0] = cols.argmax(axis=1)
+    bboxes[:, 1] = rows.argmax(axis=1)
+    bboxes[:, 2] = ori_w - cols[:, ::-1].argmax(axis=1)
+    bboxes[:, 3] = ori_h - rows[:, ::-1].argmax(axis=1)
+    bboxes[~rows.any(axis=1), :4] = 0
+    bboxes[:, 4] = scores
+
+    bbox_result = [bboxes[labels == i] for i in range(num_classes)]
+    segm_result = [list(masks[labels == i]) for i in range(num_classes)]
+    return bbox_result, segm_result
@@ -0,0 +1,166 @@
+import argparse
+import inspect
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmcv import Config, DictAction
+from mmcv.parallel import collate
+from mmcv.runner import load_checkpoint
+
+from mmdet.datasets.pipelines import Compose
+from mmdet.models import build_detector
+
+from onnx_postprocess import postprocess
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export SOLO / SOLOv2 with post-processing to ONNX')
+    parser.add_argument('config', help='test config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument(
+        '--output-file', type=str, default='tmp.onnx', help='ONNX file')
+    parser.add_argument(
+        '--shape',
+        type=int,
+        nargs=2,
+        default=[800, 1344],
+        help='padded input size (h, w) of the graph')
+    parser.add_argument(
+        '--opset-version', type=int, default=11, help='ONNX opset version')
+    parser.add_argument(
+        '--input-img',
+        type=str,
+        help='image for --verify, a random input if not given')
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='compare ONNX Runtime on CPU with simple_test')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    args = parser.parse_args()
+    return args
+
+
+def load_input(cfg, input_img, shape):
+    """Image tensor padded to shape and its meta, through the test
+    pipeline."""
+    h, w = shape
+    if input_img is None:
+        img = torch.randn(1, 3, h, w)
+        img_meta = dict(img_shape=(h, w, 3), ori_shape=(h, w, 3),
+                        pad_shape=(h, w, 3), scale_factor=1.0, flip=False)
+        return img, img_meta
+    test_pipeline = Compose(cfg.data.test.pipeline)
+    data = test_pipeline(dict(img_info=dict(filename=input_img),
+                              img_prefix=None))
+    data = collate([data], samples_per_gpu=1)
+    img = data['img'][0]
+    img_meta = data['img_metas'][0].data[0][0]
+    pad_h, pad_w = img.shape[-2:]
+    assert pad_h <= h and pad_w <= w, \
+        f'the image is padded to {(pad_h, pad_w)}, larger than {shape}'
+    img = F.pad(img, (0, w - pad_w, 0, h - pad_h))
+    img_meta['pad_shape'] = (h, w, 3)
+    return img, img_meta
+
+
+def mask_iou(mask_a, mask_b):
+    union = (mask_a | mask_b).sum()
+    return (mask_a & mask_b).sum() / union if union > 0 else 1.
+
+
+def export(model, img, output_file, opset_version=11):
+    """Export model.onnx_export on img to output_file."""
+    kwargs = {}
+    # newer torch exports through dynamo by default, whose node names are
+    # not scoped by module, see quantize_onnx.excluded_nodes
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    model.forward = model.onnx_export
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                img,
+                output_file,
+                input_names=['input'],
+                output_names=['scores', 'labels', 'masks'],
+                opset_version=opset_version,
+                do_constant_folding=True,
+                **kwargs)
+    finally:
+        del model.forward
+
+
+def verify(model, output_file, img, img_meta, num_classes, mask_thr):
+    """Compare ONNX Runtime on CPU with simple_test. The detections and
+    their scores must match, and the mask IoU of every detection pair is
+    returned."""
+    import onnxruntime as ort
+
+    sess = ort.InferenceSession(output_file,
+                                providers=['CPUExecutionProvider'])
+    scores, labels, masks = sess.run(None, {'input': img.numpy()})
+    onnx_bboxes, onnx_segms = postprocess(scores, labels, masks,
+                                          img_meta['img_shape'],
+                                          img_meta['ori_shape'], num_classes,
+                                          mask_thr)
+    with torch.no_grad():
+        torch_bboxes, torch_segms = model.simple_test(
+            img, [img_meta], rescale=True)[0]
+
+    ious = []
+    for label in range(num_classes):
+        assert len(onnx_bboxes[label]) == len(torch_bboxes[label]), \
+            f'{len(onnx_bboxes[label])} vs {len(torch_bboxes[label])} ' \
+            f'detections of class {label}'
+        np.testing.assert_allclose(onnx_bboxes[label][:, 4],
+                                   torch_bboxes[label][:, 4], atol=1e-3)
+        ious += [mask_iou(onnx_segm, torch_segm) for onnx_segm, torch_segm
+                 in zip(onnx_segms[label], torch_segms[label])]
+    return ious
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    # import modules from string list.
+    if cfg.get('custom_imports', None):
+        from mmcv.utils import import_modules_from_strings
+        import_modules_from_strings(**cfg['custom_imports'])
+    cfg.model.pretrained = None
+    cfg.model.train_cfg = None
+    # the graph computes the masks of all cells and pastes them itself
+    test_cfg = cfg.model.get('test_cfg') or cfg.get('test_cfg')
+    if test_cfg is None:
+        raise ValueError(f'{args.config} has no test_cfg, the exported '
+                         'post-processing needs its thresholds')
+    test_cfg.lazy_masks = False
+    test_cfg.mask_format = 'full'
+
+    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
+    load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model.cpu().eval()
+
+    img, img_meta = load_input(cfg, args.input_img, args.shape)
+    export(model, img, args.output_file, args.opset_version)
+    print(f'Successfully exported ONNX model: {args.output_file}')
+
+    if args.verify:
+        ious = verify(model, args.output_file, img, img_meta,
+                      model.bbox_head.num_classes, test_cfg.mask_thr)
+        print(f'{len(ious)} detections match, mask IoU with simple_test: '
+              f'min {min(ious, default=1.):.4f} '
+              f'mean {np.mean(ious or [1.]):.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import argparse
+import time
+import warnings
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+import torch.nn.functional as F
+from mmcv import Config, DictAction
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat,
+                                      QuantType, quantize_static)
+from pycocotools import mask as mask_util
+from torch.utils.data import Subset
+
+from mmdet.datasets import build_dataloader, build_dataset
+
+from onnx_postprocess import postprocess
+
+# convs whose outputs are scores, mask logits or dynamic kernels
+SENSITIVE_LAYERS = ['solo_cate', 'solo_kernel', 'solo_ins_list',
+                    'dsolo_ins_list']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Quantize an exported SOLO / SOLOv2 graph to int8 and '
+        'compare it with the fp32 graph')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('model', help='fp32 ONNX file from pytorch2onnx.py')
+    parser.add_argument(
+        '--output-file', type=str, default='tmp_int8.onnx', help='int8 file')
+    parser.add_argument(
+        '--calib-num',
+        type=int,
+        default=64,
+        help='training images used for calibration')
+    parser.add_argument(
+        '--keep-fp32',
+        type=str,
+        nargs='+',
+        default=SENSITIVE_LAYERS,
+        help='convs whose module names contain one of these stay in fp32')
+    parser.add_argument(
+        '--per-channel',
+        action='store_true',
+        help='quantize the conv weights per output channel')
+    parser.add_argument(
+        '--eval',
+        type=str,
+        nargs='*',
+        default=['bbox', 'segm'],
+        help='metrics to compare on the test set, none to only quantize')
+    parser.add_argument(
+        '--eval-num',
+        type=int,
+        default=None,
+        help='test images to evaluate, all if not given')
+    parser.add_argument(
+        '--threads', type=int, default=None, help='intra-op threads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    args = parser.parse_args()
+    return args
+
+
+def build_images(cfg, data_cfg):
+    """Dataset of data_cfg through the test pipeline."""
+    while 'dataset' in data_cfg:
+        data_cfg = data_cfg.dataset
+    data_cfg.pipeline = cfg.data.test.pipeline
+    data_cfg.test_mode = True
+    return build_dataset(data_cfg)
+
+
+def build_loader(cfg, dataset):
+    return build_dataloader(
+        dataset,
+        samples_per_gpu=1,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False)
+
+
+def padded_input(data, shape):
+    """Image of a batch padded to the input shape of the graph, and its
+    meta."""
+    img = data['img'][0]
+    img_meta = data['img_metas'][0].data[0][0]
+    pad_h, pad_w = img.shape[-2:]
+    h, w = shape
+    assert pad_h <= h and pad_w <= w, \
+        f'the image is padded to {(pad_h, pad_w)}, export the graph with ' \
+        f'a --shape of at least that'
+    img = F.pad(img, (0, w - pad_w, 0, h - pad_h))
+    return img.numpy(), img_meta
+
+
+class CalibrationReader(CalibrationDataReader):
+
+    def __init__(self, data_loader, input_name, shape):
+        self.data = iter(data_loader)
+        self.input_name = input_name
+        self.shape = shape
+
+    def get_next(self):
+        data = next(self.data, None)
+        if data is None:
+            return None
+        return {self.input_name: padded_input(data, self.shape)[0]}
+
+
+def excluded_nodes(model_file, patterns):
+    """Convs of the graph that match one of the patterns.
+    A conv matches if its node name, its output names or its weight names
+    contain a pattern, with '/' read as '.'. torch exports the conv of
+    bbox_head.solo_cate as the node /bbox_head/solo_cate/Conv, whereas
+    constant folding can rename its weight to onnx::Conv_123. Every
+    pattern that matches no conv is warned about, and it is an error if
+    none matches.
+    """
+    graph = onnx.load(model_file).graph
+    nodes = []
+    matched = set()
+    for node in graph.node:
+        if node.op_type != 'Conv':
+            continue
+        names = [
+            name.replace('/', '.')
+            for name in [node.name, *node.output, *node.input[1:]]
+        ]
+        hits = {
+            pattern for pattern in patterns
+            if any(pattern.replace('/', '.') in name for name in names)
+        }
+        if hits:
+            nodes.append(node.name)
+            matched |= hits
+    for pattern in patterns:
+        if pattern not in matched:
+            warnings.warn(f'--keep-fp32 {pattern} matches no conv of '
+                          f'{model_file}')
+    if patterns and not nodes:
+        raise ValueError(
+            f'no conv of {model_file} matches --keep-fp32 {patterns}. The '
+            f'node names are only scoped by module for graphs exported '
+            f'with torch>=1.13')
+    return nodes
+
+
+def evaluate(session, data_loader, num_classes, mask_thr):
+    """Results of the graph on a dataset, with the mean model and
+    post-processing times in ms."""
+    inp = session.get_inputs()[0]
+    shape = inp.shape[-2:]
+    results = []
+    model_time = post_time = 0.
+    for data in data_loader:
+        img, img_meta = padded_input(data, shape)
+        start = time.perf_counter()
+        scores, labels, masks = session.run(None, {inp.name: img})
+        model_time += time.perf_counter() - start
+        start = time.perf_counter()
+        bbox_result, segm_result = postprocess(scores, labels, masks,
+                                               img_meta['img_shape'],
+                                               img_meta['ori_shape'],
+                                               num_classes, mask_thr)
+        post_time += time.perf_counter() - start
+        segm_result = [[
+            mask_util.encode(np.array(segm[:, :, None], order='F',
+                                      dtype='uint8'))[0]
+            for segm in cls_segms
+        ] for cls_segms in segm_result]
+        results.append((bbox_result, segm_result))
+    num_imgs = max(len(results), 1)
+    return results, model_time / num_imgs * 1000, post_time / num_imgs * 1000
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    test_cfg = cfg.model.get('test_cfg') or cfg.get('test_cfg')
+
+    options = ort.SessionOptions()
+    if args.threads is not None:
+        options.intra_op_num_threads = args.threads
+    fp32_session = ort.InferenceSession(
+        args.model, options, providers=['CPUExecutionProvider'])
+    inp = fp32_session.get_inputs()[0]
+
+    # calibrate on random training images and quantize the convs
+    calib_set = build_images(cfg, cfg.data.train)
+    rng = np.random.default_rng(args.seed)
+    calib_set = Subset(calib_set, sorted(rng.choice(
+        len(calib_set), min(args.calib_num, len(calib_set)),
+        replace=False)))
+    exclude = excluded_nodes(args.model, args.keep_fp32)
+    print(f'keeping {len(exclude)} convs in fp32: {exclude}')
+    quantize_static(
+        args.model,
+        args.output_file,
+        CalibrationReader(build_loader(cfg, calib_set), inp.name,
+                          inp.shape[-2:]),
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=['Conv'],
+        per_channel=args.per_channel,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        nodes_to_exclude=exclude)
+    print(f'Successfully quantized ONNX model: {args.output_file}')
+    if not args.eval:
+        return
+
+    int8_session = ort.InferenceSession(
+        args.output_file, options, providers=['CPUExecutionProvider'])
+    dataset = build_images(cfg, cfg.data.test)
+    if args.eval_num is not None:
+        # the first eval_num images
+        dataset.data_infos = dataset.data_infos[:args.eval_num]
+        dataset.img_ids = dataset.img_ids[:args.eval_num]
+    test_loader = build_loader(cfg, dataset)
+    eval_kwargs = cfg.get('evaluation', {}).copy()
+    # hard-code way to remove EvalHook args
+    for key in [
+            'interval', 'tmpdir', 'start', 'gpu_collect', 'save_best', 'rule'
+    ]:
+        eval_kwargs.pop(key, None)
+    eval_kwargs.update(metric=args.eval)
+
+    rows = []
+    for name, session in [('fp32', fp32_session), ('int8', int8_session)]:
+        results, model_ms, post_ms = evaluate(session, test_loader,
+                                              len(dataset.CLASSES),
+                                              test_cfg.mask_thr)
+        rows.append((name, model_ms, post_ms,
+                     dataset.evaluate(results, **eval_kwargs)))
+
+    keys = [f'{metric}_mAP' for metric in args.eval]
+    print(f'{"model":>6} {"graph (ms)":>11} {"post (ms)":>10} ' +
+          ' '.join(f'{key:>10}' for key in keys))
+    for name, model_ms, post_ms, metrics in rows:
+        print(f'{name:>6} {model_ms:>11.1f} {post_ms:>10.1f} ' +
+              ' '.join(f'{metrics.get(key, float("nan")):>10.3f}'
+                       for key in keys))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+import argparse
+import contextlib
+import copy
+import inspect
+import io
+import itertools
+import multiprocessing
+import os
+import os.path as osp
+import time
+
+import mmcv
+import numpy as np
+import torch
+from mmcv import Config, DictAction
+from mmcv.runner import load_checkpoint
+
+from mmdet.datasets import build_dataloader, build_dataset
+from mmdet.models import build_detector
+
+OUTPUTS_FILE = 'outputs.bin'
+INDEX_FILE = 'index.pkl'
+# changes with the layout of the outputs file, so that older caches are
+# computed again
+CACHE_VERSION = 2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run SOLO / SOLOv2 once over the test set and evaluate '
+        'a grid of test_cfg values on the cached head outputs')
+    parser.add_argument('config', help='test config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument(
+        '--cache',
+        help='directory of the cached head outputs, head_outputs/ in the '
+        'work_dir of the config if not given. An existing cache is reused '
+        'if it was made with the same checkpoint, model and test data '
+        'configs and --eval-num')
+    parser.add_argument(
+        '--grid',
+        nargs='+',
+        action=DictAction,
+        default={},
+        help='test_cfg values to sweep, e.g. score_thr=0.05,0.1 '
+        'kernel=gaussian,linear, every combination is evaluated')
+    parser.add_argument(
+        '--eval',
+        type=str,
+        nargs='+',
+        default=['bbox', 'segm'],
+        help='evaluation metrics')
+    parser.add_argument(
+        '--eval-num',
+        type=int,
+        default=None,
+        help='test images to cache, all if not given')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='processes evaluating settings in parallel')
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='intra-op threads of every worker, cpu count / workers if not '
+        'given')
+    parser.add_argument(
+        '--device', default='cuda:0', help='device used for the networks')
+    parser.add_argument('--out', help='dump the metrics of all settings')
+    parser.add_argument(
+        '--cfg-options',
+        nargs='+',
+        action=DictAction,
+        help='override some settings in the used config, the key-value pair '
+        'in xxx=yyy format will be merged into config file.')
+    args = parser.parse_args()
+    return args
+
+
+def build_test_dataset(cfg, num_imgs=None):
+    cfg.data.test.test_mode = True
+    dataset = build_dataset(cfg.data.test)
+    if num_imgs is not None:
+        # the first num_imgs images
+        dataset.data_infos = dataset.data_infos[:num_imgs]
+        dataset.img_ids = dataset.img_ids[:num_imgs]
+    return dataset
+
+
+def build_head(cfg, checkpoint):
+    cfg.model.pretrained = None
+    cfg.model.train_cfg = None
+    model = build_detector(cfg.model, test_cfg=cfg.get('test_cfg'))
+    load_checkpoint(model, checkpoint, map_location='cpu', logger='silent')
+    return model.eval()
+
+
+def dump_outputs(file, outs, offset, fp32_outs=()):
+    """Write the head outputs of an image as fp16, except the ones in
+    fp32_outs.
+    Args:
+        file (file): the outputs file
+        outs (tuple[Tensor | list[Tensor]]): outputs of network_outputs
+        offset (int): bytes already in the file
+        fp32_outs (Sequence[int]): indices of the outputs kept in fp32
+    Returns:
+        tuple: the layout of the outputs, with the (offset, shape, dtype) of
+            every tensor in place of the tensor, and the new offset
+    """
+    layout = []
+    for i, out in enumerate(outs):
+        tensors = out if isinstance(out, (list, tuple)) else [out]
+        dtype = torch.float if i in fp32_outs else torch.half
+        entries = []
+        for tensor in tensors:
+            tensor = tensor.detach().to(dtype).cpu().numpy()
+            file.write(tensor.tobytes())
+            entries.append((offset, tensor.shape, tensor.dtype.str))
+            offset += tensor.nbytes
+        layout.append(entries if isinstance(out, (list, tuple))
+                      else entries[0])
+    return layout, offset
+
+
+def score_outputs(head):
+    """Indices of the category scores among the outputs of network_outputs,
+    the cate_preds argument of get_seg."""
+    params = list(inspect.signature(head.get_seg).parameters)
+    return (params.index('cate_preds'), )
+
+
+def load_outputs(values, layout):
+    """Head outputs of an image from the memory-mapped outputs file."""
+
+    def load(offset, shape, dtype):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        tensor = values[offset:offset + size].view(dtype).reshape(shape)
+        return torch.from_numpy(tensor.astype(np.float32))
+
+    return tuple([load(*entry) for entry in entries]
+                 if isinstance(entries, list) else load(*entries)
+                 for entries in layout)
+
+
+def cache_fingerprint(cfg, checkpoint, num_imgs):
+    """What the cached outputs depend on: the checkpoint file, the model and
+    test data configs and the number of images."""
+    return dict(
+        checkpoint=osp.abspath(checkpoint),
+        checkpoint_mtime=osp.getmtime(checkpoint),
+        checkpoint_size=osp.getsize(checkpoint),
+        model=cfg.model.to_dict(),
+        data=cfg.data.test.to_dict(),
+        num_imgs=num_imgs,
+        version=CACHE_VERSION)
+
+
+def cache_outputs(cfg, checkpoint, cache, num_imgs, device):
+    """Run the networks over the test set and store what get_seg reads."""
+    # before build_head changes the model config
+    fingerprint = cache_fingerprint(cfg, checkpoint, num_imgs)
+    model = build_head(cfg, checkpoint).to(device)
+    dataset = build_test_dataset(cfg, num_imgs)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu=1,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False)
+    mmcv.mkdir_or_exist(cache)
+    index = dict(
+        num_imgs=len(dataset),
+        fingerprint=fingerprint,
+        samples=[])
+    offset = 0
+    # the category scores stay in fp32, so that the detections near
+    # score_thr and update_thr are the ones of test.py
+    fp32_outs = score_outputs(model.bbox_head)
+    prog_bar = mmcv.ProgressBar(len(dataset))
+    with open(osp.join(cache, OUTPUTS_FILE), 'wb') as file:
+        for data in data_loader:
+            img = data['img'][0].to(device)
+            img_meta = data['img_metas'][0].data[0][0]
+            with torch.no_grad():
+                outs = model.network_outputs(img)
+            layout, offset = dump_outputs(file, outs, offset, fp32_outs)
+            index['samples'].append(dict(img_meta=img_meta, layout=layout))
+            prog_bar.update()
+    mmcv.dump(index, osp.join(cache, INDEX_FILE))
+    print(f'\n{offset / 2**30:.2f} GB of head outputs written to {cache}')
+
+
+# state of a worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(cfg, checkpoint, cache, eval_kwargs, threads):
+    torch.set_num_threads(threads)
+    if cfg.get('custom_imports', None):
+        from mmcv.utils import import_modules_from_strings
+        import_modules_from_strings(**cfg['custom_imports'])
+    index = mmcv.load(osp.join(cache, INDEX_FILE))
+    _worker.update(
+        head=build_head(cfg, checkpoint).bbox_head,
+        test_cfg=cfg.model.get('test_cfg') or cfg.get('test_cfg'),
+        dataset=build_test_dataset(cfg, index['num_imgs']),
+        samples=index['samples'],
+        values=np.memmap(
+            osp.join(cache, OUTPUTS_FILE), dtype=np.uint8, mode='r'),
+        eval_kwargs=eval_kwargs)
+
+
+def eval_setting(setting):
+    """Metrics of the cached outputs post-processed with a test_cfg
+    setting."""
+    start = time.perf_counter()
+    test_cfg = copy.deepcopy(_worker['test_cfg'])
+    test_cfg.update(setting)
+    head = _worker['head']
+    results = []
+    for sample in _worker['samples']:
+        outs = load_outputs(_worker['values'], sample['layout'])
+        with torch.no_grad():
+            bbox_results, segm_results = head.get_seg(
+                *outs, [sample['img_meta']], test_cfg, rescale=True)
+        results.append((bbox_results[0], segm_results[0]))
+    with contextlib.redirect_stdout(io.StringIO()):
+        metrics = _worker['dataset'].evaluate(results,
+                                              **_worker['eval_kwargs'])
+    return setting, metrics, time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    # import modules from string list.
+    if cfg.get('custom_imports', None):
+        from mmcv.utils import import_modules_from_strings
+        import_modules_from_strings(**cfg['custom_imports'])
+    cache = args.cache
+    if cache is None:
+        work_dir = cfg.get('work_dir') or osp.join(
+            './work_dirs', osp.splitext(osp.basename(args.config))[0])
+        cache = osp.join(work_dir, 'head_outputs')
+    # SOLO keeps the mask features instead of the masks of all cells, and
+    # the masks are encoded as RLE right away
+    test_cfg = cfg.model.get('test_cfg') or cfg.get('test_cfg')
+    test_cfg.lazy_masks = True
+    test_cfg.mask_format = 'rle'
+
+    index_file = osp.join(cache, INDEX_FILE)
+    fingerprint = cache_fingerprint(cfg, args.checkpoint, args.eval_num)
+    if osp.exists(index_file) and \
+            mmcv.load(index_file).get('fingerprint') == fingerprint:
+        print(f'using the head outputs cached in {cache}')
+    else:
+        if osp.exists(index_file):
+            print(f'the head outputs cached in {cache} are of another '
+                  'checkpoint, config or --eval-num, computing them again')
+        device = args.device if torch.cuda.is_available() else 'cpu'
+        cache_outputs(cfg, args.checkpoint, cache, args.eval_num, device)
+
+    eval_kwargs = cfg.get('evaluation', {}).copy()
+    # hard-code way to remove EvalHook args
+    for key in [
+            'interval', 'tmpdir', 'start', 'gpu_collect', 'save_best', 'rule'
+    ]:
+        eval_kwargs.pop(key, None)
+    eval_kwargs.update(metric=args.eval)
+    keys = list(args.grid)
+    grid = [
+        values if isinstance(values, list) else [values]
+        for values in args.grid.values()
+    ]
+    settings = [dict(zip(keys, values)) for values in itertools.product(*grid)]
+    workers = min(args.workers, len(settings))
+    threads = args.threads or max(os.cpu_count() // workers, 1)
+
+    rows = []
+    prog_bar = mmcv.ProgressBar(len(settings))
+    # forked workers can hang in the OpenMP pool the parent already used
+    with multiprocessing.get_context('spawn').Pool(
+            workers,
+            initializer=init_worker,
+            initargs=(cfg, args.checkpoint, cache, eval_kwargs,
+                      threads)) as pool:
+        for row in pool.imap_unordered(eval_setting, settings):
+            rows.append(row)
+            prog_bar.update()
+
+    metric_keys = [f'{metric}_mAP' for metric in args.eval]
+    rows.sort(key=lambda row: [-row[1].get(key, 0) for key in metric_keys])
+    print('\n' + ' '.join(f'{key:>12}' for key in keys + metric_keys) +
+          f' {"time (s)":>9}')
+    for setting, metrics, seconds in rows:
+        print(' '.join(f'{str(setting[key]):>12}' for key in keys) + ' ' +
+              ' '.join(f'{metrics.get(key, float("nan")):>12.3f}'
+                       for key in metric_keys) + f' {seconds:>9.1f}')
+    if args.out:
+        mmcv.dump([dict(setting=setting, metrics=metrics)
+                   for setting, metrics, _ in rows], args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,8 @@ from mmdet.datasets import build_dataset
 from mmdet.models import build_detector
 from mmdet.utils import collect_env, get_root_logger
 
+from models.datasets import FeatureStoreDataset  # noqa: F401
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Train a detector')
@@ -24,6 +26,10 @@ def parse_args():
     parser.add_argument('--work-dir', help='the dir to save logs and models')
     parser.add_argument(
         '--resume-from', help='the checkpoint file to resume from')
+    parser.add_argument(
+        '--feature-store',
+        help='train the heads only, on the neck outputs cached by '
+        'tools/cache_features.py in this directory')
     parser.add_argument(
         '--no-validate',
         action='store_true',
@@ -107,6 +113,11 @@ def main():
                                 osp.splitext(osp.basename(args.config))[0])
     if args.resume_from is not None:
         cfg.resume_from = args.resume_from
+    # the images, whose pipeline the val stage of the workflow uses
+    img_train_cfg = cfg.data.train
+    if args.feature_store is not None:
+        cfg.data.train = dict(
+            type='FeatureStoreDataset', store=args.feature_store)
     if args.gpu_ids is not None:
         cfg.gpu_ids = args.gpu_ids
     else:
@@ -161,9 +172,21 @@ def main():
         test_cfg=cfg.get('test_cfg'))
 
     datasets = [build_dataset(cfg.data.train)]
+    if args.feature_store is not None:
+        # the backbone and neck the features were computed with
+        model.backbone.requires_grad_(False)
+        if model.with_neck:
+            model.neck.requires_grad_(False)
+        if cfg.data.samples_per_gpu > 1 and not datasets[0].fixed_shape:
+            raise ValueError(
+                f'{args.feature_store} was cached without --pad-size, so '
+                'its samples can only be batched with samples_per_gpu=1')
+        cfg.load_from = datasets[0].index['checkpoint']
+        logger.info(f'Training the heads on {args.feature_store}, '
+                    f'load_from {cfg.load_from}')
     if len(cfg.workflow) == 2:
         val_dataset = copy.deepcopy(cfg.data.val)
-        val_dataset.pipeline = cfg.data.train.pipeline
+        val_dataset.pipeline = img_train_cfg.pipeline
         datasets.append(build_dataset(val_dataset))
     if cfg.checkpoint_config is not None:
         # save mmdet version, config file content and class names in